@@ -0,0 +1,556 @@
+## CPU micro benchmarks for the captioning model, run with: python benchmark.py <name> [options]
+
+import argparse
+import copy
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+from model import MultiHeadAttention, HAS_SDPA, ProjectionLayer, build_transformer, precision_context
+
+
+def timeit(fn, repeat: int = 20, warmup: int = 3):
+    # median wall time of fn() in milliseconds
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def bench_attention(args):
+    # Compare the 'math' and 'sdpa' attention backends on the encoder (256 patches, no mask)
+    # and decoder (150 tokens, causal + padding mask) shapes. Both backends have to agree
+    # on the output, with the mask in boolean and in additive form, before they are timed
+    torch.manual_seed(0)
+    attention = MultiHeadAttention(args.d_model, args.heads).eval()
+
+    seq_len = args.seq_len
+    padding = torch.arange(seq_len) < seq_len - seq_len // 3  # last third of the caption is [PAD]
+    bool_mask = (torch.tril(torch.ones(seq_len, seq_len, dtype=torch.bool)) & padding).view(1, 1, seq_len, seq_len)
+    additive_mask = torch.zeros(bool_mask.shape).masked_fill(~bool_mask, float('-inf'))
+    shapes = [
+        ('encoder', args.patches, None),
+        ('decoder bool mask', seq_len, bool_mask),
+        ('decoder additive mask', seq_len, additive_mask),
+    ]
+    backends = ['math', 'sdpa'] if HAS_SDPA else ['math']
+
+    print(f"{'shape':<24}{'backend':<8}{'ms':>10}{'max abs diff':>16}")
+    with torch.no_grad():
+        for name, length, mask in shapes:
+            x = torch.randn(args.batch_size, length, args.d_model)
+            reference = None
+            for backend in backends:
+                attention.set_backend(backend)
+                out = attention(x, x, x, mask)
+                if reference is None:
+                    reference = out
+                diff = (out - reference).abs().max().item()
+                assert diff < 1e-4, f'{backend} attention does not match the math backend on {name}: {diff}'
+                ms = timeit(lambda: attention(x, x, x, mask), args.repeat)
+                print(f'{name:<24}{backend:<8}{ms:>10.2f}{diff:>16.2e}')
+
+
+def bench_dataloader(args):
+    # samples/sec of the training DataLoader from get_ds for every worker count,
+    # the first batch is not counted because it includes the worker start-up.
+    # --shard-dir measures the streaming dataset instead (the shards are written on the first run)
+    from config import get_config
+    from train import get_ds
+
+    config = get_config()
+    config['batch_size'] = args.batch_size
+    config['shard_dir'] = args.shard_dir
+    print(f"{'workers':>8}{'samples/sec':>14}")
+    for workers in args.workers:
+        config['num_workers'] = workers
+        train_dataloader, _, _ = get_ds(config)
+        iterator = iter(train_dataloader)
+        next(iterator)
+        samples = 0
+        start = time.perf_counter()
+        for _ in range(args.batches):
+            batch = next(iterator, None)
+            if batch is None:
+                break
+            samples += batch['encoder_input'].size(0)
+        elapsed = time.perf_counter() - start
+        print(f'{workers:>8}{samples / elapsed:>14.1f}')
+        del iterator, train_dataloader
+
+
+def benchmark_model(args, **kwargs):
+    # The positional table is shared by the 256 patches and the caption, so it needs
+    # max(seq_len, patches) rows for encode to work
+    return build_transformer(max(args.seq_len, args.patches), args.batch_size, args.vocab_size, args.d_model, **kwargs)
+
+
+def bench_precision(args):
+    # Train step time and peak RSS in fp32 and bf16. Every precision runs in its own
+    # process, otherwise the peak RSS of the first run would hide the second one
+    if args.precision is not None:
+        torch.manual_seed(0)
+        model = benchmark_model(args, pad_idx=1).train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=5e-5, eps=1e-9)
+        loss_fn = torch.nn.CrossEntropyLoss(ignore_index=1, label_smoothing=0.1)
+        image = torch.randn(args.batch_size, 3, 224, 224)
+        tokens = torch.randint(4, args.vocab_size, (args.batch_size, args.seq_len))
+
+        def step():
+            optimizer.zero_grad()
+            with precision_context('cpu', args.precision):
+                encoder_output = model.encode(image, None)
+                proj_output = model.project(model.decode(tokens, None, None, encoder_output))
+            loss = loss_fn(proj_output.view(-1, args.vocab_size), tokens.view(-1))
+            loss.backward()
+            optimizer.step()
+
+        ms = timeit(step, args.repeat, warmup=2)
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'{args.precision:<8}{ms:>12.1f}{peak_mb:>16.0f}')
+        return
+
+    print(f"{'mode':<8}{'step ms':>12}{'peak RSS MB':>16}")
+    for precision in ('fp32', 'bf16'):
+        subprocess.run([sys.executable, __file__, 'precision', '--precision', precision,
+                        '--batch-size', str(args.batch_size), '--seq-len', str(args.seq_len),
+                        '--vocab-size', str(args.vocab_size), '--repeat', str(args.repeat)], check=True)
+
+
+def bench_loss(args):
+    # Projection + loss forward/backward time and peak RSS, full log-probs + CrossEntropyLoss vs
+    # the chunked loss (--chunk-size 0 is the full path). Each run is its own process for the RSS,
+    # the chunked runs also check their loss and gradients against the full path
+    padded = args.seq_len // 3  # last third of every caption is [PAD]
+
+    def run(chunk_size):
+        torch.manual_seed(0)
+        projection = ProjectionLayer(args.d_model, args.vocab_size)
+        x = torch.randn(args.batch_size, args.seq_len, args.d_model, requires_grad=True)
+        label = torch.randint(4, args.vocab_size, (args.batch_size, args.seq_len))
+        label[:, args.seq_len - padded:] = 1
+        loss_fn = torch.nn.CrossEntropyLoss(ignore_index=1, label_smoothing=0.1)
+
+        def step():
+            x.grad = None
+            projection.zero_grad()
+            if chunk_size:
+                loss = projection.loss(x, label, 1, 0.1, chunk_size)
+            else:
+                loss = loss_fn(projection(x).view(-1, args.vocab_size), label.view(-1))
+            loss.backward()
+            return loss
+        return step, x, projection
+
+    if args.chunk_size is not None:
+        step, x, projection = run(args.chunk_size)
+        ms = timeit(step, args.repeat, warmup=1)
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if args.chunk_size:
+            # checked after the timing so the full reference does not count towards the peak RSS
+            loss = step().item()
+            reference, x_ref, projection_ref = run(0)
+            diff = abs(reference().item() - loss)
+            for grad, ref_grad in zip([x.grad, projection.fc.weight.grad], [x_ref.grad, projection_ref.fc.weight.grad]):
+                diff = max(diff, (grad - ref_grad).abs().max().item())
+            assert diff < 1e-4, f'chunked loss does not match the full projection: {diff}'
+        print(f'{args.chunk_size or "full":<8}{ms:>12.1f}{peak_mb:>16.0f}')
+        return
+
+    print(f"{'chunk':<8}{'step ms':>12}{'peak RSS MB':>16}")
+    for chunk_size in [0] + args.chunk_sizes:
+        subprocess.run([sys.executable, __file__, 'loss', '--chunk-size', str(chunk_size),
+                        '--batch-size', str(args.batch_size), '--seq-len', str(args.seq_len),
+                        '--vocab-size', str(args.vocab_size), '--repeat', str(args.repeat)], check=True)
+
+
+def _distributed_worker(rank, world_size, args, port):
+    import torch.distributed as dist
+    from distributed import wrap_model
+
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+    # the same global batch on every process, each one trains on its own rows of it.
+    # No [PAD] in the labels, so every process averages over the same number of tokens
+    torch.manual_seed(0)
+    model = benchmark_model(args, pad_idx=1)
+    batch_size = args.batch_size * world_size
+    image = torch.randn(batch_size, 3, 224, 224)
+    tokens = torch.randint(4, args.vocab_size, (batch_size, args.seq_len))
+    rows = slice(rank, None, world_size)
+
+    # the DDP gradient has to be the gradient of the whole batch in a single process (dropout off)
+    reference = copy.deepcopy(model).eval()
+    reference(image, tokens, tokens, 1, 0.1).backward()
+    ddp_model = wrap_model(model, {'ddp_bucket_mb': args.bucket_mb}).eval()
+    ddp_model(image[rows], tokens[rows], tokens[rows], 1, 0.1).backward()
+    diff = max((p.grad - r.grad).abs().max().item() for p, r in zip(model.parameters(), reference.parameters())
+               if r.grad is not None)
+    assert diff < 1e-4, f'distributed gradients do not match the single process gradients: {diff}'
+    del reference
+
+    ddp_model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=5e-5, eps=1e-9)
+
+    def step():
+        optimizer.zero_grad(set_to_none=True)
+        ddp_model(image[rows], tokens[rows], tokens[rows], 1, 0.1).backward()
+        optimizer.step()
+
+    ms = timeit(step, args.repeat, warmup=1)
+    if rank == 0:
+        print(f'{world_size:>10}{ms:>12.1f}{batch_size / ms * 1000:>16.2f}{diff:>16.2e}')
+    dist.destroy_process_group()
+
+
+def bench_distributed(args):
+    # Train step time of DistributedDataParallel on one machine for every process count, with
+    # batch_size samples per process. Before timing, the gradients of every run are checked against
+    # the gradients of the whole batch in one process
+    import torch.multiprocessing as mp
+
+    print(f"{'processes':>10}{'step ms':>12}{'samples/sec':>16}{'max grad diff':>16}")
+    for world_size in args.processes:
+        mp.spawn(_distributed_worker, args=(world_size, args, args.port + world_size), nprocs=world_size, join=True)
+
+
+def bench_features(args):
+    # Decoder-only fine-tuning step time with the full model training, with a frozen encoder that still
+    # runs on the images, and with precomputed encoder features. The frozen encoder runs without dropout,
+    # so the live and the precomputed step have to give the same loss
+    torch.manual_seed(0)
+    model = benchmark_model(args, pad_idx=1)
+    image = torch.randn(args.batch_size, 3, 224, 224)
+    tokens = torch.randint(4, args.vocab_size, (args.batch_size, args.seq_len))
+
+    def run(frozen, precomputed):
+        model.freeze_encoder(frozen)
+        model.train()
+        optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=0.0)
+        features = None
+        if precomputed:
+            with torch.no_grad():
+                features = model.encode(image, None)
+
+        def step():
+            optimizer.zero_grad()
+            torch.manual_seed(0)
+            loss = model(image, tokens, tokens, 1, 0.1, args.chunk_size, encoder_output=features)
+            loss.backward()
+            optimizer.step()
+            return loss
+        return step
+
+    print(f"{'mode':<14}{'step ms':>12}{'speedup':>10}")
+    losses = {}
+    baseline = None
+    for name, frozen, precomputed in [('full', False, False), ('frozen', True, False), ('precomputed', True, True)]:
+        step = run(frozen, precomputed)
+        ms = timeit(step, args.repeat, warmup=1)
+        losses[name] = step().item()
+        baseline = baseline or ms
+        print(f'{name:<14}{ms:>12.1f}{baseline / ms:>9.2f}x')
+    diff = abs(losses['frozen'] - losses['precomputed'])
+    assert diff < 1e-5, f'precomputed features do not match the frozen encoder: {diff}'
+
+
+def bench_export(args):
+    # Greedy captioning latency per caption of the eager model (generate.batch_greedy_decode) and of the
+    # static-KV captioner of export.py run eagerly, as TorchScript and with torch.compile. The random weights
+    # rarely produce [EOS], so every run decodes max_len steps. All of them have to give the same captions
+    from export import build_captioner, captioner_outputs
+    from generate import batch_greedy_decode
+
+    class SpecialTokens:
+        def token_to_id(self, token):
+            return {'[PAD]': 1, '[SOS]': 2, '[EOS]': 3}[token]
+
+    torch.manual_seed(0)
+    model = benchmark_model(args, pad_idx=1).eval()
+    images = torch.randn(args.batch_size, 3, 224, 224)
+    with torch.no_grad():
+        reference = batch_greedy_decode(model, images, SpecialTokens(), args.max_len, 'cpu')
+    backends = ['eager', 'torchscript'] + (['compile'] if args.compile else [])
+
+    print(f"{'mode':<14}{'ms/caption':>12}{'speedup':>10}")
+    with torch.no_grad():
+        baseline = timeit(lambda: batch_greedy_decode(model, images, SpecialTokens(), args.max_len, 'cpu'),
+                          args.repeat, warmup=1) / args.batch_size
+        print(f"{'reference':<14}{baseline:>12.1f}{1.0:>9.2f}x")
+        for backend in backends:
+            captioner = build_captioner(model, args.max_len, 2, 3, 1, backend, images)
+            outputs = captioner_outputs(*captioner(images))
+            assert all(torch.equal(output, ref) for output, ref in zip(outputs, reference)), f'{backend} captions differ'
+            ms = timeit(lambda: captioner(images), args.repeat, warmup=1) / args.batch_size
+            print(f'{backend:<14}{ms:>12.1f}{baseline / ms:>9.2f}x')
+
+
+def bench_quantize(args):
+    # Greedy captioning latency per caption, serialized size and caption agreement of dynamic and static int8
+    # against fp32. Random weights and images, the static scales are calibrated on random captions, so
+    # the agreement is only a smoke test here, quantize.py reports it on the validation split
+    import warnings
+    from quantize import quantize_model, quantization_report
+
+    class SpecialTokens:
+        def token_to_id(self, token):
+            return {'[PAD]': 1, '[SOS]': 2, '[EOS]': 3}[token]
+
+    torch.manual_seed(0)
+    model = benchmark_model(args, pad_idx=1).eval()
+    loader = [{'encoder_input': torch.randn(args.batch_size, 3, 224, 224),
+               'decoder_input': torch.randint(4, args.vocab_size, (args.batch_size, args.seq_len))}
+              for _ in range(args.batches)]
+
+    print(f"{'mode':<10}{'ms/caption':>12}{'speedup':>10}{'MB':>10}{'exact':>8}{'tokens':>8}")
+    with warnings.catch_warnings():
+        # torch.ao.quantization warns about its own deprecation on every call
+        warnings.simplefilter('ignore')
+        for mode in args.modes:
+            report = quantization_report(model, quantize_model(model, mode, loader, args.batches), loader,
+                                         SpecialTokens(), args.max_len)
+            if mode == args.modes[0]:
+                print(f"{'fp32':<10}{report['fp32 ms/caption']:>12.1f}{1.0:>9.2f}x{report['fp32 MB']:>10.0f}")
+            print(f"{mode:<10}{report['int8 ms/caption']:>12.1f}{report['speedup']:>9.2f}x{report['int8 MB']:>10.0f}"
+                  f"{report['exact match']:>8.2f}{report['token agreement']:>8.2f}")
+
+
+def bench_server(args):
+    # Throughput and latency of the micro-batching caption server for different max-wait windows: requests
+    # images from concurrent clients over a local socket, the model is a random model with a fixed number of
+    # decode steps, so only the batching differs between the runs
+    import asyncio
+    import io
+    from PIL import Image
+    from dataset import ImagePreprocessor
+    from generate import batch_greedy_decode
+    from server import CaptionServer, caption_images
+
+    class SpecialTokens:
+        def token_to_id(self, token):
+            return {'[PAD]': 1, '[SOS]': 2, '[EOS]': 3}[token]
+
+    torch.manual_seed(0)
+    model = benchmark_model(args, pad_idx=1).eval()
+
+    def caption_fn(pixel_values):
+        return [' '.join(map(str, t.tolist())) for t in batch_greedy_decode(model, pixel_values, SpecialTokens(), args.max_len, 'cpu')]
+
+    images = []
+    for _ in range(args.requests):
+        buffer = io.BytesIO()
+        Image.fromarray(torch.randint(0, 256, (256, 256, 3), dtype=torch.uint8).numpy()).save(buffer, format='JPEG')
+        images.append(buffer.getvalue())
+
+    async def run(max_wait_ms):
+        server = CaptionServer(caption_fn, ImagePreprocessor(), args.max_batch_size, max_wait_ms)
+        await server.start()
+        listener = await asyncio.start_server(server.handle_connection, '127.0.0.1', args.port)
+        start = time.perf_counter()
+        await caption_images(images, args.concurrency, port=args.port)
+        elapsed = time.perf_counter() - start
+        listener.close()
+        await listener.wait_closed()
+        await server.stop()
+        return elapsed, server.metrics()
+
+    print(f"{'max wait ms':>12}{'req/sec':>10}{'queue p50':>11}{'compute p50':>13}{'total p90':>11}  batch sizes")
+    for max_wait_ms in args.max_wait_ms:
+        elapsed, metrics = asyncio.run(run(max_wait_ms))
+        print(f"{max_wait_ms:>12.0f}{args.requests / elapsed:>10.2f}{metrics['queue_ms']['p50']:>11.0f}"
+              f"{metrics['compute_ms']['p50']:>13.0f}{metrics['total_ms']['p90']:>11.0f}  {metrics['batch_sizes']}")
+
+
+def bench_scheduler(args):
+    # Steady stream of caption requests (Poisson arrivals at --rate per second) through static batches
+    # (generate.batch_greedy_decode on up to --slots waiting images, new images wait for the whole batch)
+    # and through the continuous batching scheduler with --slots slots. The random model never produces
+    # [EOS], so every request gets a random caption length between --min-len and --max-len instead
+    import collections
+    from generate import batch_greedy_decode
+    from scheduler import ContinuousBatcher
+
+    class SpecialTokens:
+        def token_to_id(self, token):
+            return {'[PAD]': 1, '[SOS]': 2, '[EOS]': 3}[token]
+
+    torch.manual_seed(0)
+    model = benchmark_model(args, pad_idx=1).eval()
+    with torch.no_grad():
+        model.projection.fc.bias[3] = -1e4
+    images = torch.randn(args.requests, 3, 224, 224)
+    lengths = torch.randint(args.min_len, args.max_len + 1, (args.requests,)).tolist()
+    arrivals = torch.empty(args.requests).exponential_(args.rate).cumsum(0).tolist()
+
+    def run_static():
+        # a batch runs until its longest caption is done
+        latencies, i = [], 0
+        start = time.perf_counter()
+        while i < args.requests:
+            now = time.perf_counter() - start
+            if arrivals[i] > now:
+                time.sleep(arrivals[i] - now)
+                continue
+            batch = [j for j in range(i, args.requests) if arrivals[j] <= now][:args.slots]
+            with torch.no_grad():
+                batch_greedy_decode(model, images[batch], SpecialTokens(), max(lengths[j] for j in batch), 'cpu')
+            done = time.perf_counter() - start
+            latencies += [done - arrivals[j] for j in batch]
+            i += len(batch)
+        return time.perf_counter() - start, latencies
+
+    def run_continuous():
+        batcher = ContinuousBatcher(model, args.slots, args.max_len, 2, 3, 1)
+        waiting = collections.deque(range(args.requests))
+        latencies = []
+        start = time.perf_counter()
+        while waiting or batcher.pending():
+            now = time.perf_counter() - start
+            while waiting and arrivals[waiting[0]] <= now:
+                i = waiting.popleft()
+                batcher.submit(images[i], i, lengths[i])
+            if not batcher.pending():
+                time.sleep(arrivals[waiting[0]] - now)
+                continue
+            _, finished = batcher.step()
+            done = time.perf_counter() - start
+            for i, tokens in finished:
+                assert len(tokens) == lengths[i]
+                latencies.append(done - arrivals[i])
+        return time.perf_counter() - start, latencies
+
+    print(f"{'scheduler':<12}{'req/sec':>10}{'p50 s':>8}{'p90 s':>8}{'p99 s':>8}")
+    for name, run in (('static', run_static), ('continuous', run_continuous)):
+        elapsed, latencies = run()
+        latencies.sort()
+        p = lambda q: latencies[min(len(latencies) - 1, int(q / 100 * len(latencies)))]
+        print(f'{name:<12}{args.requests / elapsed:>10.2f}{p(50):>8.2f}{p(90):>8.2f}{p(99):>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU benchmarks for the captioning model')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    attention = subparsers.add_parser('attention', help='math vs sdpa attention backends')
+    attention.add_argument('--batch-size', type=int, default=2)
+    attention.add_argument('--d-model', type=int, default=768)
+    attention.add_argument('--heads', type=int, default=8)
+    attention.add_argument('--patches', type=int, default=256)
+    attention.add_argument('--seq-len', type=int, default=150)
+    attention.add_argument('--repeat', type=int, default=20)
+    attention.set_defaults(func=bench_attention)
+
+    dataloader = subparsers.add_parser('dataloader', help='data pipeline throughput for different worker counts')
+    dataloader.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4, 8])
+    dataloader.add_argument('--batch-size', type=int, default=8)
+    dataloader.add_argument('--batches', type=int, default=50)
+    dataloader.add_argument('--shard-dir', default=None, help='stream from the Arrow shards in this directory')
+    dataloader.set_defaults(func=bench_dataloader)
+
+    precision = subparsers.add_parser('precision', help='fp32 vs bf16 train step time and peak RSS')
+    precision.add_argument('--precision', choices=['fp32', 'bf16'], default=None, help='run a single mode (used internally)')
+    precision.add_argument('--batch-size', type=int, default=2)
+    precision.add_argument('--d-model', type=int, default=768)
+    precision.add_argument('--patches', type=int, default=256)
+    precision.add_argument('--seq-len', type=int, default=150)
+    precision.add_argument('--vocab-size', type=int, default=36749)
+    precision.add_argument('--repeat', type=int, default=5)
+    precision.set_defaults(func=bench_precision)
+
+    loss = subparsers.add_parser('loss', help='full vs chunked projection + cross entropy')
+    loss.add_argument('--chunk-sizes', type=int, nargs='+', default=[256, 1024])
+    loss.add_argument('--chunk-size', type=int, default=None, help='run a single chunk size (used internally)')
+    loss.add_argument('--batch-size', type=int, default=8)
+    loss.add_argument('--d-model', type=int, default=768)
+    loss.add_argument('--seq-len', type=int, default=150)
+    loss.add_argument('--vocab-size', type=int, default=36749)
+    loss.add_argument('--repeat', type=int, default=5)
+    loss.set_defaults(func=bench_loss)
+
+    distributed = subparsers.add_parser('distributed', help='DistributedDataParallel train steps with local processes')
+    distributed.add_argument('--processes', type=int, nargs='+', default=[1, 2])
+    distributed.add_argument('--batch-size', type=int, default=2, help='samples per process')
+    distributed.add_argument('--d-model', type=int, default=768)
+    distributed.add_argument('--patches', type=int, default=256)
+    distributed.add_argument('--seq-len', type=int, default=150)
+    distributed.add_argument('--vocab-size', type=int, default=36749)
+    distributed.add_argument('--bucket-mb', type=int, default=25)
+    distributed.add_argument('--port', type=int, default=29600)
+    distributed.add_argument('--repeat', type=int, default=3)
+    distributed.set_defaults(func=bench_distributed)
+
+    features = subparsers.add_parser('features', help='full vs frozen encoder vs precomputed encoder features train step')
+    features.add_argument('--batch-size', type=int, default=4)
+    features.add_argument('--d-model', type=int, default=768)
+    features.add_argument('--patches', type=int, default=256)
+    features.add_argument('--seq-len', type=int, default=150)
+    features.add_argument('--vocab-size', type=int, default=36749)
+    features.add_argument('--chunk-size', type=int, default=1024)
+    features.add_argument('--repeat', type=int, default=3)
+    features.set_defaults(func=bench_features)
+
+    export = subparsers.add_parser('export', help='eager vs TorchScript vs torch.compile greedy captioning latency')
+    export.add_argument('--batch-size', type=int, default=4)
+    export.add_argument('--d-model', type=int, default=768)
+    export.add_argument('--patches', type=int, default=256)
+    export.add_argument('--seq-len', type=int, default=150)
+    export.add_argument('--vocab-size', type=int, default=36749)
+    export.add_argument('--max-len', type=int, default=30)
+    export.add_argument('--compile', action='store_true', help='also time torch.compile (compiling takes a while)')
+    export.add_argument('--repeat', type=int, default=3)
+    export.set_defaults(func=bench_export)
+
+    quantize = subparsers.add_parser('quantize', help='fp32 vs dynamic/static int8 greedy captioning')
+    quantize.add_argument('--modes', nargs='+', choices=['dynamic', 'static'], default=['dynamic', 'static'])
+    quantize.add_argument('--batch-size', type=int, default=4)
+    quantize.add_argument('--batches', type=int, default=2)
+    quantize.add_argument('--d-model', type=int, default=768)
+    quantize.add_argument('--patches', type=int, default=256)
+    quantize.add_argument('--seq-len', type=int, default=150)
+    quantize.add_argument('--vocab-size', type=int, default=36749)
+    quantize.add_argument('--max-len', type=int, default=20)
+    quantize.set_defaults(func=bench_quantize)
+
+    server = subparsers.add_parser('server', help='caption server throughput and latency for different max-wait windows')
+    server.add_argument('--max-wait-ms', type=float, nargs='+', default=[0, 10, 50])
+    server.add_argument('--max-batch-size', type=int, default=8)
+    server.add_argument('--requests', type=int, default=32)
+    server.add_argument('--concurrency', type=int, default=8)
+    server.add_argument('--d-model', type=int, default=768)
+    server.add_argument('--patches', type=int, default=256)
+    server.add_argument('--seq-len', type=int, default=150)
+    server.add_argument('--vocab-size', type=int, default=36749)
+    server.add_argument('--max-len', type=int, default=10)
+    server.add_argument('--port', type=int, default=29700)
+    server.set_defaults(func=bench_server, batch_size=1)
+
+    scheduler = subparsers.add_parser('scheduler', help='static batches vs continuous batching under a steady request stream')
+    scheduler.add_argument('--requests', type=int, default=48)
+    scheduler.add_argument('--rate', type=float, default=4.0, help='requests per second')
+    scheduler.add_argument('--slots', type=int, default=8)
+    scheduler.add_argument('--min-len', type=int, default=5)
+    scheduler.add_argument('--max-len', type=int, default=40)
+    scheduler.add_argument('--d-model', type=int, default=768)
+    scheduler.add_argument('--patches', type=int, default=256)
+    scheduler.add_argument('--seq-len', type=int, default=150)
+    scheduler.add_argument('--vocab-size', type=int, default=36749)
+    scheduler.set_defaults(func=bench_scheduler, batch_size=1)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+## Checkpoints that are written from a background thread while training continues.
+## A checkpoint is the rank 0 file from get_weights_file_path (model, optimizer, epoch, step, data position)
+## plus one small <name>.rank<r>.pt shard per process with its RNG state.
+
+import os
+import queue
+import random
+import re
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+def cpu_snapshot(state):
+    # copy of every tensor in a (nested) state dict on the CPU, the training loop can keep
+    # updating the parameters and the Adam moments in place while the copy is written
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: cpu_snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_snapshot(value) for value in state)
+    return state
+
+
+def get_rng_state():
+    state = {
+        'torch': torch.get_rng_state(),
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def shard_path(path, rank: int):
+    # tmodel_03.pt -> tmodel_03.rank0.pt
+    path = Path(path)
+    return str(path.with_name(f'{path.stem}.rank{rank}{path.suffix}'))
+
+
+def list_checkpoints(config):
+    # rank 0 checkpoint files <model_basename><epoch>[_<step>].pt, oldest first. Other files of the
+    # model folder (RNG shards, quantize.py outputs like tmodel_05.int8.pt) are not checkpoints
+    folder = Path(config['model_folder'])
+    if not folder.exists():
+        return []
+    pattern = re.compile(re.escape(config['model_basename']) + r'\d+(_\d+)?\.pt')
+    files = [path for path in folder.iterdir() if pattern.fullmatch(path.name)]
+    return [str(path) for path in sorted(files, key=lambda path: path.stat().st_mtime)]
+
+
+def latest_checkpoint(config):
+    # tag of the newest checkpoint for config['preload'] = 'latest', None when there is none
+    files = list_checkpoints(config)
+    if not files:
+        return None
+    return Path(files[-1]).stem[len(config['model_basename']):]
+
+
+class AsyncCheckpointer:
+    # save() takes a CPU snapshot of the states on the calling thread and returns, the files are written
+    # by a background thread to <path>.tmp and renamed into place, so a crash never leaves a half
+    # written checkpoint behind. A save() while the previous checkpoint is still being written blocks
+    # until it is done, so there is never more than one snapshot in memory. Only the keep_last newest
+    # checkpoints written by this checkpointer are kept (0 keeps all of them), files of earlier runs are
+    # never deleted
+    def __init__(self, keep_last: int = 0, background: bool = True):
+        self.keep_last = keep_last
+        self.history = []
+        self._error = None
+        self._queue = None
+        if background:
+            self._queue = queue.Queue(maxsize=1)
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def save(self, files):
+        # files: {path: state dict}, all of them belong to one checkpoint
+        self.wait()
+        files = {path: cpu_snapshot(state) for path, state in files.items()}
+        if self._queue is not None:
+            self._queue.put(files)
+        else:
+            self._write(files)
+
+    def wait(self):
+        # blocks until every checkpoint handed to save() is on disk
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._queue is not None:
+            self._queue.join()
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def _write(self, files):
+        for path, state in files.items():
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = f'{path}.tmp'
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+        self.history = [group for group in self.history if not set(group) & set(files)]
+        self.history.append(list(files))
+        if self.keep_last:
+            while len(self.history) > self.keep_last:
+                for path in self.history.pop(0):
+                    Path(path).unlink(missing_ok=True)
+
+    def _worker(self):
+        while True:
+            files = self._queue.get()
+            try:
+                if files is None:
+                    return
+                self._write(files)
+            except Exception as error:
+                self._error = error
+            finally:
+                # the snapshot is freed before the next save() makes a new one
+                files = None
+                self._queue.task_done()
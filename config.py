@@ -2,18 +2,56 @@ from pathlib import Path
 
 def get_config():
     return {
-        "batch_size":2,
+        "batch_size":2,  # micro-batch size, the effective batch size is batch_size * grad_accum_steps
+        "grad_accum_steps": 1,
+        "loss_chunk_size": 1024,  # positions per chunk of the fused projection + loss, 0 projects the whole batch at once
+        "activation_checkpointing": False,  # recompute EncoderBlock/DecoderBlock activations in backward
+        "freeze_encoder": False,  # train only the decoder and projection, PatchEmbed and the Encoder keep their weights
+        "encoder_features": None,  # path prefix of the precomputed frozen-encoder output, e.g. "cache/features", needs freeze_encoder
+        "encoder_features_dtype": "float16",  # 'float32' or 'float16'
+        "encoder_features_batch_size": 32,  # images per encoder forward while the features are built
         "num_epochs": 100,
         "lr": 50**-4,
         "seq_len": 150,
         "d_model": 768,
+        "attention_backend": "auto",  # 'auto', 'sdpa' or 'math'
+        "precision": "fp32",  # 'fp32' or 'bf16' (torch.autocast, LayerNorm/softmax/loss stay in fp32)
+        "fused_qkv": False,  # one packed QKV GEMM for self-attention, one packed KV GEMM for cross-attention
         "lang_src": "0",
         "lang_tgt": "1",
         "model_folder": "weights",
         "model_basename": "tmodel_",
-        "preload": None,
+        "preload": None,  # checkpoint tag to resume from, e.g. "05" or "05_0001200", or "latest"
+        "checkpoint_every": 0,  # optimizer steps between mid-epoch checkpoints, 0 only saves at the end of every epoch
+        "keep_last_checkpoints": 0,  # > 0 deletes the older checkpoints written by the run, 0 keeps all of them
+        "async_checkpoint": True,  # write checkpoints from a background thread
         "tokenizer_file": "tokenizer.json",
+        "image_processor": "builtin",  # 'builtin' (torch/PIL, works offline) or 'hf' (transformers ViTFeatureExtractor)
+        "image_size": 224,
+        "image_cache": None,  # path prefix of the preprocessed image cache, e.g. "cache/images"
+        "image_cache_dtype": "float32",  # 'float32' (served without a copy), opt-in smaller caches: 'float16' (upcast on every read) or 'uint8' (normalized on every read)
+        "caption_store": None,  # path prefix of the pre-tokenized captions, e.g. "cache/captions"
+        "shard_dir": None,  # stream the data from Arrow shards in <shard_dir>/train and /val (written on the first run), e.g. "shards"
+        "shard_rows": 5000,  # rows per shard file when the shards are written
+        "shuffle_buffer": 1000,  # records the streaming dataset shuffles at a time
+        "dynamic_padding": False,  # pad every batch to its longest caption instead of seq_len
+        "bucket_batching": False,  # batch captions of similar length together
+        "bucket_size_multiplier": 100,  # a bucket holds batch_size * bucket_size_multiplier samples
+        "val_batch_size": 16,  # validation loss and caption generation run in batches of this size
+        "val_max_samples": None,  # validate on a fixed random subset of this many images, None uses the whole split
+        "val_generate": True,  # generate captions for CER/WER/BLEU during validation
+        "num_workers": 0,  # DataLoader worker processes, 0 loads in the training process
+        "pin_memory": False,  # only helps when training on a GPU
+        "persistent_workers": False,  # keep the workers alive between epochs
+        "prefetch_factor": 2,  # batches loaded in advance by each worker
         "experiment_name": "runs/tmodel",
+        "log_every": 50,  # steps between metric flushes to TensorBoard/wandb
+        "log_in_background": True,  # write the flushed metrics from a background thread
+        "log_grad_norm": False,  # also log the total gradient norm
+        "grad_flow_every": 0,  # steps between gradient flow plots (graph.png), 0 turns them off
+        "dist_backend": "gloo",  # process group backend of torchrun runs, gloo works on CPU-only nodes
+        "ddp_bucket_mb": 25,  # size of the gradient buckets that are all-reduced while backward runs
+        "threads_per_process": None,  # intra-op threads of every torchrun process, None splits the cores between the local processes
         'project_name': 'proj1'
     }
 
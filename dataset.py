@@ -1,46 +1,413 @@
+import hashlib
+import io
+import json
+import os
+import random
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
 import torch
 import torchvision
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Subset, Sampler, get_worker_info
 import pandas as pd
-from transformers import ViTFeatureExtractor
+from PIL import Image
+from tqdm import tqdm
 
 # import model
 model_id = 'google/vit-base-patch16-224-in21k'
-feature_extractor = ViTFeatureExtractor.from_pretrained(
-    model_id
-)
+# created on first use, so every DataLoader worker builds its own copy instead of
+# inheriting a half-initialized one from the parent process. transformers is only
+# imported when the 'hf' image processor is used
+feature_extractor = None
+
+def get_feature_extractor():
+    global feature_extractor
+    if feature_extractor is None:
+        from transformers import ViTFeatureExtractor
+        feature_extractor = ViTFeatureExtractor.from_pretrained(
+            model_id
+        )
+    return feature_extractor
+
+
+# preprocessing settings of google/vit-base-patch16-224-in21k
+VIT_IMAGE_MEAN = (0.5, 0.5, 0.5)
+VIT_IMAGE_STD = (0.5, 0.5, 0.5)
+
+class ImagePreprocessor:
+    # Built-in version of the ViT feature extractor: bilinear resize to img_size, rescale to [0, 1]
+    # and normalize with the ViT mean/std. Only needs PIL and torch, no download and no transformers
+    def __init__(self, img_size: int = 224, image_mean=VIT_IMAGE_MEAN, image_std=VIT_IMAGE_STD, rescale_factor: float = 1 / 255):
+        self.img_size = img_size
+        self.image_mean = list(image_mean)
+        self.image_std = list(image_std)
+        self.rescale_factor = rescale_factor
+
+    def resize(self, image):
+        # PIL image -> (3, img_size, img_size) uint8 tensor
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image = image.resize((self.img_size, self.img_size), resample=Image.BILINEAR)
+        return torch.from_numpy(np.asarray(image).copy()).permute(2, 0, 1)
+
+    def normalize(self, pixels):
+        # (..., 3, H, W) uint8 -> float32 pixel_values
+        mean = torch.tensor(self.image_mean).view(-1, 1, 1)
+        std = torch.tensor(self.image_std).view(-1, 1, 1)
+        return (pixels.float() * self.rescale_factor - mean) / std
+
+    def __call__(self, image):
+        return self.normalize(self.resize(image))
+
+    def batch(self, images):
+        # list of PIL images -> (n, 3, img_size, img_size), normalized in one op on the stacked uint8 images
+        return self.normalize(torch.stack([self.resize(image) for image in images]))
+
+
+class HFImageProcessor:
+    # Same interface as ImagePreprocessor on top of the transformers ViT feature extractor
+    def load(self):
+        return get_feature_extractor()
+
+    @property
+    def image_mean(self):
+        return list(self.load().image_mean)
+
+    @property
+    def image_std(self):
+        return list(self.load().image_std)
+
+    @property
+    def rescale_factor(self):
+        return self.load().rescale_factor
+
+    def resize(self, image):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        pixels = self.load()(image, do_rescale=False, do_normalize=False, return_tensors='np')['pixel_values'][0]
+        return torch.from_numpy(np.rint(pixels).astype(np.uint8))
+
+    def __call__(self, image):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return self.load()(image, return_tensors='pt')['pixel_values'][0]
+
+    def batch(self, images):
+        images = [image if image.mode == 'RGB' else image.convert('RGB') for image in images]
+        return self.load()(images, return_tensors='pt')['pixel_values']
+
+
+def get_image_processor(kind: str = 'builtin', img_size: int = 224):
+    assert kind in ('builtin', 'hf'), f'unknown image processor {kind}'
+    if kind == 'hf':
+        return HFImageProcessor()
+    return ImagePreprocessor(img_size)
+
+
+def worker_init_fn(worker_id):
+    # Each DataLoader worker preprocesses whole samples on its own, so intra-op threads
+    # would only oversubscribe the cores the other workers are using
+    torch.set_num_threads(1)
+    # the transformers feature extractor is loaded once per worker before the first batch,
+    # the built-in processor has nothing to load
+    load = getattr(getattr(get_worker_info().dataset, 'image_processor', None), 'load', None)
+    if load is not None:
+        load()
+
+
+def dataloader_kwargs(config):
+    # DataLoader settings from get_config(), the worker-only options are only valid with num_workers > 0
+    kwargs = {'num_workers': config['num_workers'], 'pin_memory': config['pin_memory']}
+    if config['num_workers'] > 0:
+        # set before the workers fork, the tokenizer may already have used its thread pool here
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        kwargs.update(
+            worker_init_fn=worker_init_fn,
+            persistent_workers=config['persistent_workers'],
+            prefetch_factor=config['prefetch_factor'],
+        )
+    return kwargs
+
+class TensorStore:
+    # Fixed shape rows in a memory-mapped <path>.npy file, with a json index (<path>.json) next to it.
+    # Rows are in the order of the raw dataset, so row i belongs to ds_raw[i]
+    def __init__(self, path):
+        path = Path(path)
+        with open(Path(f'{path}.json')) as f:
+            self.index = json.load(f)
+        if not self.index.get('complete'):
+            raise ValueError(f'{path} was not written completely, delete it and build it again')
+        # copy-on-write mapping: slices are zero-copy and torch does not complain about read-only arrays
+        self.data = np.load(Path(f'{path}.npy'), mmap_mode='c')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.data[idx])
+
+    @staticmethod
+    def exists(path):
+        return Path(f'{path}.json').exists()
+
+    @staticmethod
+    def create(path, shape, dtype, **index):
+        # returns a writable memmap, call TensorStore.finish once every row is written
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        index.update(shape=list(shape), dtype=np.dtype(dtype).name, complete=False)
+        with open(Path(f'{path}.json'), 'w') as f:
+            json.dump(index, f)
+        return np.lib.format.open_memmap(Path(f'{path}.npy'), mode='w+', dtype=dtype, shape=tuple(shape))
+
+    @staticmethod
+    def finish(path, data):
+        data.flush()
+        path = Path(path)
+        with open(Path(f'{path}.json')) as f:
+            index = json.load(f)
+        index['complete'] = True
+        with open(Path(f'{path}.json'), 'w') as f:
+            json.dump(index, f)
+
+
+class ImageCache(TensorStore):
+    # Preprocessed pixel_values of every image, stored as float32, float16 or uint8.
+    # float32 rows are served without a copy, uint8 keeps the resized image before rescaling/normalizing
+    # (4x smaller than float32) and the normalization is applied when a row is read
+    def __init__(self, path):
+        super().__init__(path)
+        self.mean = torch.tensor(self.index['image_mean']).view(-1, 1, 1)
+        self.std = torch.tensor(self.index['image_std']).view(-1, 1, 1)
+
+    def matches(self, image_processor, dtype: str, rows: int) -> bool:
+        # False when the cache was built with other preprocessing settings, another dtype or for another dataset
+        img_size = getattr(image_processor, 'img_size', self.index['shape'][-1])
+        return (self.index['dtype'] == dtype and self.index['shape'][0] == rows and self.index['shape'][-1] == img_size
+                and self.index['image_mean'] == list(image_processor.image_mean)
+                and self.index['image_std'] == list(image_processor.image_std)
+                and self.index['rescale_factor'] == image_processor.rescale_factor)
+
+    def __getitem__(self, idx):
+        pixels = super().__getitem__(idx)
+        if self.index['dtype'] == 'uint8':
+            return (pixels.float() * self.index['rescale_factor'] - self.mean) / self.std
+        if self.index['dtype'] == 'float16':
+            return pixels.float()
+        return pixels
+
+
+def build_image_cache(ds, path, dtype: str = 'float32', image_processor=None):
+    # One pass over the raw dataset that runs the image processor on every image
+    # and writes pixel_values into an ImageCache
+    assert dtype in ('float32', 'float16', 'uint8'), f'unsupported image cache dtype {dtype}'
+    image_processor = image_processor if image_processor is not None else get_image_processor()
+    data = None
+    for i in tqdm(range(len(ds)), desc=f'Caching images to {path}'):
+        image = ds[i]['image']
+        if dtype == 'uint8':
+            pixels = image_processor.resize(image)
+        else:
+            pixels = image_processor(image)
+        if data is None:
+            data = TensorStore.create(path, (len(ds),) + tuple(pixels.shape), dtype,
+                                      image_mean=image_processor.image_mean,
+                                      image_std=image_processor.image_std,
+                                      rescale_factor=image_processor.rescale_factor)
+        data[i] = pixels.numpy()
+    TensorStore.finish(path, data)
+    return ImageCache(path)
+
+
+class FeatureStore(TensorStore):
+    # Output of the frozen encoder for every image, (patches, d_model) per row, stored as float32 or float16.
+    # The index holds the encoder_fingerprint of the weights it was built with
+    def __getitem__(self, idx):
+        features = super().__getitem__(idx)
+        if self.index['dtype'] == 'float16':
+            return features.float()
+        return features
+
+
+def build_encoder_features(model, ds, path, dtype: str = 'float16', batch_size: int = 32, device='cpu'):
+    # One pass over every image of the raw dataset behind ds (a BilingualDataset) through the frozen
+    # encoder, in eval mode and fp32. Rows are in raw dataset order like the other stores
+    assert dtype in ('float32', 'float16'), f'unsupported encoder feature dtype {dtype}'
+    was_training = model.training
+    model.eval()
+    num_rows = len(ds.raw)
+    data = None
+    with torch.no_grad():
+        for start in tqdm(range(0, num_rows, batch_size), desc=f'Encoding images to {path}'):
+            rows = range(start, min(start + batch_size, num_rows))
+            pixel_values = torch.stack([ds.pixel_values(row) for row in rows]).to(device)
+            features = model.encode(pixel_values, None).float().cpu()
+            if data is None:
+                data = TensorStore.create(path, (num_rows,) + tuple(features.shape[1:]), dtype,
+                                          encoder=model.encoder_fingerprint())
+            data[start:start + len(rows)] = features.numpy()
+    TensorStore.finish(path, data)
+    model.train(was_training)
+    return FeatureStore(path)
+
+
+class CaptionStore:
+    # Token ids of every caption in one flat int32 array, caption i is ids[offsets[i]:offsets[i + 1]].
+    # lengths is the per-caption length index (without [SOS]/[EOS]), rows are in raw dataset order
+    def __init__(self, path):
+        with open(f'{path}.json') as f:
+            self.index = json.load(f)
+        self.ids = np.load(f'{path}.ids.npy', mmap_mode='c')
+        self.offsets = np.load(f'{path}.offsets.npy')
+        self.lengths = np.load(f'{path}.lengths.npy')
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.ids[self.offsets[idx]:self.offsets[idx + 1]]).long()
+
+    def matches(self, tokenizer, rows: int) -> bool:
+        # False when the store was built with another tokenizer or for another dataset
+        return (self.index['rows'] == rows and self.index['vocab_size'] == tokenizer.get_vocab_size()
+                and self.index.get('tokenizer') == tokenizer_fingerprint(tokenizer))
+
+    @staticmethod
+    def exists(path):
+        return Path(f'{path}.json').exists()
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    # sha1 of the serialized tokenizer, a retrained tokenizer can keep its vocab size
+    return hashlib.sha1(tokenizer.to_str().encode()).hexdigest()
+
+
+def build_caption_store(ds, tokenizer, path, batch_size: int = 1000):
+    # One pass over the captions of the raw dataset, tokenized in batches with encode_batch
+    texts = ds.select_columns(['en_text'])
+    ids, lengths = [], []
+    for start in tqdm(range(0, len(texts), batch_size), desc=f'Tokenizing captions to {path}'):
+        for encoding in tokenizer.encode_batch(texts[start:start + batch_size]['en_text']):
+            ids.append(np.asarray(encoding.ids, dtype=np.int32))
+            lengths.append(len(encoding.ids))
+    lengths = np.asarray(lengths, dtype=np.int32)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    np.save(f'{path}.ids.npy', np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32))
+    np.save(f'{path}.offsets.npy', offsets)
+    np.save(f'{path}.lengths.npy', lengths)
+    # the index is written last, a store without it is incomplete
+    with open(f'{path}.json', 'w') as f:
+        json.dump({'rows': len(lengths), 'max_length': int(lengths.max(initial=0)), 'vocab_size': tokenizer.get_vocab_size(),
+                   'tokenizer': tokenizer_fingerprint(tokenizer)}, f)
+    return CaptionStore(path)
+
 
 class BilingualDataset(Dataset):
-    def __init__(self, ds, tokenizer_tgt, seq_len):
+    def __init__(self, ds, tokenizer_tgt, seq_len, image_cache=None, caption_store=None, pad_to_seq_len: bool = True,
+                 image_processor=None):
         super().__init__()
         self.seq_len = seq_len
 
         self.ds = ds
         self.tokenizer_tgt = tokenizer_tgt
 
+        # ds may be a random_split Subset of the raw dataset, the caches are indexed by raw row
+        self.rows = ds.indices if isinstance(ds, Subset) else range(len(ds))
+        self.raw = ds.dataset if isinstance(ds, Subset) else ds
+        self.image_cache = image_cache
+        self.image_processor = image_processor if image_processor is not None else get_image_processor()
+        if image_cache is not None:
+            # the images come from the cache, so only the caption column has to be read
+            self.texts = self.raw.select_columns(['en_text'])
+        # precomputed encoder output that replaces the image, see set_encoder_features
+        self.encoder_features = None
+        # pre-tokenized captions, the tokenizer is only used when there is no store
+        self.caption_store = caption_store
+        # without padding to seq_len the samples keep their own length and collate_batch
+        # pads every batch to its longest caption
+        self.pad_to_seq_len = pad_to_seq_len
+
         self.sos_token = torch.tensor([tokenizer_tgt.token_to_id("[SOS]")], dtype=torch.int64)
         self.eos_token = torch.tensor([tokenizer_tgt.token_to_id("[EOS]")], dtype=torch.int64)
         self.pad_token = torch.tensor([tokenizer_tgt.token_to_id("[PAD]")], dtype=torch.int64)
+        self.sos_id = tokenizer_tgt.token_to_id("[SOS]")
+        self.eos_id = tokenizer_tgt.token_to_id("[EOS]")
+        self.pad_id = tokenizer_tgt.token_to_id("[PAD]")
 
     def __len__(self):
         return len(self.ds)
 
+    def set_encoder_features(self, feature_store):
+        # samples carry 'encoder_output' from the FeatureStore instead of 'encoder_input', the images are
+        # not read anymore. Only valid while the encoder is frozen with the weights the store was built with
+        self.encoder_features = feature_store
+        self.texts = self.raw.select_columns(['en_text'])
+
+    def pixel_values(self, row):
+        # preprocessed image of row of the raw dataset -> (3, 224, 224)
+        if self.image_cache is not None:
+            return self.image_cache[row]
+        return self.image_processor(self.raw[row]['image'])
+
+    def caption_lengths(self):
+        # number of caption tokens of every sample, read from the caption store when there is one
+        if self.caption_store is not None:
+            return self.caption_store.lengths[np.asarray(self.rows)]
+        # one read of the whole caption column instead of one per row
+        texts = self.raw.select_columns(['en_text'])[list(self.rows)]['en_text']
+        return np.asarray([len(e.ids) for e in self.tokenizer_tgt.encode_batch(texts)])
+
+    def __getitems__(self, indices):
+        # A whole batch at once (the DataLoader calls this instead of __getitem__ for every index): one Arrow
+        # read of the rows, the captions tokenized with encode_batch and the images preprocessed as one
+        # stacked tensor. Gives the same samples as __getitem__
+        rows = [self.rows[idx] for idx in indices]
+        if self.encoder_features is not None:
+            tgt_texts = self.texts[rows]['en_text']
+            sources = {'encoder_output': self.encoder_features[rows]}
+        elif self.image_cache is not None:
+            tgt_texts = self.texts[rows]['en_text']
+            sources = {'encoder_input': self.image_cache[rows]}
+        else:
+            columns = self.raw[rows]
+            tgt_texts = columns['en_text']
+            sources = {'encoder_input': self.image_processor.batch(columns['image'])}
+
+        if self.caption_store is not None:
+            tokens = [self.caption_store[row] for row in rows]
+        else:
+            tokens = [torch.tensor(encoding.ids, dtype=torch.int64) for encoding in self.tokenizer_tgt.encode_batch(tgt_texts)]
+        return [
+            caption_sample({key: value[i] for key, value in sources.items()}, tgt_texts[i], tokens[i], self.seq_len,
+                           self.sos_id, self.eos_id, self.pad_id, self.pad_to_seq_len)
+            for i in range(len(rows))
+        ]
+
     def __getitem__(self, idx):
     
      
 
         
-        src_target_pair = self.ds[idx]
-        src_image = src_target_pair['image']
-        tgt_text = src_target_pair['en_text']
+        row = self.rows[idx]
+        if self.encoder_features is not None:
+            # the frozen encoder already ran on this image -> (patches, d_model)
+            tgt_text = self.texts[row]['en_text']
+            source = {'encoder_output': self.encoder_features[row]}
+        elif self.image_cache is not None:
+            tgt_text = self.texts[row]['en_text']
+            source = {'encoder_input': self.image_cache[row]}
+        else:
+            src_target_pair = self.ds[idx]
+            src_image = src_target_pair['image']
+            tgt_text = src_target_pair['en_text']
 
-        if src_image.mode != 'RGB':
-            src_image = src_image.convert('RGB')
-        
-        enc_input = feature_extractor(
-        src_image,
-        return_tensors='pt'
-        )
+            # converted to RGB, resized and normalized -> (3, 224, 224)
+            source = {'encoder_input': self.image_processor(src_image)}
         
         
      
@@ -49,66 +416,384 @@ class BilingualDataset(Dataset):
 
         # # Transform the text into tokens
         # enc_input_tokens = self.tokenizer_src.encode(src_text).ids
-        dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
-
-        # Add sos, eos and padding to each sentence
-        # enc_num_padding_tokens = self.seq_len - len(enc_input_tokens) - 2  # We will add <s> and </s>
-        # We will only add <s>, and </s> only on the label
-        dec_num_padding_tokens = self.seq_len - len(dec_input_tokens) - 1
-
-        # Make sure the number of padding tokens is not negative. If it is, the sentence is too long
-        if dec_num_padding_tokens < 0:
-            raise ValueError("Sentence is too long")
-
-        # # Add <s> and </s> token
-        # encoder_input = torch.cat(
-        #     [
-        #         self.sos_token,
-        #         torch.tensor(enc_input_tokens, dtype=torch.int64),
-        #         self.eos_token,
-        #         torch.tensor([self.pad_token] * enc_num_padding_tokens, dtype=torch.int64),
-        #     ],
-        #     dim=0,
-        # )
-
-        # Add only <s> token
-        decoder_input = torch.cat(
-            [
-                self.sos_token,
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
-                torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
-            ],
-            dim=0,
-        )
+        if self.caption_store is not None:
+            dec_input_tokens = self.caption_store[row]
+        else:
+            dec_input_tokens = torch.tensor(self.tokenizer_tgt.encode(tgt_text).ids, dtype=torch.int64)
+        return caption_sample(source, tgt_text, dec_input_tokens, self.seq_len, self.sos_id, self.eos_id, self.pad_id,
+                              self.pad_to_seq_len)
 
-        # Add only </s> token
-        label = torch.cat(
-            [
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
-                self.eos_token,
-                torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
-            ],
-            dim=0,
-        )
 
-        # Double check the size of the tensors to make sure they are all seq_len long
-        # assert encoder_input.size(0) == self.seq_len
-        assert decoder_input.size(0) == self.seq_len
-        assert label.size(0) == self.seq_len
+def caption_sample(source, tgt_text, dec_input_tokens, seq_len, sos_id, eos_id, pad_id, pad_to_seq_len: bool = True):
+    # training sample of an image (source: {'encoder_input': ...} or {'encoder_output': ...}) and its caption
+    # tokens, shared by BilingualDataset and ShardedCaptionDataset
+    num_tokens = dec_input_tokens.size(0)
+
+    # Add sos, eos and padding to each sentence
+    # We will only add <s>, and </s> only on the label
+    dec_num_padding_tokens = seq_len - num_tokens - 1
+
+    # Make sure the number of padding tokens is not negative. If it is, the sentence is too long
+    if dec_num_padding_tokens < 0:
+        raise ValueError("Sentence is too long")
+
+    if not pad_to_seq_len:
         return {
-            'encoder_input': enc_input['pixel_values'][0],
-            'decoder_input': decoder_input,
-            "encoder_mask": (torch.cat((torch.ones(197,),torch.zeros(60),),)).unsqueeze(0).unsqueeze(0), # (1, 1, seq_len)
-            "decoder_mask": (decoder_input != self.pad_token).unsqueeze(0).int() & causal_mask(decoder_input.size(0)), # (1, seq_len) & (1, seq_len, seq_len),
-            "label": label,  # (seq_len)
-             
-            # "src_text": src_text,
+            **source,
+            'decoder_input': torch.cat([torch.tensor([sos_id], dtype=torch.int64), dec_input_tokens]),  # (num_tokens + 1)
+            "label": torch.cat([dec_input_tokens, torch.tensor([eos_id], dtype=torch.int64)]),  # (num_tokens + 1)
             "tgt_text": tgt_text,
         }
 
-   
-    
+    # Add only <s> token, the rest of the sequence is [PAD]
+    decoder_input = torch.full((seq_len,), pad_id, dtype=torch.int64)
+    decoder_input[0] = sos_id
+    decoder_input[1:num_tokens + 1] = dec_input_tokens
+
+    # Add only </s> token
+    label = torch.full((seq_len,), pad_id, dtype=torch.int64)
+    label[:num_tokens] = dec_input_tokens
+    label[num_tokens] = eos_id
+
+    # Double check the size of the tensors to make sure they are all seq_len long
+    assert decoder_input.size(0) == seq_len
+    assert label.size(0) == seq_len
+    return {
+        **source,
+        'decoder_input': decoder_input,
+        # no masks here, the model derives the causal/padding mask from decoder_input
+        "label": label,  # (seq_len)
+        "tgt_text": tgt_text,
+    }
+
+
 def causal_mask(size):
     mask = torch.triu(torch.ones((1, size, size)), diagonal=1).type(torch.int)
     return mask == 0
-        
\ No newline at end of file
+
+
+def collate_batch(batch, pad_id):
+    # Pads decoder_input and label only up to the longest caption of the batch
+    length = max(item['decoder_input'].size(0) for item in batch)
+    decoder_input = torch.full((len(batch), length), pad_id, dtype=torch.int64)
+    label = torch.full((len(batch), length), pad_id, dtype=torch.int64)
+    for i, item in enumerate(batch):
+        decoder_input[i, :item['decoder_input'].size(0)] = item['decoder_input']
+        label[i, :item['label'].size(0)] = item['label']
+
+    collated = {
+        'decoder_input': decoder_input,  # (B, length)
+        'label': label,  # (B, length)
+    }
+    for key, value in batch[0].items():
+        if key not in collated:
+            values = [item[key] for item in batch]
+            collated[key] = torch.stack(values) if isinstance(value, torch.Tensor) else values
+    return collated
+
+
+def get_collate_fn(pad_id):
+    return partial(collate_batch, pad_id=pad_id)
+
+
+class BucketBatchSampler(Sampler):
+    # Groups captions of similar length into the same batch so dynamic padding has little to pad.
+    # Indices are shuffled, cut into buckets of batch_size * bucket_size_multiplier samples,
+    # sorted by length inside each bucket and split into batches, then the batches are shuffled.
+    # With num_replicas > 1 every process takes every num_replicas-th batch, starting at rank
+    def __init__(self, lengths, batch_size: int, shuffle: bool = True, bucket_size_multiplier: int = 100,
+                 drop_last: bool = False, seed: int = 0, num_replicas: int = 1, rank: int = 0):
+        self.lengths = torch.as_tensor(np.asarray(lengths), dtype=torch.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch: int) -> None:
+        # every epoch gets its own, reproducible order
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        n = len(self.lengths)
+        indices = torch.randperm(n, generator=generator) if self.shuffle else torch.arange(n)
+
+        batches = []
+        for bucket in indices.split(self.bucket_size):
+            bucket = bucket[torch.argsort(self.lengths[bucket], stable=True)]
+            for batch in bucket.split(self.batch_size):
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        if self.num_replicas > 1:
+            # every process needs the same number of batches, so the list is cut (drop_last)
+            # or padded with batches from the start before it is split between the processes
+            total = len(self) * self.num_replicas
+            batches = (batches * (total // max(len(batches), 1) + 1))[:total]
+            batches = batches[self.rank::self.num_replicas]
+        return iter(batches)
+
+    def _num_batches(self):
+        # every bucket ends with its own partial batch
+        n = len(self.lengths)
+        full_buckets, last_bucket = divmod(n, self.bucket_size)
+        if self.drop_last:
+            return full_buckets * (self.bucket_size // self.batch_size) + last_bucket // self.batch_size
+        per_bucket = (self.bucket_size + self.batch_size - 1) // self.batch_size
+        return full_buckets * per_bucket + (last_bucket + self.batch_size - 1) // self.batch_size
+
+    def __len__(self):
+        if self.drop_last:
+            return self._num_batches() // self.num_replicas
+        return (self._num_batches() + self.num_replicas - 1) // self.num_replicas
+        
+
+class ResumableBatchSampler(Sampler):
+    # Wraps a batch sampler with a reproducible per-epoch order (BucketBatchSampler, or a BatchSampler
+    # over a DistributedSampler) so training can resume in the middle of an epoch: skip(k) makes the
+    # next pass start at batch k without loading the first k batches. len() stays the full epoch
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.start = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        sampler = self.batch_sampler if hasattr(self.batch_sampler, 'set_epoch') else self.batch_sampler.sampler
+        sampler.set_epoch(epoch)
+
+    def skip(self, batches: int) -> None:
+        # only applies to the next pass over the data
+        self.start = batches
+
+    def __iter__(self):
+        # a generator, so the skip is only used up by the pass that actually runs (the DataLoader
+        # creates a sampler iterator it never reads from when it starts its workers)
+        start, self.start = self.start, 0
+        yield from islice(iter(self.batch_sampler), start, None)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class SubsetSampler(Sampler):
+    # A random subset of at most max_samples indices (all of them when it is None). The subset only depends
+    # on the seed, so every epoch is evaluated on the same samples. With num_replicas > 1 every process gets
+    # its own part of the subset
+    def __init__(self, num_samples: int, max_samples: int = None, seed: int = 0, num_replicas: int = 1, rank: int = 0):
+        self.num_samples = num_samples
+        self.max_samples = max_samples
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def _subset_size(self):
+        if self.max_samples is None:
+            return self.num_samples
+        return min(self.num_samples, self.max_samples)
+
+    def __iter__(self):
+        if self.max_samples is None:
+            indices = torch.arange(self.num_samples)
+        else:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed)
+            indices = torch.randperm(self.num_samples, generator=generator)[:self._subset_size()]
+        return iter(indices[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return len(range(self.rank, self._subset_size(), self.num_replicas))
+
+
+def image_bytes(image):
+    # encoded file bytes of a dataset image: the {'bytes', 'path'} dict of an undecoded datasets.Image
+    # column is used as it is, a decoded PIL image is encoded again
+    if isinstance(image, dict):
+        if image.get('bytes') is not None:
+            return image['bytes']
+        with open(image['path'], 'rb') as f:
+            return f.read()
+    buffer = io.BytesIO()
+    image.save(buffer, format=image.format or 'PNG')
+    return buffer.getvalue()
+
+
+def write_shards(ds, rows, directory, rows_per_shard: int = 5000, batch_rows: int = 256):
+    # Writes the images (encoded, as they are stored in the dataset) and captions of the rows of ds to
+    # Arrow IPC files <directory>/shard-00000.arrow, ... in the order of rows, in record batches of batch_rows.
+    # index.json lists the shards with their number of rows, it is written last so a partial directory is
+    # never mistaken for a finished one
+    import pyarrow as pa
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    rows = [int(row) for row in rows]
+    schema = pa.schema([('row', pa.int64()), ('image', pa.binary()), ('en_text', pa.string())])
+    shards = []
+    for start in tqdm(range(0, len(rows), rows_per_shard), desc=f'Writing shards to {directory}'):
+        shard_rows = rows[start:start + rows_per_shard]
+        name = f'shard-{len(shards):05d}.arrow'
+        with pa.OSFile(str(directory / name), 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+            for i in range(0, len(shard_rows), batch_rows):
+                batch = shard_rows[i:i + batch_rows]
+                columns = ds[batch]
+                writer.write_batch(pa.record_batch([
+                    pa.array(batch, pa.int64()),
+                    pa.array([image_bytes(image) for image in columns['image']], pa.binary()),
+                    pa.array(columns['en_text'], pa.string()),
+                ], schema=schema))
+        shards.append({'file': name, 'rows': len(shard_rows)})
+    with open(directory / 'index.json', 'w') as f:
+        json.dump({'rows': len(rows), 'shards': shards}, f)
+
+
+class ShardedCaptionDataset(IterableDataset):
+    # Streams the (image, caption) samples of a directory written by write_shards. The shards are memory-mapped
+    # and read sequentially one record batch at a time, so the directory can be larger than RAM, and the
+    # samples are drawn at random from a buffer of shuffle_buffer records (only the drawn ones are decoded).
+    # Every epoch (set_epoch) shuffles the shard order, the rows in that order are then cut into one contiguous
+    # range per reader (a DataLoader worker of a rank), using the shard sizes of index.json. The ranges differ by
+    # at most one row whatever the shard sizes are, and a reader only opens the shards its range overlaps.
+    # With batch_size set every worker of every rank yields the same number of whole batches (the few rows
+    # beyond that are dropped for the epoch, len() is exact) and skip(k) resumes the next pass at batch k like
+    # ResumableBatchSampler. Otherwise every row is yielded once, max_samples caps the samples of a pass, e.g.
+    # for validation
+    def __init__(self, directory, tokenizer_tgt, seq_len, image_processor=None, pad_to_seq_len: bool = True,
+                 shuffle_buffer: int = 1000, shuffle: bool = True, seed: int = 0, num_replicas: int = 1, rank: int = 0,
+                 batch_size: int = None, num_workers: int = 0, max_samples: int = None):
+        super().__init__()
+        self.directory = Path(directory)
+        with open(self.directory / 'index.json') as f:
+            index = json.load(f)
+        self.shards = index['shards']
+        self.num_rows = index['rows']
+        self.tokenizer_tgt = tokenizer_tgt
+        self.seq_len = seq_len
+        self.image_processor = image_processor if image_processor is not None else get_image_processor()
+        self.pad_to_seq_len = pad_to_seq_len
+        self.shuffle_buffer = shuffle_buffer if shuffle else 0
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.batch_size = batch_size
+        # the number of DataLoader workers has to be known up front for the per-worker quota of whole batches
+        self.num_workers = max(num_workers, 1)
+        self.max_samples = max_samples
+        self.start = 0
+        if batch_size is not None and self._worker_samples() == 0:
+            raise ValueError(f'{self.directory} has too few rows for {num_replicas * self.num_workers} readers with batch size {batch_size}')
+
+        self.sos_id = tokenizer_tgt.token_to_id("[SOS]")
+        self.eos_id = tokenizer_tgt.token_to_id("[EOS]")
+        self.pad_id = tokenizer_tgt.token_to_id("[PAD]")
+
+    @staticmethod
+    def exists(directory) -> bool:
+        return (Path(directory) / 'index.json').exists()
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def skip(self, batches: int) -> None:
+        # only applies to the next pass over the data
+        assert self.batch_size is not None, 'skipping needs the batch_size of the DataLoader'
+        self.start = batches
+
+    def _samples(self):
+        return self.num_rows if self.max_samples is None else min(self.num_rows, self.max_samples)
+
+    def _readers(self):
+        return self.num_replicas * self.num_workers
+
+    def _reader_range(self, reader: int):
+        # [start, stop) of the rows of reader in the shard order of the epoch
+        readers = self._readers()
+        return reader * self.num_rows // readers, (reader + 1) * self.num_rows // readers
+
+    def _worker_samples(self, reader: int = 0):
+        # samples one reader yields in one pass, never more than the rows of its range
+        if self.batch_size is not None:
+            # at most num_rows // readers, the size of the smallest range
+            per_rank = self.num_rows // self.num_replicas
+            return per_rank // (self.batch_size * self.num_workers) * self.batch_size
+        start, stop = self._reader_range(reader)
+        samples, readers = self._samples(), self._readers()
+        return min(stop - start, (reader + 1) * samples // readers - reader * samples // readers)
+
+    def __len__(self):
+        readers = range(self.rank * self.num_workers, (self.rank + 1) * self.num_workers)
+        return sum(self._worker_samples(reader) for reader in readers)
+
+    def _records(self, shards, start, stop):
+        # (image bytes, caption) of the rows [start, stop) of the shards in order
+        import pyarrow as pa
+
+        offset = 0
+        for shard in shards:
+            shard_start, offset = offset, offset + shard['rows']
+            if offset <= start or shard_start >= stop:
+                continue
+            with pa.memory_map(str(self.directory / shard['file'])) as source:
+                file = pa.ipc.open_file(source)
+                row = shard_start
+                for b in range(file.num_record_batches):
+                    batch = file.get_batch(b)
+                    first, row = row, row + batch.num_rows
+                    if row <= start or first >= stop:
+                        continue
+                    images, texts = batch.column('image'), batch.column('en_text')
+                    for j in range(max(start - first, 0), min(stop, row) - first):
+                        yield images[j].as_py(), texts[j].as_py()
+
+    def _shuffled(self, records, rng):
+        # bounded shuffle: every record replaces a random one of the buffer, which is yielded
+        if not self.shuffle_buffer:
+            yield from records
+            return
+        buffer = []
+        for record in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = record
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _sample(self, record):
+        data, tgt_text = record
+        source = {'encoder_input': self.image_processor(Image.open(io.BytesIO(data)))}
+        dec_input_tokens = torch.tensor(self.tokenizer_tgt.encode(tgt_text).ids, dtype=torch.int64)
+        return caption_sample(source, tgt_text, dec_input_tokens, self.seq_len, self.sos_id, self.eos_id, self.pad_id,
+                              self.pad_to_seq_len)
+
+    def __iter__(self):
+        info = get_worker_info()
+        workers, worker = (info.num_workers, info.id) if info is not None else (1, 0)
+        assert workers == self.num_workers, \
+            f'the dataset was set up for {self.num_workers} workers, the DataLoader has {workers}'
+        # batch k of the epoch comes from worker k % workers, but the DataLoader takes the first batch of
+        # every pass from worker 0. After skip(start) worker w takes over the batches of worker
+        # (start + w) % workers, so the rest of the epoch has the same batches in the same order as without
+        # the interruption. The skipped batches are drawn from the buffer but not decoded
+        start, self.start = self.start, 0
+        reader = self.rank * workers + (start + worker) % workers
+
+        # the shard order only depends on seed and epoch, so all readers split the same order
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        rng = random.Random(f'{self.seed}-{self.epoch}-{reader}')
+        records = self._shuffled(self._records(shards, *self._reader_range(reader)), rng)
+        records = islice(records, self._worker_samples(reader))
+        if start:
+            records = islice(records, (start + worker) // workers * self.batch_size, None)
+        for record in records:
+            yield self._sample(record)
@@ -0,0 +1,111 @@
+## Multi-process data-parallel training on CPU nodes.
+## Launch with torchrun, e.g. on one machine with 2 processes:
+##     torchrun --standalone --nproc_per_node=2 train.py
+## or on 2 machines (run on both, with node_rank 0 and 1):
+##     torchrun --nnodes=2 --nproc_per_node=4 --node_rank=0 --master_addr=<host of rank 0> --master_port=29500 train.py
+## Without the torchrun environment everything falls back to a single process.
+
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def setup_distributed(config):
+    # Joins the process group when the script was started by torchrun (RANK/WORLD_SIZE are set).
+    # Returns (rank, local_rank, world_size), (0, 0, 1) for a normal single process run
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        return 0, 0, 1
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    world_size = int(os.environ['WORLD_SIZE'])
+    if not dist.is_initialized():
+        dist.init_process_group(backend=config['dist_backend'])
+
+    # torchrun sets OMP_NUM_THREADS=1 for every process, on a CPU box the cores are split
+    # between the local processes instead
+    threads = config['threads_per_process']
+    if threads is None:
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(threads)
+    return rank, local_rank, world_size
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    # only rank 0 writes to wandb/TensorBoard and saves checkpoints
+    return get_rank() == 0
+
+
+def barrier() -> None:
+    if is_distributed():
+        dist.barrier()
+
+
+def wrap_model(model, config):
+    # DistributedDataParallel all-reduces the gradients in buckets of ddp_bucket_mb while backward is
+    # still running, so the communication of the later layers overlaps with the backward of the earlier ones.
+    # Some parameters never get a gradient (e.g. the unused LayerNorms and patch_embeddings.cls_token),
+    # find_unused_parameters lets DDP mark them as ready instead of waiting for them forever
+    if not is_distributed():
+        return model
+    return DistributedDataParallel(model, bucket_cap_mb=config['ddp_bucket_mb'],
+                                   gradient_as_bucket_view=True, find_unused_parameters=True)
+
+
+def unwrap_model(model):
+    # the plain Transformer, for encode/decode/project and for state_dicts without the 'module.' prefix
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def no_sync(model, sync: bool):
+    # skips the gradient all-reduce on the micro-batches before the last one of an accumulation step,
+    # the gradients are only summed locally and all-reduced together with the last micro-batch
+    if sync or not isinstance(model, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def all_reduce_mean(tensor):
+    # mean over all processes, a no-op in a single process run
+    if not is_distributed():
+        return tensor
+    tensor = tensor.clone()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor / get_world_size()
+
+
+def all_reduce_sum(tensor):
+    if not is_distributed():
+        return tensor
+    tensor = tensor.clone()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def all_gather_objects(items):
+    # concatenation of the lists of all processes, in rank order
+    if not is_distributed():
+        return list(items)
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, list(items))
+    return [item for part in gathered for item in part]
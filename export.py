@@ -0,0 +1,206 @@
+## Inference export of the captioning model. The image encoder and one decode step with a static KV cache
+## are traced with TorchScript and driven by a scripted greedy loop, everything is saved in one file
+## together with the tokenizer:
+##     python export.py weights/tmodel_05.pt captioner.pt
+## A serving process only needs torch (and tokenizers to turn the ids into text):
+##     captioner, tokenizer_json = load_captioner('captioner.pt')
+##     tokens, lengths = captioner(pixel_values)  # (n, max_len) ids starting with [SOS], valid up to lengths
+
+import argparse
+import warnings
+
+import torch
+import torch.nn as nn
+
+
+class EncodeStep(nn.Module):
+    # pixel_values (n, 3, img_size, img_size) -> cross-attention keys and values of every decoder block,
+    # each stacked to (blocks, n, patches, d_model). The encoder output itself is not needed after that
+    def __init__(self, model):
+        super(EncodeStep, self).__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        encoder_output = self.model.encode(pixel_values, None)
+        kv = self.model.cross_kv(encoder_output)
+        return torch.stack([key for key, _ in kv]), torch.stack([value for _, value in kv])
+
+
+class DecodeStep(nn.Module):
+    # One decode step for a batch of captions with a static KV cache. The self-attention keys/values live in
+    # (blocks, n, max_len, d_model) tensors that are written in place at positions (one position per row, so
+    # rows can be at different steps) and the attention is masked to the positions written so far.
+    # Every step has the same shapes, so the step is traced once and replayed.
+    # Same computation as Transformer.decode with a cache in eval mode, dropout is left out
+    def __init__(self, model):
+        super(DecodeStep, self).__init__()
+        self.model = model
+
+    def forward(self, tokens, positions, self_k, self_v, cross_k, cross_v):
+        # tokens, positions: (n,) -> log-probs of the next token (n, vocab_size)
+        model = self.model
+        x = model.target_embedding(tokens.unsqueeze(1))
+        x = x + model.positional_encoding.positional_encoding[0, positions].unsqueeze(1)  # (n, 1, d_model)
+
+        index = positions.view(-1, 1, 1).expand(-1, 1, x.size(-1))
+        steps = torch.arange(self_k.size(2), device=positions.device)
+        mask = (steps.unsqueeze(0) <= positions.unsqueeze(1)).unsqueeze(1).unsqueeze(1)  # (n, 1, 1, max_len)
+        for i, block in enumerate(model.decoder.decoders):
+            norm = block.layer_norm1(x)
+            key, value = block.multiheadattention.project_kv(norm, norm)
+            self_k[i].scatter_(1, index, key)
+            self_v[i].scatter_(1, index, value)
+            x = x + block.multiheadattention(norm, None, None, mask, kv=(self_k[i], self_v[i]))
+            # the cross-attention is queried with the self-attention input, like DecoderBlock.forward
+            x = x + block.crossattention(norm, None, None, None, kv=(cross_k[i], cross_v[i]))
+            x = x + block.feedforward(block.layer_norm3(x))
+        return model.project_last(model.decoder.norm(x))
+
+
+class GreedyCaptioner(nn.Module):
+    # Fixed greedy generation loop over EncodeStep/DecodeStep, written so it can be compiled with
+    # torch.jit.script. Unlike generate.batch_greedy_decode the batch never shrinks, finished rows keep
+    # running with [PAD] so every step has the same shapes. Returns the (n, max_len) token ids starting
+    # with [SOS] and the length of every caption including [EOS]
+    def __init__(self, encode_step, decode_step, blocks: int, d_model: int, max_len: int, sos_idx: int, eos_idx: int,
+                 pad_idx: int):
+        super(GreedyCaptioner, self).__init__()
+        self.encode_step = encode_step
+        self.decode_step = decode_step
+        self.blocks = blocks
+        self.d_model = d_model
+        self.max_len = max_len
+        self.sos_idx = sos_idx
+        self.eos_idx = eos_idx
+        self.pad_idx = pad_idx
+
+    def forward(self, pixel_values):
+        cross_k, cross_v = self.encode_step(pixel_values)
+        n = pixel_values.size(0)
+        device = pixel_values.device
+        self_k = torch.zeros([self.blocks, n, self.max_len, self.d_model], dtype=cross_k.dtype, device=device)
+        self_v = torch.zeros_like(self_k)
+
+        output = torch.full([n, self.max_len], self.pad_idx, dtype=torch.long, device=device)
+        output[:, 0] = self.sos_idx
+        lengths = torch.full([n], self.max_len, dtype=torch.long, device=device)
+        finished = torch.zeros([n], dtype=torch.bool, device=device)
+        tokens = output[:, 0]
+        for step in range(1, self.max_len):
+            positions = torch.full([n], step - 1, dtype=torch.long, device=device)
+            log_probs = self.decode_step(tokens, positions, self_k, self_v, cross_k, cross_v)
+            tokens = log_probs.argmax(dim=1).masked_fill(finished, self.pad_idx)
+            output[:, step] = tokens
+            ended = (tokens == self.eos_idx) & ~finished
+            lengths = torch.where(ended, torch.full_like(lengths, step + 1), lengths)
+            finished = finished | ended
+            if bool(finished.all()):
+                break
+        return output, lengths
+
+
+def build_captioner(model, max_len: int, sos_idx: int, eos_idx: int, pad_idx: int, backend: str = 'torchscript',
+                    example=None):
+    # backend 'eager' runs the static-KV loop as plain python, 'compile' compiles the encode and decode steps
+    # with torch.compile (in-process only, nothing to save), 'torchscript' traces the two steps on example
+    # (a (n, 3, img_size, img_size) batch) and scripts the loop into a module that torch.jit.save can write
+    assert backend in ('eager', 'compile', 'torchscript'), f'unknown export backend {backend}'
+    model = model.eval()
+    blocks = len(model.decoder.decoders)
+    d_model = model.positional_encoding.positional_encoding.size(-1)
+    assert max_len <= model.positional_encoding.positional_encoding.size(1), 'max_len is longer than the positional table'
+    encode_step, decode_step = EncodeStep(model).eval(), DecodeStep(model).eval()
+    if backend == 'compile':
+        encode_step, decode_step = torch.compile(encode_step), torch.compile(decode_step)
+    elif backend == 'torchscript':
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            cross_k, cross_v = encode_step(example)
+            n = example.size(0)
+            self_k = torch.zeros(blocks, n, max_len, d_model, device=example.device)
+            tokens = torch.full((n,), sos_idx, dtype=torch.long, device=example.device)
+            positions = torch.zeros(n, dtype=torch.long, device=example.device)
+            encode_step = torch.jit.trace(encode_step, (example,))
+            decode_step = torch.jit.trace(decode_step, (tokens, positions, self_k, self_k.clone(), cross_k, cross_v))
+    captioner = GreedyCaptioner(encode_step, decode_step, blocks, d_model, max_len, sos_idx, eos_idx, pad_idx).eval()
+    if backend == 'torchscript':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            captioner = torch.jit.script(captioner)
+    return captioner
+
+
+def save_captioner(captioner, path, tokenizer_json: str = '') -> None:
+    # the tokenizer is stored inside the TorchScript file, so the file is all a serving process needs
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        torch.jit.save(captioner, path, _extra_files={'tokenizer.json': tokenizer_json})
+
+
+def load_captioner(path, map_location='cpu'):
+    # -> (captioner, tokenizer json string), tokenizers.Tokenizer.from_str turns the latter into a tokenizer
+    extra_files = {'tokenizer.json': ''}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        captioner = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    tokenizer_json = extra_files['tokenizer.json']
+    if isinstance(tokenizer_json, bytes):
+        tokenizer_json = tokenizer_json.decode()
+    return captioner.eval(), tokenizer_json
+
+
+def captioner_outputs(tokens, lengths):
+    # (n, max_len) ids and lengths of a captioner -> list of n token tensors like generate.batch_greedy_decode,
+    # generate.decode_captions turns them into text
+    return [row[:length] for row, length in zip(tokens, lengths.tolist())]
+
+
+def load_checkpoint_model(checkpoint, config, tokenizer_tgt):
+    # eval-mode Transformer of config with the weights of a tmodel_XX.pt checkpoint, without train.py
+    from model import build_transformer, load_model_state
+
+    model = build_transformer(config['seq_len'], config['batch_size'], tokenizer_tgt.get_vocab_size(), config['d_model'],
+                              attention_backend=config['attention_backend'], fused_qkv=config['fused_qkv'],
+                              pad_idx=tokenizer_tgt.token_to_id("[PAD]"), img_size=config['image_size'])
+    state = torch.load(checkpoint, map_location='cpu')
+    load_model_state(model, state['model_state_dict'])
+    return model.eval()
+
+
+def export_checkpoint(checkpoint, path, max_len: int = None, check: bool = True):
+    # builds the model of get_config() with the weights of a tmodel_XX.pt checkpoint and writes the
+    # TorchScript captioner. check compares its captions with generate.batch_greedy_decode on random images
+    from tokenizers import Tokenizer
+    from config import get_config
+
+    config = get_config()
+    tokenizer_tgt = Tokenizer.from_file(config['tokenizer_file'])
+    pad_idx = tokenizer_tgt.token_to_id("[PAD]")
+    model = load_checkpoint_model(checkpoint, config, tokenizer_tgt)
+
+    max_len = max_len or config['seq_len']
+    sos_idx, eos_idx = tokenizer_tgt.token_to_id("[SOS]"), tokenizer_tgt.token_to_id("[EOS]")
+    example = torch.randn(2, 3, config['image_size'], config['image_size'])
+    captioner = build_captioner(model, max_len, sos_idx, eos_idx, pad_idx, 'torchscript', example)
+    save_captioner(captioner, path, tokenizer_tgt.to_str())
+
+    if check:
+        from generate import batch_greedy_decode
+        captioner, _ = load_captioner(path)
+        images = torch.randn(3, 3, config['image_size'], config['image_size'])
+        with torch.no_grad():
+            tokens, lengths = captioner(images)
+            expected = batch_greedy_decode(model, images, tokenizer_tgt, max_len, 'cpu')
+        for output, reference in zip(captioner_outputs(tokens, lengths), expected):
+            assert torch.equal(output, reference), 'exported captioner does not match the eager model'
+        print(f'{path}: captions match the eager model')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a checkpoint as a TorchScript greedy captioner')
+    parser.add_argument('checkpoint')
+    parser.add_argument('path')
+    parser.add_argument('--max-len', type=int, default=None, help='longest caption including [SOS], defaults to seq_len')
+    parser.add_argument('--no-check', action='store_true', help='skip the comparison with the eager model')
+    args = parser.parse_args()
+    export_checkpoint(args.checkpoint, args.path, args.max_len, check=not args.no_check)
@@ -0,0 +1,134 @@
+## Batched caption generation, greedy and beam search, on top of the decoder cache of Transformer
+
+import torch
+
+
+def batch_greedy_decode(model, source, tokenizer_tgt, max_len, device, encoder_output=None):
+    # source: (n, 3, img_size, img_size) -> list of n token tensors starting with [SOS].
+    # An encoder_output that was already computed for the images can be passed instead of source
+    sos_idx = tokenizer_tgt.token_to_id("[SOS]")
+    eos_idx = tokenizer_tgt.token_to_id("[EOS]")
+    pad_idx = tokenizer_tgt.token_to_id("[PAD]")
+
+    if encoder_output is None:
+        encoder_output = model.encode(source, None)
+    n = encoder_output.size(0)
+    cache = model.init_cache(encoder_output)
+
+    # the tokens stay on the device, rows are only read back once decoding is done
+    output = torch.full((n, max_len), pad_idx, dtype=torch.long, device=device)
+    output[:, 0] = sos_idx
+    lengths = torch.full((n,), max_len, dtype=torch.long, device=device)
+    # rows of output that are still being decoded, finished rows are dropped from the batch
+    active = torch.arange(n, device=device)
+    next_input = output[:, :1]
+
+    for step in range(1, max_len):
+        out = model.decode(next_input, None, None, None, cache)
+        prob = model.project_last(out)
+        _, next_word = torch.max(prob, dim=1)
+        output[active, step] = next_word
+
+        finished = next_word == eos_idx
+        # the only host sync of the step, needed to know whether rows can be dropped
+        if finished.any():
+            lengths[active[finished]] = step + 1
+            keep = (~finished).nonzero().squeeze(1)
+            if keep.numel() == 0:
+                break
+            active = active[keep]
+            next_word = next_word[keep]
+            cache = model.reorder_cache(cache, keep)
+        next_input = next_word.unsqueeze(1)
+
+    lengths = lengths.tolist()
+    return [output[i, :lengths[i]] for i in range(n)]
+
+
+def beam_search_decode(model, source, tokenizer_tgt, max_len, device, beam_size: int = 4, length_penalty: float = 0.6):
+    # source: (n, 3, img_size, img_size) -> list of n token tensors starting with [SOS]
+    # The finished hypotheses are ranked with the GNMT length penalty ((5 + len) / 6) ** length_penalty
+    sos_idx = tokenizer_tgt.token_to_id("[SOS]")
+    eos_idx = tokenizer_tgt.token_to_id("[EOS]")
+    pad_idx = tokenizer_tgt.token_to_id("[PAD]")
+    n, k = source.size(0), beam_size
+
+    encoder_output = model.encode(source, None)
+    # project the cross-attention keys/values once per image and repeat them for every beam
+    cache = model.init_cache(encoder_output)
+    cache = model.reorder_cache(cache, torch.arange(n, device=device).repeat_interleave(k))
+
+    tokens = torch.full((n * k, max_len), pad_idx, dtype=torch.long, device=device)
+    tokens[:, 0] = sos_idx
+    # only the first beam is alive at the start, otherwise every beam would pick the same words
+    scores = torch.full((n, k), float('-inf'), device=device)
+    scores[:, 0] = 0.0
+    finished = torch.zeros((n, k), dtype=torch.bool, device=device)
+    lengths = torch.ones((n, k), dtype=torch.long, device=device)
+    # images that still have unfinished beams
+    active = torch.arange(n, device=device)
+    results = [None] * n
+
+    next_input = tokens[:, :1]
+    for step in range(1, max_len):
+        m = active.size(0)
+        out = model.decode(next_input, None, None, None, cache)
+        log_probs = model.project_last(out).float().view(m, k, -1)
+        vocab_size = log_probs.size(-1)
+
+        # finished beams can only be extended with [PAD], which does not change their score
+        log_probs = log_probs.masked_fill(finished.unsqueeze(-1), float('-inf'))
+        log_probs[:, :, pad_idx] = log_probs[:, :, pad_idx].masked_fill(finished, 0.0)
+
+        candidates = (scores.unsqueeze(-1) + log_probs).view(m, -1)
+        scores, top = candidates.topk(k, dim=1)
+        beam = torch.div(top, vocab_size, rounding_mode='floor')
+        word = top % vocab_size
+
+        rows = (torch.arange(m, device=device) * k).unsqueeze(1) + beam  # (m, k)
+        tokens = tokens.index_select(0, rows.view(-1))
+        tokens[:, step] = word.view(-1)
+        was_finished = finished.gather(1, beam)
+        finished = was_finished | (word == eos_idx)
+        lengths = torch.where(was_finished, lengths.gather(1, beam), torch.full_like(lengths, step + 1))
+        cache = model.reorder_cache(cache, rows.view(-1), cross=False)
+
+        done = finished.all(dim=1)
+        # the only host sync of the step, needed to know whether images can be dropped
+        if done.any():
+            for i in done.nonzero().squeeze(1).tolist():
+                results[active[i].item()] = _best_beam(tokens, scores, lengths, i, k, length_penalty)
+            rows_idx = torch.arange(m * k, device=device).view(m, k)
+            keep = (~done).nonzero().squeeze(1)
+            if keep.numel() == 0:
+                break
+            keep_rows = rows_idx[keep].view(-1)
+            active = active[keep]
+            scores, finished, lengths = scores[keep], finished[keep], lengths[keep]
+            tokens = tokens.index_select(0, keep_rows)
+            cache = model.reorder_cache(cache, keep_rows)
+        next_input = tokens[:, step:step + 1]
+
+    # images that reached max_len with unfinished beams
+    for i, image in enumerate(active.tolist()):
+        if results[image] is None:
+            results[image] = _best_beam(tokens, scores, lengths, i, k, length_penalty)
+    return results
+
+
+def _best_beam(tokens, scores, lengths, i, k, length_penalty):
+    # pick the best hypothesis of the i-th active image, the length excludes [SOS]
+    penalty = ((5.0 + (lengths[i] - 1).float()) / 6.0) ** length_penalty
+    best = int((scores[i] / penalty).argmax())
+    return tokens[i * k + best, :int(lengths[i, best])]
+
+
+def generate(model, source, tokenizer_tgt, max_len, device, beam_size: int = 1, length_penalty: float = 0.6):
+    if beam_size > 1:
+        return beam_search_decode(model, source, tokenizer_tgt, max_len, device, beam_size, length_penalty)
+    return batch_greedy_decode(model, source, tokenizer_tgt, max_len, device)
+
+
+def decode_captions(tokenizer_tgt, tokens):
+    # list of token tensors -> list of strings, decoded by the tokenizer in one call
+    return tokenizer_tgt.decode_batch([t.tolist() for t in tokens])
@@ -0,0 +1,143 @@
+## Training metrics that stay on the device between flushes, so a training step never waits on .item()
+
+import bisect
+import collections
+import queue
+import threading
+
+import torch
+
+
+class MetricsLogger:
+    # add() sums the detached values on the device, every flush_every steps the means over the
+    # window are read back with a single host sync and written to TensorBoard and wandb.
+    # With background=True the writes happen on a separate thread. reduce_fn combines the window
+    # means of all processes in a distributed run, every process has to flush at the same steps
+    def __init__(self, writer=None, log_fn=None, flush_every: int = 50, background: bool = False, names=None, reduce_fn=None):
+        self.writer = writer  # TensorBoard SummaryWriter
+        self.log_fn = log_fn  # e.g. wandb.log
+        self.flush_every = max(1, flush_every)
+        self.names = names or {}  # TensorBoard tag -> name used for log_fn
+        self.reduce_fn = reduce_fn
+        self.last = {}  # means of the last flushed window
+        self._sums = {}
+        self._counts = {}
+        self._steps = 0
+
+        self._queue = None
+        if background:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def add(self, name, value):
+        value = value.detach().float()
+        if name in self._sums:
+            self._sums[name] += value
+            self._counts[name] += 1
+        else:
+            self._sums[name] = value.clone()
+            self._counts[name] = 1
+
+    def step(self, global_step) -> bool:
+        # call once per optimizer step, returns True when the metrics were flushed
+        self._steps += 1
+        if self._steps < self.flush_every:
+            return False
+        self.flush(global_step)
+        return True
+
+    def flush(self, global_step):
+        self._steps = 0
+        if not self._sums:
+            return
+        names = list(self._sums)
+        values = torch.stack([self._sums[name] / self._counts[name] for name in names])
+        if self.reduce_fn is not None:
+            values = self.reduce_fn(values)
+        values = values.tolist()
+        self._sums, self._counts = {}, {}
+        self.last = dict(zip(names, values))
+        if self._queue is not None:
+            self._queue.put((global_step, self.last))
+        else:
+            self._write(global_step, self.last)
+
+    def close(self, global_step=None):
+        if global_step is not None:
+            self.flush(global_step)
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+
+    def _write(self, global_step, scalars):
+        if self.writer is not None:
+            for name, value in scalars.items():
+                self.writer.add_scalar(name, value, global_step)
+            self.writer.flush()
+        if self.log_fn is not None:
+            self.log_fn({**{self.names.get(name, name): value for name, value in scalars.items()}, "Global Step": global_step})
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._write(*item)
+
+
+def grad_norm(parameters):
+    # total L2 norm of the gradients as a device tensor
+    parameters = list(parameters)
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if not grads:
+        # on the device of the parameters like the norm itself, the metrics are accumulated there
+        return torch.zeros((), device=parameters[0].device if parameters else None)
+    return torch.linalg.vector_norm(torch.stack([torch.linalg.vector_norm(g) for g in grads]))
+
+
+def layer_grad_means(named_parameters):
+    # mean absolute gradient of every weight (biases are skipped) as one device tensor
+    layers, means, device = [], [], None
+    for n, p in named_parameters:
+        device = p.device
+        if(p.requires_grad) and ("bias" not in n) and p.grad is not None:
+            layers.append(n)
+            means.append(p.grad.abs().mean())
+    return layers, torch.stack(means) if means else torch.zeros(0, device=device)
+
+
+class LatencyHistogram:
+    # Latencies in milliseconds: the number of samples per bucket (upper bounds in ms)
+    # plus the last `window` samples for the percentiles
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+    def __init__(self, buckets=BUCKETS_MS, window: int = 10000):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one counts the samples above every bound
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, ms: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.samples.append(ms)
+        self.count += 1
+        self.total += ms
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / max(self.count, 1),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {**{f'le_{bound}': n for bound, n in zip(self.buckets, self.counts)}, 'inf': self.counts[-1]},
+        }
@@ -1,12 +1,29 @@
 
 ##Implementation of tranformer from scratch, this implememtation was inspired by Umar Jamir
 
+import hashlib
 import torch
 import torch.nn as nn
 import math
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 #  device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+PRECISIONS = ('fp32', 'bf16')
+
+def precision_context(device, precision: str = 'fp32'):
+    # bf16 runs the matmuls under torch.autocast, the weights themselves stay in fp32,
+    # so checkpoints are the same in both precisions
+    assert precision in PRECISIONS, f'unknown precision {precision}'
+    device_type = device.type if isinstance(device, torch.device) else torch.device(device).type
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+class LayerNorm(nn.LayerNorm):
+    # nn.LayerNorm that always normalizes in fp32, CPU autocast would run it in bfloat16 otherwise
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return super().forward(x.float())
+
 class InputEmbeddings(nn.Module):
     def __init__(self, d_model: int, vocab_size: int) -> None:
         super(InputEmbeddings, self).__init__()
@@ -52,9 +69,10 @@ class PositionEncoding(nn.Module):
         positional_encoding = positional_encoding.unsqueeze(0)
         self.register_buffer('positional_encoding', positional_encoding)
     
-    def forward(self, x):  
-         x = x + (self.positional_encoding[:, :x.shape[1], :]).requires_grad_(False) # (batch, seq_len, d_model)
-         return self.dropout(x)
+    def forward(self, x, start: int = 0, dropout: bool = True):  
+         # start is the position of the first token in x, non zero when decoding incrementally
+         x = x + (self.positional_encoding[:, start:start + x.shape[1], :]).requires_grad_(False) # (batch, seq_len, d_model)
+         return self.dropout(x) if dropout else x
 
 ## code from @jankrepl on github
 class PatchEmbed(nn.Module):
@@ -126,23 +144,55 @@ class PatchEmbed(nn.Module):
         # x = x + self.pos_embed  # Learnable pos embed -> (n_samples, n_patches_embed_dim) 
     
         return x
+
+ATTENTION_BACKENDS = ('auto', 'sdpa', 'math')
+# torch.nn.functional.scaled_dot_product_attention was added in torch 2.0
+HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
+def prepare_mask(mask):
+    # Masks can be given in boolean form (a bool or integer tensor, True/non zero = attend) or in additive
+    # form (a float tensor added to the scores, 0 = attend, negative/-inf = masked). The form only depends
+    # on the dtype, so an all-zero additive mask attends everywhere and nothing is read back from the device
+    if mask is None or mask.dtype == torch.bool or mask.is_floating_point():
+        return mask
+    return mask != 0
+
 class MultiHeadAttention(nn.Module):
-    def __init__(self, d_model:int, heads: int) -> None:
+    def __init__(self, d_model:int, heads: int, backend: str = 'auto', fused: str = None) -> None:
         super(MultiHeadAttention,self).__init__()
         self.head = heads
         self.head_dim = d_model // heads
+        self.d_model = d_model
+        self.set_backend(backend)
         
 
 
         assert d_model % heads == 0, 'cannot divide d_model by heads'
 
         ## initialize the query, key and value weights 512*512
-        self.query_weight = nn.Linear(d_model, d_model, bias=False)
-        self.key_weight = nn.Linear(d_model, d_model,bias=False)
-        self.value_weight = nn.Linear(d_model, d_model,bias=False)
+        # fused='qkv' packs the three projections of self-attention into one GEMM,
+        # fused='kv' packs the key and value projections of cross-attention
+        assert fused in (None, 'qkv', 'kv'), f'unknown fused projection {fused}'
+        self.fused = fused
+        if fused == 'qkv':
+            self.qkv_weight = nn.Linear(d_model, 3 * d_model, bias=False)
+        else:
+            self.query_weight = nn.Linear(d_model, d_model, bias=False)
+        if fused == 'kv':
+            self.kv_weight = nn.Linear(d_model, 2 * d_model, bias=False)
+        elif fused is None:
+            self.key_weight = nn.Linear(d_model, d_model,bias=False)
+            self.value_weight = nn.Linear(d_model, d_model,bias=False)
         self.final_weight  = nn.Linear(d_model, d_model, bias=False)
         self.dropout = nn.Dropout(p=0.1)
 
+    def set_backend(self, backend: str) -> None:
+        # 'sdpa' runs the fused torch kernel, 'math' the explicit implementation below,
+        # 'auto' picks sdpa when the installed torch has it
+        assert backend in ATTENTION_BACKENDS, f'unknown attention backend {backend}'
+        assert backend != 'sdpa' or HAS_SDPA, 'scaled_dot_product_attention needs torch >= 2.0'
+        self.backend = backend
+        self.use_sdpa = HAS_SDPA and backend != 'math'
       
     def self_attention(self,query, key, value, mask,dropout):
         #splitting query, key and value into heads
@@ -150,14 +200,23 @@ class MultiHeadAttention(nn.Module):
         query = query.view(query.shape[0], query.shape[1],self.head,self.head_dim).transpose(2,1)
         key = key.view(key.shape[0], key.shape[1],self.head,self.head_dim).transpose(2,1)
         value = value.view(value.shape[0], value.shape[1],self.head,self.head_dim).transpose(2,1)
+        mask = prepare_mask(mask)
+
+        if self.use_sdpa:
+            # the fused kernel never materializes the (batch, heads, seq_len, seq_len) temporaries
+            dropout_p = dropout.p if dropout is not None and self.training else 0.0
+            attention_scores = F.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=dropout_p)
+            return attention_scores.transpose(2,1).contiguous().view(attention_scores.shape[0], -1, self.head_dim * self.head)
         
         attention = query @ key.transpose(3,2)
         attention = attention / math.sqrt(query.shape[-1])
         # print(f' attention shape {attention.shape}')
         # print(f' mask shape {mask.shape}')
 
-        if mask is not None:
-           attention = attention.masked_fill(mask == 0, -1e9)      
+        if mask is not None and mask.dtype == torch.bool:
+           attention = attention.masked_fill(~mask, -1e9)      
+        elif mask is not None:
+           attention = attention + mask
         attention = torch.softmax(attention, dim=-1)      
         if dropout is not None:
             attention = dropout(attention)
@@ -165,12 +224,39 @@ class MultiHeadAttention(nn.Module):
        
         return attention_scores.transpose(2,1).contiguous().view(attention_scores.shape[0], -1, self.head_dim * self.head)
       
-    def forward(self,query, key, value,mask):
+    def project_kv(self, key, value):
+        # used to project the encoder output once for cross-attention, it does not change while decoding
+        if self.fused is None:
+            return self.key_weight(key), self.value_weight(value)
+        if self.fused == 'kv' and key is value:
+            return self.kv_weight(key).chunk(2, dim=-1)
+        weight = self.qkv_weight.weight[self.d_model:] if self.fused == 'qkv' else self.kv_weight.weight
+        return F.linear(key, weight[:self.d_model]), F.linear(value, weight[self.d_model:])
+
+    def forward(self,query, key, value,mask, cache=None, kv=None):
 
         ## initialize the query, key and value matrices to give us seq_len by 512
-        query = self.query_weight(query)
-        key = self.key_weight(key)
-        value = self.value_weight(value)
+        if self.fused == 'qkv' and kv is None and query is key and key is value:
+            query, key, value = self.qkv_weight(query).chunk(3, dim=-1)
+        else:
+            if self.fused == 'qkv':
+                query = F.linear(query, self.qkv_weight.weight[:self.d_model])
+            else:
+                query = self.query_weight(query)
+            if kv is not None:
+                # keys and values were already projected by project_kv
+                key, value = kv
+            else:
+                key, value = self.project_kv(key, value)
+
+        # when decoding incrementally only the newest tokens are passed in, the keys and values
+        # of the previous steps are kept in the cache and extended here
+        if cache is not None:
+            if 'key' in cache:
+                key = torch.cat([cache['key'], key], dim=1)
+                value = torch.cat([cache['value'], value], dim=1)
+            cache['key'] = key
+            cache['value'] = value
 
         attention = MultiHeadAttention.self_attention(self, query, key, value, mask, self.dropout)
         return self.final_weight(attention) 
@@ -193,17 +279,39 @@ class ProjectionLayer(nn.Module):
         self.fc = nn.Linear(d_model, vocab_size)
     def forward(self, x):
         x = self.fc(x)
-        return torch.log_softmax(x, dim=-1)   
+        # the softmax over the vocabulary is done in fp32 even when the matmul runs in bf16
+        return torch.log_softmax(x.float(), dim=-1)   
+
+    def _chunk_loss(self, x, label, label_smoothing: float):
+        return F.cross_entropy(self.fc(x).float(), label, label_smoothing=label_smoothing, reduction='sum')
+
+    def loss(self, x, label, ignore_index: int, label_smoothing: float = 0.0, chunk_size: int = 1024):
+        # Same value as CrossEntropyLoss(ignore_index, label_smoothing) on forward(x), without ever holding
+        # the (batch, seq_len, vocab_size) output: [PAD] positions are dropped before the projection and
+        # the rest is projected chunk_size positions at a time. In training each chunk is checkpointed,
+        # so its logits are recomputed in backward instead of being kept alive
+        x = x.reshape(-1, x.size(-1))
+        label = label.reshape(-1)
+        keep = (label != ignore_index).nonzero().squeeze(1)
+        x, label = x.index_select(0, keep), label.index_select(0, keep)
+
+        total = torch.zeros((), device=x.device)
+        for x_chunk, label_chunk in zip(x.split(chunk_size), label.split(chunk_size)):
+            if torch.is_grad_enabled() and x_chunk.requires_grad:
+                total = total + checkpoint(self._chunk_loss, x_chunk, label_chunk, label_smoothing, use_reentrant=False)
+            else:
+                total = total + self._chunk_loss(x_chunk, label_chunk, label_smoothing)
+        return total / max(label.numel(), 1)
 
 class EncoderBlock(nn.Module):
-    def __init__(self, d_model:int, head:int, d_ff:int) -> None:
+    def __init__(self, d_model:int, head:int, d_ff:int, fused_qkv: bool = False) -> None:
         super(EncoderBlock, self).__init__()    
-        self.multiheadattention = MultiHeadAttention(d_model,head)
-        self.layer_norm1 = nn.LayerNorm(d_model)
+        self.multiheadattention = MultiHeadAttention(d_model,head, fused='qkv' if fused_qkv else None)
+        self.layer_norm1 = LayerNorm(d_model)
         self.dropout1 = nn.Dropout(p=0.3)
         self.feedforward = FeedForward(d_model, d_ff)
-        self.layer_norm2 = nn.LayerNorm(d_model)
-        self.layer_norm3 = nn.LayerNorm(d_model)
+        self.layer_norm2 = LayerNorm(d_model)
+        self.layer_norm3 = LayerNorm(d_model)
         self.dropout2 = nn.Dropout(p=0.3)
 
     def forward(self, x, src_mask):
@@ -218,43 +326,49 @@ class EncoderBlock(nn.Module):
         return x + self.dropout2(ff)     
 
 class Encoder(nn.Module):
-    def __init__(self, number_of_block:int, d_model:int, head:int, d_ff:int) -> None:
+    def __init__(self, number_of_block:int, d_model:int, head:int, d_ff:int, fused_qkv: bool = False) -> None:
         super(Encoder, self).__init__()
-        self.norm = nn.LayerNorm(d_model)
+        self.norm = LayerNorm(d_model)
         
         # Use nn.ModuleList to store the EncoderBlock instances
-        self.encoders = nn.ModuleList([EncoderBlock(d_model, head, d_ff) 
+        self.encoders = nn.ModuleList([EncoderBlock(d_model, head, d_ff, fused_qkv) 
                                        for _ in range(number_of_block)])
+        # recompute the block activations in backward instead of keeping them, see Transformer.set_gradient_checkpointing
+        self.gradient_checkpointing = False
 
     def forward(self, x, src_mask):
         for encoder_block in self.encoders:
-            x = encoder_block(x, src_mask)
+            if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+                x = checkpoint(encoder_block, x, src_mask, use_reentrant=False)
+            else:
+                x = encoder_block(x, src_mask)
         return self.norm(x)   
    
 class DecoderBlock(nn.Module):
-    def __init__(self, d_model:int, head:int, d_ff:int) -> None:
+    def __init__(self, d_model:int, head:int, d_ff:int, fused_qkv: bool = False) -> None:
         super(DecoderBlock, self).__init__()
         self.head_dim = d_model // head
         
-        self.multiheadattention = MultiHeadAttention(d_model, head)
-        self.crossattention = MultiHeadAttention(d_model, head)
-        self.layer_norm1 = nn.LayerNorm(d_model)
+        self.multiheadattention = MultiHeadAttention(d_model, head, fused='qkv' if fused_qkv else None)
+        self.crossattention = MultiHeadAttention(d_model, head, fused='kv' if fused_qkv else None)
+        self.layer_norm1 = LayerNorm(d_model)
         self.dropout1 = nn.Dropout(p=0.1)
         self.feedforward = FeedForward(d_model,d_ff)
-        self.layer_norm2 = nn.LayerNorm(d_model)
-        self.layer_norm3 = nn.LayerNorm(d_model)
-        self.layer_norm4 = nn.LayerNorm(d_model)
+        self.layer_norm2 = LayerNorm(d_model)
+        self.layer_norm3 = LayerNorm(d_model)
+        self.layer_norm4 = LayerNorm(d_model)
         self.dropout2 = nn.Dropout(p=0.3)
         self.dropout3 = nn.Dropout(p=0.3)
-    def forward(self, x, src_mask, tgt_mask, encoder_output):
+    def forward(self, x, src_mask, tgt_mask, encoder_output, cache=None):
+        cache = {} if cache is None else cache
         #Self-attention block
         norm = self.layer_norm1(x)
-        attention = self.multiheadattention(norm, norm, norm, tgt_mask)
+        attention = self.multiheadattention(norm, norm, norm, tgt_mask, cache.get('self'))
         x = (x + self.dropout1(attention))
     
         # Cross-attention block
         norm2 = self.layer_norm2(x)    
-        cross_attention = self.crossattention(norm, encoder_output, encoder_output, src_mask)
+        cross_attention = self.crossattention(norm, encoder_output, encoder_output, src_mask, kv=cache.get('cross'))
         x = (x + self.dropout2(cross_attention))
    
         # Feedforward block  
@@ -264,25 +378,34 @@ class DecoderBlock(nn.Module):
 
 
 class Decoder(nn.Module):
-    def __init__(self, number_of_block:int,d_model:int, head:int, d_ff:int) -> None:
+    def __init__(self, number_of_block:int,d_model:int, head:int, d_ff:int, fused_qkv: bool = False) -> None:
         super(Decoder, self).__init__()
-        self.norm = nn.LayerNorm(d_model) 
-        self.decoders = nn.ModuleList([DecoderBlock(d_model, head, d_ff) 
+        self.norm = LayerNorm(d_model) 
+        self.decoders = nn.ModuleList([DecoderBlock(d_model, head, d_ff, fused_qkv) 
                                        for _ in range(number_of_block)])
-
-    def forward(self, x, src_mask, tgt_mask, encoder_output):
-        for decoder_block in self.decoders:
-            x = decoder_block(x, src_mask, tgt_mask, encoder_output)
+        self.gradient_checkpointing = False
+
+    def forward(self, x, src_mask, tgt_mask, encoder_output, cache=None):
+        for i, decoder_block in enumerate(self.decoders):
+            if cache is None and self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+                x = checkpoint(decoder_block, x, src_mask, tgt_mask, encoder_output, use_reentrant=False)
+            else:
+                x = decoder_block(x, src_mask, tgt_mask, encoder_output, None if cache is None else cache[i])
         return self.norm(x)    
 
 
 class Transformer(nn.Module):
-    def __init__(self, seq_len:int, batch:int, d_model:int,target_vocab_size:int, head: int = 8, d_ff: int =  1024, number_of_block: int = 2, imgSize: int = 224, patch_size: int = 14) -> None:
+    def __init__(self, seq_len:int, batch:int, d_model:int,target_vocab_size:int, head: int = 8, d_ff: int =  1024, number_of_block: int = 2, imgSize: int = 224, patch_size: int = 14, fused_qkv: bool = False, pad_idx: int = None) -> None:
         super(Transformer, self).__init__()
+        # the decoder mask is derived from the token ids, [PAD] positions are masked out when pad_idx is set
+        self.pad_idx = pad_idx
+        self.register_buffer('causal', torch.tril(torch.ones(1, 1, seq_len, seq_len, dtype=torch.bool)), persistent=False)
+        # a frozen encoder is a fixed feature extractor, see freeze_encoder
+        self.encoder_frozen = False
     
        
-        self.encoder = Encoder(number_of_block,d_model, head, d_ff )
-        self.decoder = Decoder(number_of_block, d_model, head, d_ff )
+        self.encoder = Encoder(number_of_block,d_model, head, d_ff, fused_qkv )
+        self.decoder = Decoder(number_of_block, d_model, head, d_ff, fused_qkv )
         self.patch_embeddings = PatchEmbed(imgSize, patch_size)
         # encoder_layer = nn.TransformerEncoderLayer(d_model=512, nhead=8, batch_first=True)
         # self.encoder = nn.TransformerEncoder(encoder_layer, num_layers=6)
@@ -291,29 +414,153 @@ class Transformer(nn.Module):
         # self.decoder = nn.TransformerDecoder(decoder_layer, num_layers=6)
         self.projection = ProjectionLayer(d_model, target_vocab_size)
         self.target_embedding = InputEmbeddings(d_model,target_vocab_size)
-        self.positional_encoding = PositionEncoding(seq_len, d_model, batch)
+        # the positional table is shared by the image patches and the caption tokens
+        self.positional_encoding = PositionEncoding(max(seq_len, self.patch_embeddings.n_patches), d_model, batch)
 
    
+    def forward(self, src, tgt, label=None, ignore_index: int = None, label_smoothing: float = 0.0, chunk_size: int = 1024,
+                encoder_output=None):
+        # training forward, image -> decoder output (batch, seq_len, d_model) with the masks built from tgt,
+        # or the loss when label is given. DistributedDataParallel only knows about the parameters that
+        # are used inside forward, so the projection has to happen in here as well.
+        # With precomputed encoder features src is not used and can be None
+        if encoder_output is None:
+            encoder_output = self.encode(src, None)
+        decoder_output = self.decode(tgt, None, None, encoder_output)
+        if label is None:
+            return decoder_output
+        return self.project_loss(decoder_output, label, ignore_index, label_smoothing, chunk_size)
+
     def encode(self,x, src_mask):
+        if self.encoder_frozen:
+            # no autograd graph and no dropout, the same features as a precomputed feature store
+            with torch.no_grad():
+                x = self.patch_embeddings(x)
+                x = self.positional_encoding(x, dropout=False)
+                return self.encoder(x, src_mask)
         x  = self.patch_embeddings(x)
         # x = self.source_embedding(x)
         x = self.positional_encoding(x)
         return self.encoder(x, src_mask)
        
-    def decode(self,x, src_mask, tgt_mask, encoder_output):
+    def decode(self,x, src_mask, tgt_mask, encoder_output, cache=None):
+        # with a cache, x only holds the tokens that are not in the cache yet
+        if tgt_mask is None and cache is None:
+            tgt_mask = self.tgt_mask(x)
         x = self.target_embedding(x)
-        x = self.positional_encoding(x)
-        return self.decoder(x, src_mask, tgt_mask, encoder_output,)
-        
+        x = self.positional_encoding(x, self.cache_length(cache))
+        return self.decoder(x, src_mask, tgt_mask, encoder_output, cache)
+
+    def tgt_mask(self, x):
+        # (batch, seq_len) token ids -> (batch, 1, seq_len, seq_len) causal & padding mask,
+        # sliced from the cached causal buffer instead of building a new triu every step
+        seq_len = x.size(1)
+        if seq_len <= self.causal.size(-1):
+            mask = self.causal[:, :, :seq_len, :seq_len]
+        else:
+            mask = torch.tril(torch.ones(1, 1, seq_len, seq_len, dtype=torch.bool, device=x.device))
+        if self.pad_idx is not None:
+            mask = mask & (x != self.pad_idx).view(x.size(0), 1, 1, seq_len)
+        return mask
+
+    def cross_kv(self, encoder_output):
+        # project the encoder output into the cross-attention keys/values of every decoder block,
+        # this only has to happen once per image instead of on every decode step
+        return [decoder_block.crossattention.project_kv(encoder_output, encoder_output)
+                for decoder_block in self.decoder.decoders]
+
+    def init_cache(self, encoder_output=None, self_attention: bool = True):
+        # one dict per decoder block, 'self' is filled with the self-attention keys/values by decode
+        # and 'cross' holds the precomputed cross-attention keys/values when encoder_output is given
+        cache = [{} for _ in self.decoder.decoders]
+        if self_attention:
+            for layer in cache:
+                layer['self'] = {}
+        if encoder_output is not None:
+            for layer, kv in zip(cache, self.cross_kv(encoder_output)):
+                layer['cross'] = kv
+        return cache
+
+    @staticmethod
+    def reorder_cache(cache, index, cross: bool = True):
+        # select rows of the cache, used to drop finished captions from a batch and to follow beams.
+        # Beams of one image share the same cross-attention rows, so cross=False leaves them alone
+        reordered = []
+        for layer in cache:
+            new_layer = dict(layer)
+            if 'self' in layer:
+                new_layer['self'] = {name: t.index_select(0, index) for name, t in layer['self'].items()}
+            if cross and 'cross' in layer:
+                new_layer['cross'] = tuple(t.index_select(0, index) for t in layer['cross'])
+            reordered.append(new_layer)
+        return reordered
+
+    @staticmethod
+    def cache_length(cache):
+        if cache is None or 'key' not in cache[0].get('self', {}):
+            return 0
+        return cache[0]['self']['key'].size(1)
+
     def project(self, x):
         return self.projection(x)
+
+    def project_last(self, x):
+        # inference only needs the log-probs of the newest position: (batch, seq_len, d_model) -> (batch, vocab_size)
+        return self.projection(x[:, -1])
+
+    def project_loss(self, x, label, ignore_index: int = None, label_smoothing: float = 0.0, chunk_size: int = 1024):
+        # fused, chunked projection + cross entropy, see ProjectionLayer.loss.
+        # chunk_size=0 projects the whole batch at once and takes the loss of the log-probs
+        ignore_index = self.pad_idx if ignore_index is None else ignore_index
+        if not chunk_size:
+            proj_output = self.projection(x) # (B, seq_len, vocab_size)
+            return F.cross_entropy(proj_output.view(-1, proj_output.size(-1)), label.reshape(-1),
+                                   ignore_index=ignore_index, label_smoothing=label_smoothing)
+        return self.projection.loss(x, label, ignore_index, label_smoothing, chunk_size)
+
+    def freeze_encoder(self, frozen: bool = True) -> None:
+        # decoder-only fine-tuning: PatchEmbed and the Encoder stack get no gradients and always run
+        # like in eval mode, so their output for an image is fixed and can be precomputed
+        self.encoder_frozen = frozen
+        for module in (self.patch_embeddings, self.encoder):
+            for param in module.parameters():
+                param.requires_grad_(not frozen)
+        self.train(self.training)
+
+    def encoder_fingerprint(self) -> str:
+        # hash of the PatchEmbed/Encoder weights, identifies the encoder a feature store was built with
+        digest = hashlib.sha1()
+        for module in (self.patch_embeddings, self.encoder):
+            for name, param in module.state_dict().items():
+                digest.update(name.encode())
+                digest.update(param.detach().float().cpu().numpy().tobytes())
+        return digest.hexdigest()
+
+    def train(self, mode: bool = True):
+        super(Transformer, self).train(mode)
+        if self.encoder_frozen:
+            self.patch_embeddings.eval()
+            self.encoder.eval()
+        return self
+
+    def set_gradient_checkpointing(self, enabled: bool = True) -> None:
+        # activation checkpointing of every EncoderBlock/DecoderBlock while training: only the block
+        # inputs are kept and the (batch, heads, seq_len, seq_len) attention tensors are recomputed in backward
+        self.encoder.gradient_checkpointing = enabled
+        self.decoder.gradient_checkpointing = enabled
+
+    def set_attention_backend(self, backend: str) -> None:
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttention):
+                module.set_backend(backend)
         
 
 
-def build_transformer(seq_len, batch, target_vocab_size,  d_model)-> Transformer:
+def build_transformer(seq_len, batch, target_vocab_size,  d_model, attention_backend: str = 'auto', fused_qkv: bool = False, pad_idx: int = None, img_size: int = 224)-> Transformer:
     
 
-    transformer = Transformer(seq_len, batch,  d_model, target_vocab_size )
+    transformer = Transformer(seq_len, batch,  d_model, target_vocab_size, imgSize=img_size, fused_qkv=fused_qkv, pad_idx=pad_idx )
+    transformer.set_attention_backend(attention_backend)
 
       #Initialize the parameters
     # for p in transformer.parameters():
@@ -322,6 +569,65 @@ def build_transformer(seq_len, batch, target_vocab_size,  d_model)-> Transformer
     return transformer         
 
 
+## Checkpoints store either the separate query/key/value weights or the packed ones,
+## these convert a model state dict between the two layouts
+def is_fused_state_dict(state_dict) -> bool:
+    return any(name.endswith(('qkv_weight.weight', 'kv_weight.weight')) for name in state_dict)
+
+def fuse_qkv_state_dict(state_dict):
+    state_dict = dict(state_dict)
+    for name in [n for n in state_dict if n.endswith('key_weight.weight')]:
+        prefix = name[:-len('key_weight.weight')]
+        key = state_dict.pop(prefix + 'key_weight.weight')
+        value = state_dict.pop(prefix + 'value_weight.weight')
+        if prefix.endswith('crossattention.'):
+            state_dict[prefix + 'kv_weight.weight'] = torch.cat([key, value], dim=0)
+        else:
+            query = state_dict.pop(prefix + 'query_weight.weight')
+            state_dict[prefix + 'qkv_weight.weight'] = torch.cat([query, key, value], dim=0)
+    return state_dict
+
+def unfuse_qkv_state_dict(state_dict):
+    state_dict = dict(state_dict)
+    for name in [n for n in state_dict if n.endswith('kv_weight.weight')]:
+        if name.endswith('qkv_weight.weight'):
+            prefix = name[:-len('qkv_weight.weight')]
+            query, key, value = state_dict.pop(name).chunk(3, dim=0)
+            state_dict[prefix + 'query_weight.weight'] = query
+        else:
+            prefix = name[:-len('kv_weight.weight')]
+            key, value = state_dict.pop(name).chunk(2, dim=0)
+        state_dict[prefix + 'key_weight.weight'] = key
+        state_dict[prefix + 'value_weight.weight'] = value
+    return state_dict
+
+def load_model_state(model, state_dict):
+    # load a state dict saved with either layout into the model, converting it when needed
+    model_fused = is_fused_state_dict(model.state_dict())
+    if is_fused_state_dict(state_dict) != model_fused:
+        state_dict = fuse_qkv_state_dict(state_dict) if model_fused else unfuse_qkv_state_dict(state_dict)
+    return model.load_state_dict(state_dict)
+
+def convert_checkpoint(src, dst, fused: bool):
+    # rewrite a tmodel_XX.pt checkpoint in the given layout. The Adam state is tied to the
+    # parameter shapes of the old layout, so it is dropped and training restarts it
+    state = torch.load(src, map_location='cpu')
+    convert = fuse_qkv_state_dict if fused else unfuse_qkv_state_dict
+    state['model_state_dict'] = convert(state['model_state_dict'])
+    state.pop('optimizer_state_dict', None)
+    torch.save(state, dst)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert a checkpoint between the separate and the fused QKV layout')
+    parser.add_argument('src')
+    parser.add_argument('dst')
+    parser.add_argument('--unfuse', action='store_true', help='convert a fused checkpoint back to separate weights')
+    args = parser.parse_args()
+    convert_checkpoint(args.src, args.dst, fused=not args.unfuse)
+
+
 # import torch
 # import torch.nn as nn
 # import math
@@ -0,0 +1,160 @@
+## int8 inference for CPU. 'dynamic' stores the weights of every nn.Linear (attention projections, FeedForward,
+## the vocabulary projection) in int8 and quantizes the activations on the fly, 'static' also quantizes the
+## activations with scales that were calibrated on a sample of (image, caption) pairs:
+##     python quantize.py weights/tmodel_05.pt weights/tmodel_05.int8.pt --mode dynamic
+## The saved file holds the quantized state dict and the build_transformer arguments, load_quantized
+## rebuilds the model from it. The quantized model decodes with generate.py like the fp32 one.
+
+import argparse
+import copy
+import io
+import time
+
+import torch
+import torch.nn as nn
+import torch.ao.quantization as quantization
+
+from model import build_transformer, is_fused_state_dict, load_model_state
+
+QUANTIZATION_MODES = ('dynamic', 'static')
+
+
+def _wrap_linears(module, qconfig):
+    # every nn.Linear gets a QuantStub/DeQuantStub around it, the rest of the model keeps running in fp32
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            wrapper = quantization.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_linears(child, qconfig)
+
+
+def _prepare(model, mode: str):
+    # copy of model with the int8 structure of mode, static models still need calibration and convert
+    assert mode in QUANTIZATION_MODES, f'unknown quantization mode {mode}'
+    # quantized Linears have no weight tensor that could be sliced, so the packed QKV layout is not supported
+    assert not is_fused_state_dict(model.state_dict()), 'quantization needs a model with fused_qkv=False'
+    model = copy.deepcopy(model).eval()
+    if mode == 'dynamic':
+        return quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    _wrap_linears(model, quantization.get_default_qconfig(torch.backends.quantized.engine))
+    return quantization.prepare(model)
+
+
+def quantize_model(model, mode: str = 'dynamic', calibration_loader=None, calibration_batches: int = 8):
+    # -> int8 copy of an fp32 Transformer. Static quantization runs calibration_batches teacher-forced
+    # batches of calibration_loader through the model to record the activation ranges of every Linear
+    quantized = _prepare(model, mode)
+    if mode == 'static':
+        assert calibration_loader is not None, 'static quantization needs a calibration loader'
+        with torch.no_grad():
+            for i, batch in enumerate(calibration_loader):
+                if i == calibration_batches:
+                    break
+                decoder_output = quantized(batch['encoder_input'], batch['decoder_input'])
+                quantized.project(decoder_output)
+        quantization.convert(quantized, inplace=True)
+    return quantized
+
+
+def save_quantized(model, path, mode: str, model_args) -> None:
+    # model_args are the build_transformer arguments of the fp32 model (without fused_qkv)
+    torch.save({
+        'quantization': mode,
+        'engine': torch.backends.quantized.engine,
+        'model_args': model_args,
+        'model_state_dict': model.state_dict(),
+    }, path)
+
+
+def load_quantized(path):
+    # rebuilds the int8 structure of the saved mode around an fp32 model and loads the int8 weights into it
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    torch.backends.quantized.engine = state['engine']
+    model = build_transformer(**state['model_args'])
+    model = _prepare(model, state['quantization'])
+    if state['quantization'] == 'static':
+        quantization.convert(model, inplace=True)
+    model.load_state_dict(state['model_state_dict'])
+    return model.eval()
+
+
+def state_dict_size(model) -> int:
+    # bytes of the serialized state dict, int8 weights are packed so their size is only known this way
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def quantization_report(reference, quantized, loader, tokenizer_tgt, max_len: int, max_batches: int = None):
+    # greedy captions of the fp32 and the int8 model for the images of loader: latency per caption,
+    # serialized size, and how often the int8 caption is exactly the fp32 one (plus the fraction of
+    # fp32 caption tokens it reproduces at the same position)
+    from generate import batch_greedy_decode
+
+    report = {}
+    captions = {}
+    for name, model in (('fp32', reference), ('int8', quantized)):
+        elapsed, count, tokens = 0.0, 0, []
+        with torch.no_grad():
+            for i, batch in enumerate(loader):
+                if i == max_batches:
+                    break
+                start = time.perf_counter()
+                tokens.extend(batch_greedy_decode(model, batch['encoder_input'], tokenizer_tgt, max_len, 'cpu'))
+                elapsed += time.perf_counter() - start
+                count += batch['encoder_input'].size(0)
+        captions[name] = tokens
+        report[f'{name} ms/caption'] = 1000 * elapsed / max(count, 1)
+        report[f'{name} MB'] = state_dict_size(model) / 2 ** 20
+
+    matches, same_tokens, total_tokens = 0, 0, 0
+    for ref, out in zip(captions['fp32'], captions['int8']):
+        matches += int(torch.equal(ref, out))
+        n = min(len(ref), len(out))
+        same_tokens += int((ref[:n] == out[:n]).sum())
+        total_tokens += len(ref)
+    report['exact match'] = matches / max(len(captions['fp32']), 1)
+    report['token agreement'] = same_tokens / max(total_tokens, 1)
+    report['speedup'] = report['fp32 ms/caption'] / max(report['int8 ms/caption'], 1e-9)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='int8 quantization of a checkpoint for CPU inference')
+    parser.add_argument('checkpoint')
+    parser.add_argument('path')
+    parser.add_argument('--mode', choices=QUANTIZATION_MODES, default='dynamic')
+    parser.add_argument('--calibration-batches', type=int, default=8, help='training batches used to calibrate static int8')
+    parser.add_argument('--report-batches', type=int, default=4, help='validation batches compared with fp32, 0 skips the report')
+    args = parser.parse_args()
+
+    # the data pipeline is only needed for calibration and the report, serving only needs load_quantized
+    from config import get_config
+    from train import get_ds
+
+    config = get_config()
+    config['num_workers'] = 0
+    train_dataloader, val_dataloader, tokenizer_tgt = get_ds(config)
+    model_args = dict(seq_len=config['seq_len'], batch=config['batch_size'], target_vocab_size=tokenizer_tgt.get_vocab_size(),
+                      d_model=config['d_model'], attention_backend=config['attention_backend'],
+                      pad_idx=tokenizer_tgt.token_to_id("[PAD]"), img_size=config['image_size'])
+    model = build_transformer(**model_args)
+    # fused checkpoints are converted to the separate QKV layout here
+    load_model_state(model, torch.load(args.checkpoint, map_location='cpu')['model_state_dict'])
+    model.eval()
+
+    quantized = quantize_model(model, args.mode, train_dataloader, args.calibration_batches)
+    save_quantized(quantized, args.path, args.mode, model_args)
+    print(f'Saved {args.mode} int8 model to {args.path}')
+
+    if args.report_batches:
+        report = quantization_report(model, load_quantized(args.path), val_dataloader, tokenizer_tgt, config['seq_len'],
+                                     args.report_batches)
+        for name, value in report.items():
+            print(f'{name:>18}: {value:.3f}')
+
+
+if __name__ == '__main__':
+    main()
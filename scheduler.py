@@ -0,0 +1,147 @@
+## Continuous batching for greedy captioning. Instead of decoding a batch until its longest caption is done,
+## the scheduler works one decode step at a time: a finished caption frees its slot right away and a waiting
+## image is admitted into it before the next step.
+##     batcher = ContinuousBatcher(model, max_slots=8, max_len=150, sos_idx=..., eos_idx=..., pad_idx=...)
+##     batcher.submit(pixel_values, handle)  # optionally with a shorter max_len for this image
+##     while batcher.pending():
+##         admitted, finished = batcher.step()  # finished: [(handle, token tensor starting with [SOS])]
+
+import collections
+import itertools
+
+import torch
+
+from export import EncodeStep, DecodeStep
+
+
+class ContinuousBatcher:
+    # Every slot is one row of the static KV tensors of export.DecodeStep: its self-attention keys/values,
+    # its cross-attention keys/values and its own position. The active slots are always the rows
+    # [0, active), a finished slot is filled with the last active row, so a step runs on views of the
+    # first rows without gathering the caches
+    def __init__(self, model, max_slots: int, max_len: int, sos_idx: int, eos_idx: int, pad_idx: int, device='cpu'):
+        if max_len < 2:
+            raise ValueError(f'max_len {max_len} leaves no room for a generated token after [SOS]')
+        model.eval()
+        self.max_slots = max_slots
+        self.max_len = max_len
+        self.sos_idx = sos_idx
+        self.eos_idx = eos_idx
+        self.pad_idx = pad_idx
+        self.encode_step = EncodeStep(model)
+        self.decode_step = DecodeStep(model)
+
+        blocks = len(model.decoder.decoders)
+        d_model = model.positional_encoding.positional_encoding.size(-1)
+        patches = model.patch_embeddings.n_patches
+        self.self_k = torch.zeros(blocks, max_slots, max_len, d_model, device=device)
+        self.self_v = torch.zeros_like(self.self_k)
+        self.cross_k = torch.zeros(blocks, max_slots, patches, d_model, device=device)
+        self.cross_v = torch.zeros_like(self.cross_k)
+        self.tokens = torch.full((max_slots,), sos_idx, dtype=torch.long, device=device)
+        self.positions = torch.zeros(max_slots, dtype=torch.long, device=device)
+        self.limits = torch.full((max_slots,), max_len, dtype=torch.long, device=device)  # max_len of every slot
+        self.outputs = torch.full((max_slots, max_len), pad_idx, dtype=torch.long, device=device)
+        self.handles = []  # handle of every active slot
+        self.waiting = collections.deque()
+
+    @property
+    def active(self) -> int:
+        return len(self.handles)
+
+    def pending(self) -> bool:
+        return bool(self.handles or self.waiting)
+
+    def submit(self, pixel_values, handle=None, max_len: int = None) -> None:
+        # pixel_values: (3, img_size, img_size), handle is returned with the caption.
+        # max_len caps the length of this caption (including [SOS]), at most the max_len of the batcher
+        max_len = self.max_len if max_len is None else min(max_len, self.max_len)
+        if max_len < 2:
+            raise ValueError(f'max_len {max_len} leaves no room for a generated token after [SOS]')
+        self.waiting.append((pixel_values, handle, max_len))
+
+    def reset(self):
+        # drops every active and waiting caption (e.g. after a failed step) and returns their handles
+        handles = self.handles + [handle for _, handle, _ in self.waiting]
+        self.handles = []
+        self.waiting.clear()
+        return handles
+
+    def step(self):
+        # admits waiting images into the free slots and runs one decode step for every active slot.
+        # Returns the handles that were admitted and the (handle, tokens) of the captions that finished
+        admitted = self._admit()
+        n = self.active
+        if n == 0:
+            return admitted, []
+        with torch.no_grad():
+            log_probs = self.decode_step(self.tokens[:n], self.positions[:n], self.self_k[:, :n], self.self_v[:, :n],
+                                         self.cross_k[:, :n], self.cross_v[:, :n])
+        next_tokens = log_probs.argmax(dim=1)
+        self.positions[:n] += 1
+        self.outputs[torch.arange(n, device=next_tokens.device), self.positions[:n]] = next_tokens
+        self.tokens[:n] = next_tokens
+
+        done = (next_tokens == self.eos_idx) | (self.positions[:n] >= self.limits[:n] - 1)
+        finished = []
+        # the only host sync of the step, needed to know which slots are free again
+        if done.any():
+            # from the last row down, so a row that is moved into a free slot is never one that finished
+            for row in done.nonzero().squeeze(1).tolist()[::-1]:
+                length = int(self.positions[row]) + 1
+                finished.append((self.handles[row], self.outputs[row, :length].clone()))
+                self._release(row)
+        return admitted, finished
+
+    def _admit(self):
+        count = min(len(self.waiting), self.max_slots - self.active)
+        if count == 0:
+            return []
+        items = list(itertools.islice(self.waiting, count))
+        rows = slice(self.active, self.active + count)
+        with torch.no_grad():
+            cross_k, cross_v = self.encode_step(torch.stack([pixel_values for pixel_values, _, _ in items]).to(self.cross_k.device))
+        # only taken off the queue once they are encoded, when encoding fails reset() still returns their handles
+        for _ in range(count):
+            self.waiting.popleft()
+        self.cross_k[:, rows] = cross_k
+        self.cross_v[:, rows] = cross_v
+        self.tokens[rows] = self.sos_idx
+        self.positions[rows] = 0
+        self.limits[rows] = torch.tensor([max_len for _, _, max_len in items], device=self.limits.device)
+        self.outputs[rows] = self.pad_idx
+        self.outputs[rows, 0] = self.sos_idx
+        handles = [handle for _, handle, _ in items]
+        self.handles.extend(handles)
+        return handles
+
+    def _release(self, row: int) -> None:
+        last = self.active - 1
+        if row != last:
+            # only the positions the last slot has written so far have to be copied
+            length = int(self.positions[last]) + 1
+            self.self_k[:, row, :length] = self.self_k[:, last, :length]
+            self.self_v[:, row, :length] = self.self_v[:, last, :length]
+            self.cross_k[:, row] = self.cross_k[:, last]
+            self.cross_v[:, row] = self.cross_v[:, last]
+            self.tokens[row] = self.tokens[last]
+            self.positions[row] = self.positions[last]
+            self.limits[row] = self.limits[last]
+            self.outputs[row] = self.outputs[last]
+            self.handles[row] = self.handles[last]
+        self.handles.pop()
+
+
+def continuous_greedy_decode(model, images, max_slots: int, max_len: int, sos_idx: int, eos_idx: int, pad_idx: int,
+                             device='cpu'):
+    # all images through a ContinuousBatcher with max_slots slots -> token tensors in the order of images,
+    # the same captions as generate.batch_greedy_decode
+    batcher = ContinuousBatcher(model, max_slots, max_len, sos_idx, eos_idx, pad_idx, device)
+    for i, pixel_values in enumerate(images):
+        batcher.submit(pixel_values, i)
+    results = [None] * len(images)
+    while batcher.pending():
+        _, finished = batcher.step()
+        for i, tokens in finished:
+            results[i] = tokens
+    return results
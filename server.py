@@ -0,0 +1,386 @@
+## Local caption service, POST the bytes of an image to /caption and get its caption back:
+##     python server.py serve --checkpoint weights/tmodel_05.pt --port 8080
+##     python server.py serve --checkpoint weights/tmodel_05.pt --scheduler continuous --max-batch-size 16
+##     python server.py serve --captioner captioner.pt --unix /tmp/caption.sock
+##     python server.py client image1.jpg image2.jpg --port 8080 --concurrency 8
+## Images are decoded and preprocessed in a thread pool, concurrent requests are grouped into micro-batches
+## of at most max_batch_size images (the first image of a batch waits at most max_wait_ms for more) and
+## captioned on one model thread. GET /metrics returns the per-request latency histograms
+
+import argparse
+import asyncio
+import collections
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+
+from metrics import LatencyHistogram
+
+
+class UnreadableImage(ValueError):
+    # the request body could not be decoded as an image
+    pass
+
+
+class CaptionServer:
+    # caption_fn: (n, 3, img_size, img_size) pixel_values -> list of n caption strings, it always runs on
+    # the same model thread. image_processor turns a PIL image into pixel_values (see dataset.get_image_processor)
+    def __init__(self, caption_fn, image_processor, max_batch_size: int = 8, max_wait_ms: float = 5.0,
+                 preprocess_workers: int = 4):
+        self.caption_fn = caption_fn
+        self.image_processor = image_processor
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.histograms = {name: LatencyHistogram() for name in ('preprocess', 'queue', 'compute', 'total')}
+        self.batch_sizes = collections.Counter()
+        self._preprocess_pool = ThreadPoolExecutor(preprocess_workers, thread_name_prefix='preprocess')
+        self._model_pool = ThreadPoolExecutor(1, thread_name_prefix='model')
+        self._queue = None
+        self._batcher = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+
+    async def stop(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+        self._preprocess_pool.shutdown()
+        self._model_pool.shutdown()
+
+    async def caption(self, data: bytes):
+        # encoded image -> caption and the latencies of this request in ms
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        pixel_values = await loop.run_in_executor(self._preprocess_pool, self._preprocess, data)
+        enqueued = time.perf_counter()
+        future = loop.create_future()
+        await self._queue.put((pixel_values, future, enqueued))
+        caption, queue_ms, compute_ms = await future
+
+        timings = {
+            'preprocess': (enqueued - start) * 1000,
+            'queue': queue_ms,
+            'compute': compute_ms,
+            'total': (time.perf_counter() - start) * 1000,
+        }
+        for name, ms in timings.items():
+            self.histograms[name].add(ms)
+        return {'caption': caption, **{f'{name}_ms': ms for name, ms in timings.items()}}
+
+    def metrics(self):
+        return {
+            **{f'{name}_ms': histogram.summary() for name, histogram in self.histograms.items()},
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+        }
+
+    def _preprocess(self, data):
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                return self.image_processor(image)
+        except (OSError, ValueError) as error:
+            # PIL raises these for data that is not an image or is truncated
+            raise UnreadableImage(f'cannot read the image: {error}') from error
+
+    def _run(self, pixel_values):
+        with torch.no_grad():
+            return self.caption_fn(pixel_values)
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # requests that arrived while the previous batch was running are taken right away,
+            # otherwise the batch waits up to max_wait_ms for more
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            started = time.perf_counter()
+            self.batch_sizes[len(batch)] += 1
+            try:
+                captions = await loop.run_in_executor(self._model_pool, self._run,
+                                                      torch.stack([pixel_values for pixel_values, _, _ in batch]))
+            except Exception as error:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            compute_ms = (time.perf_counter() - started) * 1000
+            for (_, future, enqueued), caption in zip(batch, captions):
+                # the future is cancelled when the request that waits for it was cancelled
+                if not future.done():
+                    future.set_result((caption, (started - enqueued) * 1000, compute_ms))
+
+    async def _route(self, method, path, body):
+        if method == 'POST' and path == '/caption':
+            try:
+                return 200, await self.caption(body)
+            except UnreadableImage as error:
+                # a client error, failures of the model are answered with 500 by handle_connection
+                return 400, {'error': str(error)}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics()
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': f'no route for {method} {path}'}
+
+    async def handle_connection(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive, the bodies are raw image bytes in and JSON out
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                try:
+                    status, payload = await self._route(method, path, body)
+                except Exception as error:
+                    status, payload = 500, {'error': repr(error)}
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                data = json.dumps(payload).encode()
+                writer.write(f'HTTP/1.1 {status} {HTTP_STATUS[status]}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+                             .encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class ContinuousCaptionServer(CaptionServer):
+    # Continuous batching instead of micro-batches: the model thread runs one ContinuousBatcher step at a time
+    # and the requests that arrived in the meantime take the slots of the captions that finished (see
+    # scheduler.py). decode_fn turns a list of token tensors into caption strings. The queue latency is
+    # the time until a request got a slot, batch_sizes counts the active slots of every step
+    def __init__(self, batcher, decode_fn, image_processor, preprocess_workers: int = 4):
+        super(ContinuousCaptionServer, self).__init__(None, image_processor, batcher.max_slots, 0.0, preprocess_workers)
+        self.batcher = batcher
+        self.decode_fn = decode_fn
+
+    def _step(self, items):
+        for pixel_values, future, enqueued in items:
+            self.batcher.submit(pixel_values, {'future': future, 'enqueued': enqueued})
+        started = time.perf_counter()
+        admitted, finished = self.batcher.step()
+        for handle in admitted:
+            handle['admitted'] = started
+        self.batch_sizes[self.batcher.active + len(finished)] += 1
+        captions = self.decode_fn([tokens for _, tokens in finished]) if finished else []
+        return [(handle, caption) for (handle, _), caption in zip(finished, captions)]
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = []
+            if not self.batcher.pending():
+                items.append(await self._queue.get())
+            while not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            try:
+                finished = await loop.run_in_executor(self._model_pool, self._step, items)
+            except Exception as error:
+                for handle in self.batcher.reset():
+                    if not handle['future'].done():
+                        handle['future'].set_exception(error)
+                continue
+            now = time.perf_counter()
+            for handle, caption in finished:
+                if not handle['future'].done():
+                    handle['future'].set_result((caption, (handle['admitted'] - handle['enqueued']) * 1000,
+                                                 (now - handle['admitted']) * 1000))
+
+
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+async def serve(server, host: str = '127.0.0.1', port: int = 8080, unix_path: str = None):
+    await server.start()
+    if unix_path:
+        listener = await asyncio.start_unix_server(server.handle_connection, unix_path)
+    else:
+        listener = await asyncio.start_server(server.handle_connection, host, port)
+    print(f"Serving captions on {unix_path or f'http://{host}:{port}'}")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.stop()
+
+
+async def request(method, path, body: bytes = b'', host: str = '127.0.0.1', port: int = 8080, unix_path: str = None):
+    # one HTTP request on its own connection -> (status, decoded JSON body)
+    if unix_path:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f'{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+    finally:
+        writer.close()
+
+
+async def caption_images(images, concurrency: int = 8, **address):
+    # captions for a list of encoded images with at most concurrency requests in flight,
+    # every result also holds the round trip time seen by the client
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(data):
+        async with semaphore:
+            start = time.perf_counter()
+            status, result = await request('POST', '/caption', data, **address)
+            if status != 200:
+                raise RuntimeError(f"caption request failed with {status}: {result.get('error')}")
+            result['round_trip_ms'] = (time.perf_counter() - start) * 1000
+            return result
+    return await asyncio.gather(*[one(data) for data in images])
+
+
+def load_model(args, config, tokenizer_tgt):
+    # eval-mode Transformer of a checkpoint or of an int8 model written by quantize.py
+    if args.quantized:
+        from quantize import load_quantized
+        return load_quantized(args.quantized)
+    from export import load_checkpoint_model
+    return load_checkpoint_model(args.checkpoint, config, tokenizer_tgt)
+
+
+def load_server(args):
+    # CaptionServer (micro-batches) or ContinuousCaptionServer for the model of args,
+    # with the image processor of get_config()
+    from tokenizers import Tokenizer
+    from config import get_config
+    from dataset import get_image_processor
+    from generate import generate, decode_captions
+
+    config = get_config()
+    max_len = args.max_len or config['seq_len']
+    image_processor = get_image_processor(config['image_processor'], config['image_size'])
+    if args.captioner:
+        from export import load_captioner, captioner_outputs
+        captioner, tokenizer_json = load_captioner(args.captioner)
+        tokenizer_tgt = Tokenizer.from_str(tokenizer_json)
+
+        def caption_fn(pixel_values):
+            return decode_captions(tokenizer_tgt, captioner_outputs(*captioner(pixel_values)))
+        return CaptionServer(caption_fn, image_processor, args.max_batch_size, args.max_wait_ms, args.preprocess_workers)
+
+    tokenizer_tgt = Tokenizer.from_file(config['tokenizer_file'])
+    model = load_model(args, config, tokenizer_tgt)
+    if args.scheduler == 'continuous':
+        from scheduler import ContinuousBatcher
+        batcher = ContinuousBatcher(model, args.max_batch_size, max_len, tokenizer_tgt.token_to_id("[SOS]"),
+                                    tokenizer_tgt.token_to_id("[EOS]"), tokenizer_tgt.token_to_id("[PAD]"))
+        return ContinuousCaptionServer(batcher, lambda tokens: decode_captions(tokenizer_tgt, tokens), image_processor,
+                                       args.preprocess_workers)
+
+    def caption_fn(pixel_values):
+        return decode_captions(tokenizer_tgt, generate(model, pixel_values, tokenizer_tgt, max_len, 'cpu', args.beam_size))
+    return CaptionServer(caption_fn, image_processor, args.max_batch_size, args.max_wait_ms, args.preprocess_workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-batching caption server and its client')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='run the server')
+    model_group = serve_parser.add_mutually_exclusive_group(required=True)
+    model_group.add_argument('--checkpoint', help='tmodel_XX.pt training checkpoint')
+    model_group.add_argument('--quantized', help='int8 model written by quantize.py')
+    model_group.add_argument('--captioner', help='TorchScript captioner written by export.py')
+    serve_parser.add_argument('--scheduler', choices=['static', 'continuous'], default='static',
+                              help='micro-batches that run until their longest caption is done, or continuous batching '
+                                   '(greedy, not with --captioner)')
+    serve_parser.add_argument('--max-batch-size', type=int, default=8, help='images per micro-batch or continuous batching slots')
+    serve_parser.add_argument('--max-wait-ms', type=float, default=5.0, help='micro-batch window of the static scheduler')
+    serve_parser.add_argument('--preprocess-workers', type=int, default=4)
+    serve_parser.add_argument('--max-len', type=int, default=None, help='longest caption, defaults to seq_len (not with --captioner)')
+    serve_parser.add_argument('--beam-size', type=int, default=1, help='beam search for > 1 (not with --captioner)')
+
+    client_parser = subparsers.add_parser('client', help='caption image files with a running server')
+    client_parser.add_argument('images', nargs='+')
+    client_parser.add_argument('--concurrency', type=int, default=8)
+
+    for sub in (serve_parser, client_parser):
+        sub.add_argument('--host', default='127.0.0.1')
+        sub.add_argument('--port', type=int, default=8080)
+        sub.add_argument('--unix', default=None, help='unix socket path instead of host/port')
+    args = parser.parse_args()
+
+    if args.command == 'serve' and args.captioner:
+        # the captioner decodes greedily up to the max_len it was exported with
+        if args.scheduler == 'continuous':
+            parser.error('--scheduler continuous needs --checkpoint or --quantized, not --captioner')
+        if args.beam_size > 1:
+            parser.error('--captioner only decodes greedily, --beam-size must be 1')
+        if args.max_len is not None:
+            parser.error('--captioner keeps the max_len of export.py, --max-len cannot change it')
+    if args.command == 'serve' and args.scheduler == 'continuous' and args.beam_size > 1:
+        parser.error('--scheduler continuous only decodes greedily, --beam-size must be 1')
+
+    if args.command == 'serve':
+        asyncio.run(serve(load_server(args), args.host, args.port, args.unix))
+        return
+
+    address = dict(host=args.host, port=args.port, unix_path=args.unix)
+
+    async def run_client():
+        images = []
+        for path in args.images:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+        results = await caption_images(images, args.concurrency, **address)
+        _, metrics = await request('GET', '/metrics', **address)
+        return results, metrics
+
+    results, metrics = asyncio.run(run_client())
+    for path, result in zip(args.images, results):
+        print(f"{path}: {result['caption']}  ({result['round_trip_ms']:.0f} ms)")
+    for name in ('preprocess_ms', 'queue_ms', 'compute_ms', 'total_ms'):
+        summary = metrics[name]
+        print(f"{name:>14}: p50 {summary['p50']:.1f}  p90 {summary['p90']:.1f}  p99 {summary['p99']:.1f}  (n={summary['count']})")
+    print(f"   batch sizes: {metrics['batch_sizes']}")
+
+
+if __name__ == '__main__':
+    main()
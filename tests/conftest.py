@@ -0,0 +1,59 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+from tokenizers import Tokenizer
+
+# the modules live in the repository root, not in a package
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+
+class CaptionRows:
+    # Small in-memory stand-in for the HausaVG rows, indexed like a datasets.Dataset (a row or a list of rows)
+    def __init__(self, images, texts, columns=('image', 'en_text')):
+        self.images = images
+        self.texts = texts
+        self.columns = tuple(columns)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def select_columns(self, columns):
+        return CaptionRows(self.images, self.texts, columns)
+
+    def _row(self, i):
+        row = {'image': self.images[i], 'en_text': self.texts[i]}
+        return {column: row[column] for column in self.columns}
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            idx = range(*idx.indices(len(self)))
+        if isinstance(idx, (list, tuple, range)):
+            rows = [self._row(int(i)) for i in idx]
+            return {column: [row[column] for row in rows] for column in self.columns}
+        return self._row(int(idx))
+
+
+def make_caption_rows(n, tokenizer, seed=0):
+    # PIL images of different sizes (the first one grayscale) and captions from the tokenizer vocabulary
+    rng = np.random.RandomState(seed)
+    images = [Image.fromarray((rng.rand(rng.randint(40, 120), rng.randint(40, 120), 3) * 255).astype('uint8'))
+              for _ in range(n)]
+    if n:
+        images[0] = images[0].convert('L')
+    words = sorted(tokenizer.get_vocab())[10:500]
+    texts = [' '.join(rng.choice(words, rng.randint(3, 20))) for _ in range(n)]
+    return CaptionRows(images, texts)
+
+
+@pytest.fixture(scope='session')
+def tokenizer():
+    return Tokenizer.from_file(str(REPO / 'vison.json'))
+
+
+@pytest.fixture
+def caption_rows(tokenizer):
+    return make_caption_rows(24, tokenizer)
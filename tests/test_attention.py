@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from model import MultiHeadAttention, HAS_SDPA, prepare_mask
+
+BACKENDS = ['math', 'sdpa'] if HAS_SDPA else ['math']
+
+
+def decoder_masks(seq_len):
+    # causal + padding mask (last third is [PAD]) in every supported form
+    padding = torch.arange(seq_len) < seq_len - seq_len // 3
+    bool_mask = (torch.tril(torch.ones(seq_len, seq_len, dtype=torch.bool)) & padding).view(1, 1, seq_len, seq_len)
+    return {
+        'bool': bool_mask,
+        'int': bool_mask.int(),
+        'additive -inf': torch.zeros(bool_mask.shape).masked_fill(~bool_mask, float('-inf')),
+        'additive -1e9': torch.zeros(bool_mask.shape).masked_fill(~bool_mask, -1e9),
+    }
+
+
+def test_prepare_mask_forms():
+    masks = decoder_masks(6)
+    for name in ('bool', 'int'):
+        assert torch.equal(prepare_mask(masks[name]), masks['bool']), name
+    for name in ('additive -inf', 'additive -1e9'):
+        assert prepare_mask(masks[name]) is masks[name]
+    assert prepare_mask(None) is None
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_mask_forms_match(backend):
+    torch.manual_seed(0)
+    attention = MultiHeadAttention(64, 4, backend=backend).eval()
+    x = torch.randn(2, 12, 64)
+    with torch.no_grad():
+        outputs = {name: attention(x, x, x, mask) for name, mask in decoder_masks(12).items()}
+        unmasked = attention(x, x, x, None)
+    for name, out in outputs.items():
+        assert torch.allclose(out, outputs['bool'], atol=1e-5), name
+    # the masks actually mask something
+    assert not torch.allclose(outputs['bool'], unmasked, atol=1e-3)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_all_zero_additive_mask_attends_everywhere(backend):
+    # e.g. the padding mask of a batch without padding
+    torch.manual_seed(0)
+    attention = MultiHeadAttention(64, 4, backend=backend).eval()
+    x = torch.randn(2, 12, 64)
+    with torch.no_grad():
+        out = attention(x, x, x, torch.zeros(1, 1, 12, 12))
+        unmasked = attention(x, x, x, None)
+    assert torch.allclose(out, unmasked, atol=1e-6)
+
+
+@pytest.mark.skipif(not HAS_SDPA, reason='needs scaled_dot_product_attention')
+@pytest.mark.parametrize('mask_name', [None, 'bool', 'int', 'additive -inf'])
+def test_sdpa_matches_math(mask_name):
+    torch.manual_seed(0)
+    attention = MultiHeadAttention(64, 4).eval()
+    x = torch.randn(2, 12, 64)
+    mask = None if mask_name is None else decoder_masks(12)[mask_name]
+    with torch.no_grad():
+        attention.set_backend('math')
+        reference = attention(x, x, x, mask)
+        attention.set_backend('sdpa')
+        out = attention(x, x, x, mask)
+    assert torch.allclose(out, reference, atol=1e-5)
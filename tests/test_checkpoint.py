@@ -0,0 +1,29 @@
+import os
+from pathlib import Path
+
+import torch
+
+from checkpoint import AsyncCheckpointer, latest_checkpoint, list_checkpoints
+
+
+def test_list_checkpoints_skips_other_files(tmp_path):
+    config = {'model_folder': str(tmp_path), 'model_basename': 'tmodel_'}
+    names = ['tmodel_04.pt', 'tmodel_05_0000120.pt', 'tmodel_05.pt', 'tmodel_05.rank0.pt', 'tmodel_05.int8.pt',
+             'tmodel_05.pt.tmp', 'other_06.pt']
+    for i, name in enumerate(names):
+        (tmp_path / name).write_bytes(b'')
+        os.utime(tmp_path / name, (i, i))
+    assert [Path(path).name for path in list_checkpoints(config)] == names[:3]
+    assert latest_checkpoint(config) == '05'
+
+
+def test_rotation_keeps_earlier_runs(tmp_path):
+    earlier = tmp_path / 'tmodel_00.pt'
+    earlier.write_bytes(b'')
+    checkpointer = AsyncCheckpointer(keep_last=2, background=False)
+    for epoch in range(1, 4):
+        path = tmp_path / f'tmodel_{epoch:02d}.pt'
+        checkpointer.save({str(path): {'weight': torch.zeros(1)}, f'{tmp_path}/tmodel_{epoch:02d}.rank0.pt': {}})
+    checkpointer.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'tmodel_00.pt', 'tmodel_02.pt', 'tmodel_02.rank0.pt', 'tmodel_03.pt', 'tmodel_03.rank0.pt']
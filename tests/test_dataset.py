@@ -0,0 +1,139 @@
+import pytest
+import torch
+
+from dataset import ImageCache, build_image_cache, get_image_processor
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16', 'uint8'])
+def test_image_cache_matches_processor(caption_rows, tmp_path, dtype):
+    image_processor = get_image_processor('builtin', 32)
+    cache = build_image_cache(caption_rows, tmp_path / 'images', dtype, image_processor)
+    for row in (0, 5):
+        expected = image_processor(caption_rows[row]['image'])
+        assert torch.allclose(cache[row], expected, atol=1e-2 if dtype == 'float16' else 1e-5)
+
+    cache = ImageCache(tmp_path / 'images')
+    assert cache.matches(image_processor, dtype, len(caption_rows))
+    assert not cache.matches(image_processor, dtype, len(caption_rows) + 1)
+    assert not cache.matches(get_image_processor('builtin', 48), dtype, len(caption_rows))
+    other = get_image_processor('builtin', 32)
+    other.image_mean = [0.485, 0.456, 0.406]
+    assert not cache.matches(other, dtype, len(caption_rows))
+    assert not cache.matches(image_processor, 'float32' if dtype != 'float32' else 'uint8', len(caption_rows))
+
+
+def test_caption_store_matches_tokenizer(caption_rows, tokenizer, tmp_path):
+    from tokenizers import Tokenizer
+    from dataset import CaptionStore, build_caption_store
+
+    store = build_caption_store(caption_rows, tokenizer, tmp_path / 'captions', batch_size=5)
+    for row in (0, 7, 23):
+        assert store[row].tolist() == tokenizer.encode(caption_rows[row]['en_text']).ids
+
+    store = CaptionStore(tmp_path / 'captions')
+    assert store.matches(tokenizer, len(caption_rows))
+    assert not store.matches(tokenizer, len(caption_rows) - 1)
+    # another tokenizer
+    other = Tokenizer.from_str(tokenizer.to_str())
+    other.add_special_tokens(['[MASK]'])
+    assert not store.matches(other, len(caption_rows))
+
+
+def test_caption_lengths(caption_rows, tokenizer):
+    from torch.utils.data import random_split
+    from dataset import BilingualDataset
+
+    subset, _ = random_split(caption_rows, [20, 4], generator=torch.Generator().manual_seed(0))
+    ds = BilingualDataset(subset, tokenizer, 64)
+    expected = [len(tokenizer.encode(caption_rows[row]['en_text']).ids) for row in subset.indices]
+    assert ds.caption_lengths().tolist() == expected
+
+
+def _sharded_texts(directory, tokenizer, num_replicas, num_workers, **kwargs):
+    # tgt_text of every sample each rank yields through a DataLoader, with len() of each rank
+    from torch.utils.data import DataLoader
+    from dataset import ShardedCaptionDataset
+
+    texts, lengths = [], []
+    for rank in range(num_replicas):
+        ds = ShardedCaptionDataset(directory, tokenizer, 32, get_image_processor('builtin', 16), shuffle_buffer=3,
+                                   seed=1, num_replicas=num_replicas, rank=rank, num_workers=num_workers, **kwargs)
+        ds.set_epoch(1)
+        loader = DataLoader(ds, batch_size=1, num_workers=num_workers, collate_fn=lambda batch: batch[0])
+        rank_texts = [sample['tgt_text'] for sample in loader]
+        texts.append(rank_texts)
+        lengths.append(len(ds))
+    return texts, lengths
+
+
+def test_sharded_readers_with_uneven_shards(caption_rows, tokenizer, tmp_path):
+    from dataset import write_shards
+
+    # 13 rows in shards of 4, 4, 4 and 1 rows for 2 ranks with 2 workers each, as many shards as readers
+    write_shards(caption_rows, range(13), tmp_path, rows_per_shard=4, batch_rows=3)
+    rows = [caption_rows[row]['en_text'] for row in range(13)]
+
+    texts, lengths = _sharded_texts(tmp_path, tokenizer, 2, 2, shuffle=True)
+    assert sorted(texts[0] + texts[1]) == sorted(rows)
+    assert [len(rank_texts) for rank_texts in texts] == lengths
+
+    texts, lengths = _sharded_texts(tmp_path, tokenizer, 2, 2, shuffle=False, max_samples=9)
+    assert len(set(texts[0] + texts[1])) == 9 == sum(lengths)
+    assert [len(rank_texts) for rank_texts in texts] == lengths
+
+    # training: whole batches, the same number on every rank and no sample twice
+    texts, lengths = _sharded_texts(tmp_path, tokenizer, 2, 2, shuffle=True, batch_size=2)
+    assert lengths == [4, 4]
+    assert [len(rank_texts) for rank_texts in texts] == lengths
+    assert len(set(texts[0] + texts[1])) == 8
+
+
+def test_sharded_skip_resumes_the_epoch(caption_rows, tokenizer, tmp_path):
+    from torch.utils.data import DataLoader
+    from dataset import ShardedCaptionDataset, get_collate_fn, write_shards
+
+    write_shards(caption_rows, range(22), tmp_path, rows_per_shard=5, batch_rows=2)
+    ds = ShardedCaptionDataset(tmp_path, tokenizer, 32, get_image_processor('builtin', 16), shuffle_buffer=4,
+                               seed=3, batch_size=2, num_workers=2)
+    ds.set_epoch(2)
+    loader = DataLoader(ds, batch_size=2, num_workers=2, collate_fn=get_collate_fn(ds.pad_id))
+    batches = [batch['tgt_text'] for batch in loader]
+    assert len(batches) * 2 == len(ds) == 20
+    assert len({text for batch in batches for text in batch}) == 20
+
+    for skip in (4, 3, 1):
+        ds.skip(skip)
+        assert [batch['tgt_text'] for batch in loader] == batches[skip:]
+
+
+def test_subset_sampler_is_fixed():
+    from dataset import SubsetSampler
+
+    assert list(SubsetSampler(10)) == list(range(10))
+    subset = list(SubsetSampler(100, 12, seed=3))
+    assert len(set(subset)) == 12 and subset == list(SubsetSampler(100, 12, seed=3))
+    parts = [list(SubsetSampler(100, 12, seed=3, num_replicas=2, rank=rank)) for rank in range(2)]
+    assert sorted(parts[0] + parts[1]) == sorted(subset)
+
+
+@pytest.mark.parametrize('image_cache', [False, True], ids=['images', 'image cache'])
+@pytest.mark.parametrize('caption_store', [False, True], ids=['tokenizer', 'caption store'])
+@pytest.mark.parametrize('pad_to_seq_len', [True, False])
+def test_getitems_matches_getitem(caption_rows, tokenizer, tmp_path, image_cache, caption_store, pad_to_seq_len):
+    from torch.utils.data import random_split
+    from dataset import BilingualDataset, build_caption_store
+
+    image_processor = get_image_processor('builtin', 32)
+    cache = build_image_cache(caption_rows, tmp_path / 'images', 'float32', image_processor) if image_cache else None
+    store = build_caption_store(caption_rows, tokenizer, tmp_path / 'captions') if caption_store else None
+    subset, _ = random_split(caption_rows, [20, 4], generator=torch.Generator().manual_seed(0))
+    ds = BilingualDataset(subset, tokenizer, 64, cache, store, pad_to_seq_len, image_processor)
+
+    indices = [3, 0, 17, 3, 9]
+    for sample, expected in zip(ds.__getitems__(indices), [ds[i] for i in indices]):
+        assert sample.keys() == expected.keys()
+        for key, value in expected.items():
+            if isinstance(value, torch.Tensor):
+                assert torch.equal(sample[key], value), key
+            else:
+                assert sample[key] == value, key
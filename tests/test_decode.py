@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from generate import batch_greedy_decode, beam_search_decode, generate
+from model import build_transformer
+
+MAX_LEN = 40
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['unfused', 'fused'])
+def model(request, tokenizer):
+    torch.manual_seed(0)
+    return build_transformer(MAX_LEN, 1, tokenizer.get_vocab_size(), 768, fused_qkv=request.param,
+                             pad_idx=tokenizer.token_to_id("[PAD]")).eval()
+
+
+@pytest.fixture(scope='module')
+def images():
+    torch.manual_seed(1)
+    return torch.randn(3, 3, 224, 224)
+
+
+def test_cached_greedy_decode_matches_recompute(model, tokenizer, images):
+    # train.py needs the full training environment (torchtext, wandb)
+    pytest.importorskip('torchtext')
+    pytest.importorskip('wandb')
+    from train import greedy_decode
+
+    with torch.no_grad():
+        batched = batch_greedy_decode(model, images, tokenizer, MAX_LEN, 'cpu')
+        for image, expected in zip(images, batched):
+            source = image.unsqueeze(0)
+            cached = greedy_decode(model, source, None, tokenizer, MAX_LEN, 'cpu', use_cache=True)
+            recomputed = greedy_decode(model, source, None, tokenizer, MAX_LEN, 'cpu', use_cache=False)
+            assert torch.equal(cached, recomputed)
+            assert torch.equal(cached, expected)
+
+
+def test_beam_size_1_matches_greedy(model, tokenizer, images):
+    with torch.no_grad():
+        greedy = batch_greedy_decode(model, images, tokenizer, MAX_LEN, 'cpu')
+        beam = beam_search_decode(model, images, tokenizer, MAX_LEN, 'cpu', beam_size=1)
+        generated = generate(model, images, tokenizer, MAX_LEN, 'cpu', beam_size=1)
+    for g, b, out in zip(greedy, beam, generated):
+        assert torch.equal(g, b)
+        assert torch.equal(g, out)
@@ -0,0 +1,67 @@
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from model import build_transformer
+
+WORLD_SIZE = 2
+VOCAB_SIZE = 64
+
+
+def make_model_and_batch():
+    # the same model and global batch in every process, no [PAD] in the labels so every
+    # process averages its loss over the same number of tokens
+    torch.manual_seed(0)
+    model = build_transformer(8, 1, VOCAB_SIZE, 768, pad_idx=1, img_size=32).eval()
+    images = torch.randn(4, 3, 32, 32)
+    tokens = torch.randint(4, VOCAB_SIZE, (4, 8))
+    return model, images, tokens
+
+
+def _worker(rank, port, directory):
+    from distributed import all_reduce_mean, get_world_size, unwrap_model, wrap_model
+
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=WORLD_SIZE)
+    torch.set_num_threads(1)
+    try:
+        model, images, tokens = make_model_and_batch()
+        ddp_model = wrap_model(model, {'ddp_bucket_mb': 1})
+        assert get_world_size() == WORLD_SIZE and ddp_model is not model
+        # every process trains on its own rows of the global batch
+        rows = slice(rank, None, WORLD_SIZE)
+        loss = ddp_model(images[rows], tokens[rows], tokens[rows], 1, 0.1)
+        loss.backward()
+        grads = {name: p.grad.clone() for name, p in unwrap_model(ddp_model).named_parameters() if p.grad is not None}
+        torch.save({'loss': all_reduce_mean(loss.detach()), 'grads': grads}, os.path.join(directory, f'rank{rank}.pt'))
+    finally:
+        dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.skipif(not dist.is_available() or not dist.is_gloo_available(), reason='needs torch.distributed with gloo')
+def test_ddp_matches_single_process(tmp_path):
+    mp.spawn(_worker, args=(free_port(), str(tmp_path)), nprocs=WORLD_SIZE, join=True)
+
+    # one process on the combined batch
+    model, images, tokens = make_model_and_batch()
+    loss = model(images, tokens, tokens, 1, 0.1)
+    loss.backward()
+    for rank in range(WORLD_SIZE):
+        result = torch.load(tmp_path / f'rank{rank}.pt')
+        assert torch.allclose(result['loss'], loss.detach(), atol=1e-5)
+        grads = result['grads']
+        assert grads.keys() == {name for name, p in model.named_parameters() if p.grad is not None}
+        for name, p in model.named_parameters():
+            if p.grad is not None:
+                assert torch.allclose(grads[name], p.grad, atol=1e-5), name
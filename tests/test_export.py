@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from config import get_config
+from export import load_checkpoint_model, build_captioner, save_captioner, load_captioner, captioner_outputs
+from generate import batch_greedy_decode
+from model import build_transformer
+
+
+@pytest.fixture(scope='module')
+def checkpoint(tmp_path_factory, tokenizer):
+    # a checkpoint of the default get_config() model, like the ones train.py writes
+    config = get_config()
+    torch.manual_seed(0)
+    model = build_transformer(config['seq_len'], config['batch_size'], tokenizer.get_vocab_size(), config['d_model'],
+                              fused_qkv=config['fused_qkv'], pad_idx=tokenizer.token_to_id("[PAD]"),
+                              img_size=config['image_size'])
+    path = tmp_path_factory.mktemp('weights') / 'tmodel_00.pt'
+    torch.save({'epoch': 0, 'model_state_dict': model.state_dict()}, path)
+    return path
+
+
+def test_export_default_checkpoint(checkpoint, tokenizer, tmp_path):
+    config = get_config()
+    model = load_checkpoint_model(checkpoint, config, tokenizer)
+    special = [tokenizer.token_to_id(token) for token in ('[SOS]', '[EOS]', '[PAD]')]
+    images = torch.randn(2, 3, config['image_size'], config['image_size'])
+    max_len = 6
+    captioner = build_captioner(model, max_len, *special, backend='torchscript', example=images)
+    save_captioner(captioner, str(tmp_path / 'captioner.pt'), tokenizer.to_str())
+    captioner, tokenizer_json = load_captioner(str(tmp_path / 'captioner.pt'))
+    assert tokenizer_json == tokenizer.to_str()
+
+    with torch.no_grad():
+        expected = batch_greedy_decode(model, images, tokenizer, max_len, 'cpu')
+        outputs = captioner_outputs(*captioner(images))
+    for output, reference in zip(outputs, expected):
+        assert torch.equal(output, reference)
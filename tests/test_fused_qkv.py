@@ -0,0 +1,36 @@
+import torch
+
+from model import build_transformer, fuse_qkv_state_dict, unfuse_qkv_state_dict, load_model_state, is_fused_state_dict
+
+
+def test_fused_layout_round_trip(tokenizer):
+    vocab_size, pad_idx = tokenizer.get_vocab_size(), tokenizer.token_to_id("[PAD]")
+    torch.manual_seed(0)
+    baseline = build_transformer(16, 1, vocab_size, 768, pad_idx=pad_idx, img_size=32).eval()
+    fused = build_transformer(16, 1, vocab_size, 768, fused_qkv=True, pad_idx=pad_idx, img_size=32).eval()
+    state_dict = baseline.state_dict()
+    assert not is_fused_state_dict(state_dict)
+
+    # an unfused (baseline) state dict loads into the fused model and gives the same outputs
+    load_model_state(fused, state_dict)
+    assert is_fused_state_dict(fused.state_dict())
+    torch.manual_seed(1)
+    images = torch.randn(2, 3, 32, 32)
+    tokens = torch.randint(0, vocab_size, (2, 10))
+    with torch.no_grad():
+        expected = baseline.project(baseline.decode(tokens, None, None, baseline.encode(images, None)))
+        out = fused.project(fused.decode(tokens, None, None, fused.encode(images, None)))
+    assert torch.equal(out, expected)
+
+    # unfusing restores the original state dict exactly
+    restored = unfuse_qkv_state_dict(fused.state_dict())
+    assert restored.keys() == state_dict.keys()
+    for name, value in state_dict.items():
+        assert torch.equal(restored[name], value), name
+    assert fuse_qkv_state_dict(restored).keys() == fused.state_dict().keys()
+
+    # and a fused state dict loads back into an unfused model
+    other = build_transformer(16, 1, vocab_size, 768, pad_idx=pad_idx, img_size=32)
+    load_model_state(other, fused.state_dict())
+    for name, value in other.state_dict().items():
+        assert torch.equal(value, state_dict[name]), name
@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from dataset import ImagePreprocessor, VIT_IMAGE_MEAN, VIT_IMAGE_STD
+
+
+@pytest.fixture
+def vit_processor():
+    # the preprocessing of google/vit-base-patch16-224-in21k, built locally instead of downloaded
+    transformers = pytest.importorskip('transformers')
+    return transformers.ViTImageProcessor(do_resize=True, size={'height': 224, 'width': 224}, resample=2, do_rescale=True,
+                                          rescale_factor=1 / 255, do_normalize=True, image_mean=list(VIT_IMAGE_MEAN),
+                                          image_std=list(VIT_IMAGE_STD))
+
+
+def test_builtin_matches_vit_processor(caption_rows, vit_processor):
+    builtin = ImagePreprocessor(224)
+    for row in range(4):
+        image = caption_rows[row]['image']  # row 0 is grayscale
+        expected = vit_processor(image.convert('RGB'), return_tensors='pt')['pixel_values'][0]
+        pixels = builtin(image)
+        assert pixels.shape == expected.shape == (3, 224, 224)
+        # both resize with PIL bilinear, the rounding differs by at most one uint8 level (2 / 255 after std 0.5)
+        assert (pixels - expected).abs().max() <= 2 / 255 + 1e-5
+
+
+def test_batch_matches_single(caption_rows):
+    builtin = ImagePreprocessor(64)
+    images = [caption_rows[row]['image'] for row in range(5)]
+    assert torch.equal(builtin.batch(images), torch.stack([builtin(image) for image in images]))
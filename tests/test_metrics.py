@@ -0,0 +1,13 @@
+import torch
+
+from metrics import grad_norm
+
+
+def test_grad_norm():
+    model = torch.nn.Linear(4, 3)
+    norm = grad_norm(model.parameters())
+    assert norm.item() == 0 and norm.device == model.weight.device
+
+    model(torch.randn(2, 4)).sum().backward()
+    expected = torch.cat([p.grad.flatten() for p in model.parameters()]).norm()
+    assert torch.allclose(grad_norm(model.parameters()), expected)
@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from config import get_config
+from model import build_transformer
+from quantize import quantize_model, save_quantized, load_quantized
+
+
+@pytest.mark.parametrize('mode', ['dynamic', 'static'])
+def test_quantize_default_config(tokenizer, tmp_path, mode):
+    # the model_args quantize.py saves for the default get_config() model
+    config = get_config()
+    model_args = dict(seq_len=config['seq_len'], batch=config['batch_size'], target_vocab_size=tokenizer.get_vocab_size(),
+                      d_model=config['d_model'], attention_backend=config['attention_backend'],
+                      pad_idx=tokenizer.token_to_id("[PAD]"), img_size=config['image_size'])
+    torch.manual_seed(0)
+    model = build_transformer(**model_args).eval()
+    images = torch.randn(2, 3, config['image_size'], config['image_size'])
+    tokens = torch.randint(4, tokenizer.get_vocab_size(), (2, 10))
+    calibration = [{'encoder_input': images, 'decoder_input': tokens}]
+
+    quantized = quantize_model(model, mode, calibration, calibration_batches=1)
+    save_quantized(quantized, tmp_path / 'model.int8.pt', mode, model_args)
+    loaded = load_quantized(tmp_path / 'model.int8.pt')
+    with torch.no_grad():
+        expected = quantized.project(quantized(images, tokens))
+        output = loaded.project(loaded(images, tokens))
+        reference = model.project(model(images, tokens))
+    assert torch.equal(output, expected)
+    assert (output.exp() - reference.exp()).abs().max() < 0.1
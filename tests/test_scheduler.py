@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from generate import batch_greedy_decode
+from model import build_transformer
+from scheduler import ContinuousBatcher, continuous_greedy_decode
+
+
+@pytest.fixture(scope='module')
+def model(tokenizer):
+    torch.manual_seed(0)
+    return build_transformer(32, 1, tokenizer.get_vocab_size(), 768, pad_idx=tokenizer.token_to_id("[PAD]")).eval()
+
+
+def special_tokens(tokenizer):
+    return [tokenizer.token_to_id(token) for token in ('[SOS]', '[EOS]', '[PAD]')]
+
+
+@pytest.mark.parametrize('max_slots', [1, 3])
+def test_matches_batch_greedy_decode(model, tokenizer, max_slots):
+    torch.manual_seed(1)
+    images = torch.randn(4, 3, 224, 224)
+    with torch.no_grad():
+        expected = batch_greedy_decode(model, images, tokenizer, 6, 'cpu')
+    outputs = continuous_greedy_decode(model, list(images), max_slots, 6, *special_tokens(tokenizer))
+    for output, reference in zip(outputs, expected):
+        assert torch.equal(output, reference)
+
+
+def test_short_limits(model, tokenizer):
+    with pytest.raises(ValueError):
+        ContinuousBatcher(model, 2, 1, *special_tokens(tokenizer))
+    batcher = ContinuousBatcher(model, 2, 6, *special_tokens(tokenizer))
+    with pytest.raises(ValueError):
+        batcher.submit(torch.randn(3, 224, 224), 'too short', max_len=1)
+    batcher.submit(torch.randn(3, 224, 224), 'two tokens', max_len=2)
+    _, finished = batcher.step()
+    assert [(handle, len(tokens)) for handle, tokens in finished] == [('two tokens', 2)]
+    assert not batcher.pending()
+
+
+def test_failed_encode_keeps_the_handles(model, tokenizer):
+    batcher = ContinuousBatcher(model, 2, 6, *special_tokens(tokenizer))
+    for handle in 'abc':
+        batcher.submit(torch.randn(3, 224, 224), handle)
+
+    def failing(pixel_values):
+        raise RuntimeError('encode failed')
+    batcher.encode_step = failing
+    with pytest.raises(RuntimeError):
+        batcher.step()
+    assert sorted(batcher.reset()) == ['a', 'b', 'c']
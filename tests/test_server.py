@@ -0,0 +1,93 @@
+import asyncio
+import io
+import sys
+import time
+
+import pytest
+from PIL import Image
+
+from dataset import get_image_processor
+from server import CaptionServer, request, caption_images, main
+
+
+def image_bytes(size):
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), (size, 0, 0)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def run_server(caption_fn, client, max_batch_size=4, max_wait_ms=200.0):
+    # starts a CaptionServer on a free local port and runs client(server, port) against it
+    async def main():
+        server = CaptionServer(caption_fn, get_image_processor('builtin', 32), max_batch_size, max_wait_ms)
+        await server.start()
+        listener = await asyncio.start_server(server.handle_connection, '127.0.0.1', 0)
+        try:
+            return await client(server, listener.sockets[0].getsockname()[1])
+        finally:
+            listener.close()
+            await listener.wait_closed()
+            await server.stop()
+    return asyncio.run(main())
+
+
+def fake_captions(pixel_values):
+    time.sleep(0.01)
+    return [f'{len(pixel_values)} images, mean {float(image.mean()):.3f}' for image in pixel_values]
+
+
+def test_routes():
+    async def client(server, port):
+        return (await request('POST', '/caption', image_bytes(40), port=port),
+                await request('POST', '/caption', b'not an image', port=port),
+                await request('GET', '/nothing', port=port),
+                await request('GET', '/health', port=port),
+                await request('GET', '/metrics', port=port))
+
+    caption, bad_image, missing, health, metrics = run_server(fake_captions, client, max_wait_ms=1.0)
+    assert caption[0] == 200 and caption[1]['caption'].startswith('1 images')
+    assert bad_image[0] == 400 and 'cannot read the image' in bad_image[1]['error']
+    assert missing[0] == 404
+    assert health == (200, {'status': 'ok'})
+    assert metrics[0] == 200 and metrics[1]['total_ms']['count'] == 1
+
+
+def test_model_failure_is_a_server_error():
+    def failing(pixel_values):
+        raise ValueError('model failed')
+
+    async def client(server, port):
+        return await request('POST', '/caption', image_bytes(40), port=port)
+
+    status, result = run_server(failing, client, max_wait_ms=1.0)
+    assert status == 500 and 'model failed' in result['error']
+
+
+def test_concurrent_requests_are_batched():
+    images = [image_bytes(size) for size in range(20, 28)]
+
+    async def client(server, port):
+        results = await caption_images(images, concurrency=8, port=port)
+        return results, server.batch_sizes
+
+    results, batch_sizes = run_server(fake_captions, client, max_batch_size=4, max_wait_ms=500.0)
+    assert sum(size * count for size, count in batch_sizes.items()) == len(images)
+    assert max(batch_sizes) == 4
+    # every request gets the caption of its own image
+    expected = [fake_captions(get_image_processor('builtin', 32)(Image.open(io.BytesIO(data))).unsqueeze(0))[0]
+                for data in images]
+    assert [result['caption'].split(', ')[1] for result in results] == [caption.split(', ')[1] for caption in expected]
+
+
+@pytest.mark.parametrize('flags', [
+    ['--captioner', 'captioner.pt', '--scheduler', 'continuous'],
+    ['--captioner', 'captioner.pt', '--beam-size', '3'],
+    ['--captioner', 'captioner.pt', '--max-len', '20'],
+    ['--checkpoint', 'tmodel_00.pt', '--scheduler', 'continuous', '--beam-size', '3'],
+])
+def test_serve_rejects_ignored_flags(monkeypatch, capsys, flags):
+    monkeypatch.setattr(sys, 'argv', ['server.py', 'serve'] + flags)
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+    assert exit_info.value.code == 2
+    assert 'error:' in capsys.readouterr().err
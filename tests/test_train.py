@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+# train.py needs the full training environment (torchtext, wandb)
+pytest.importorskip('torchtext')
+pytest.importorskip('wandb')
+
+import train
+from config import get_config, get_weights_file_path
+from conftest import REPO, make_caption_rows
+
+
+@pytest.fixture
+def train_config(tmp_path, monkeypatch, tokenizer):
+    # 12 in-memory rows instead of HausaVG (10 training samples, 5 batches per epoch), nothing is sent to wandb
+    rows = make_caption_rows(12, tokenizer)
+    monkeypatch.setattr(train, 'load_dataset', lambda *args, **kwargs: rows)
+    monkeypatch.setattr(train, 'wandb', SimpleNamespace(login=lambda **kwargs: None, init=lambda **kwargs: None,
+                                                        config=SimpleNamespace(), log=lambda *args, **kwargs: None))
+    monkeypatch.chdir(tmp_path)
+    config = get_config()
+    config.update(tokenizer_file=str(REPO / 'vison.json'), batch_size=2, num_epochs=1, val_batch_size=2,
+                  val_max_samples=2, val_generate=False, log_every=1)
+    return config
+
+
+def test_resume_mid_epoch_gives_identical_weights(train_config):
+    train_config['checkpoint_every'] = 2
+    train.train_model(train_config)
+    expected = torch.load(get_weights_file_path(train_config, '00'))['model_state_dict']
+
+    # continue from the checkpoint after 2 of the 5 batches, the run ends with the same weights
+    train_config['preload'] = '00_0000002'
+    train.train_model(train_config)
+    resumed = torch.load(get_weights_file_path(train_config, '00'))['model_state_dict']
+    assert expected.keys() == resumed.keys()
+    for name in expected:
+        assert torch.equal(expected[name], resumed[name]), name
+
+
+def test_encoder_features_match_live_encoder(train_config):
+    train_config.update(freeze_encoder=True, encoder_features='features/encoder', encoder_features_dtype='float32')
+    train_dataloader, val_dataloader, tokenizer_tgt = train.get_ds(train_config)
+    model = train.get_model(train_config, tokenizer_tgt.get_vocab_size(), tokenizer_tgt.token_to_id("[PAD]"))
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=tokenizer_tgt.token_to_id("[PAD]"), label_smoothing=0.1)
+    live = next(iter(train_dataloader))
+
+    train.attach_encoder_features(train_config, model, train_dataloader, val_dataloader, 'cpu')
+    cached = next(iter(train_dataloader))
+    assert 'encoder_output' in cached and 'encoder_input' not in cached
+    losses = []
+    for batch in (live, cached):
+        torch.manual_seed(0)
+        losses.append(train.compute_loss(model, batch.get('encoder_input'), batch['decoder_input'], batch['label'],
+                                         loss_fn, train_config, batch.get('encoder_output')))
+    assert torch.equal(losses[0], losses[1])
+
+    # a store built with other encoder weights is rejected
+    with torch.no_grad():
+        model.encoder.norm.weight.add_(1)
+    with pytest.raises(ValueError, match='different encoder weights'):
+        train.attach_encoder_features(train_config, model, train_dataloader, val_dataloader, 'cpu')
+
+
+def test_validation_does_not_depend_on_batch_size(train_config, monkeypatch, tokenizer):
+    rows = make_caption_rows(40, tokenizer)  # 4 validation images
+    monkeypatch.setattr(train, 'load_dataset', lambda *args, **kwargs: rows)
+    train_config.update(seq_len=32, val_max_samples=None)
+    torch.manual_seed(0)
+    model = train.get_model(train_config, tokenizer.get_vocab_size(), tokenizer.token_to_id("[PAD]"))
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=tokenizer.token_to_id("[PAD]"), label_smoothing=0.1)
+    results = []
+    for val_batch_size in (1, 3, 8):
+        train_config['val_batch_size'] = val_batch_size
+        _, val_dataloader, _ = train.get_ds(train_config)
+        loss_sum, tokens, expected, predicted = train.validate(model, val_dataloader, tokenizer, train_config['seq_len'],
+                                                               'cpu', loss_fn=loss_fn)
+        results.append(((loss_sum / tokens).item(), expected, predicted))
+    for loss, expected, predicted in results[1:]:
+        assert loss == pytest.approx(results[0][0], rel=1e-5)
+        assert expected == results[0][1] and predicted == results[0][2]
+    assert len(results[0][1]) == 4
@@ -1,11 +1,15 @@
-from model import build_transformer
-from dataset import BilingualDataset, causal_mask
+from model import build_transformer, load_model_state, is_fused_state_dict, precision_context
+from dataset import BilingualDataset, causal_mask, ImageCache, TensorStore, build_image_cache, CaptionStore, build_caption_store, FeatureStore, build_encoder_features, write_shards, ShardedCaptionDataset, BucketBatchSampler, ResumableBatchSampler, SubsetSampler, get_collate_fn, dataloader_kwargs, get_image_processor
 from config import get_config, get_weights_file_path
+from generate import batch_greedy_decode, decode_captions
+from metrics import MetricsLogger, grad_norm, layer_grad_means
+from checkpoint import AsyncCheckpointer, get_rng_state, set_rng_state, shard_path, latest_checkpoint
+from distributed import setup_distributed, cleanup_distributed, get_rank, get_world_size, is_main_process, barrier, wrap_model, unwrap_model, no_sync, all_reduce_mean, all_reduce_sum, all_gather_objects
 
 import torchtext.datasets as datasets
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, IterableDataset, DataLoader, random_split, DistributedSampler, BatchSampler
 from torch.optim.lr_scheduler import LambdaLR
 from torch.optim.lr_scheduler import StepLR
 
@@ -15,40 +19,47 @@ import os
 from pathlib import Path
 
 # Huggingface datasets and tokenizers
-from datasets import load_dataset, concatenate_datasets
+from datasets import load_dataset, concatenate_datasets, Image as HFImage
 from tokenizers import Tokenizer
 from tokenizers.models import WordLevel
 from tokenizers.trainers import WordLevelTrainer
 from tokenizers.pre_tokenizers import Whitespace
 
 import torchmetrics
+import torchmetrics.text
 import matplotlib.pyplot as plt
 
 import wandb
 from torch.utils.tensorboard import SummaryWriter
 # from accelerate import Accelerator
 
-def greedy_decode(model, source, source_mask, tokenizer_tgt, max_len, device):
+def greedy_decode(model, source, source_mask, tokenizer_tgt, max_len, device, use_cache=True):
     sos_idx = tokenizer_tgt.token_to_id("[SOS]")
     eos_idx = tokenizer_tgt.token_to_id("[EOS]")
 
     # Precompute the encoder output and reuse it for every step
     encoder_output = model.encode(source, None)
+    # With the cache the decoder only runs on the newest token, the keys/values of
+    # the previous tokens are kept per layer instead of being recomputed every step.
+    # The cross-attention keys/values of the image are projected once here either way
+    cache = model.init_cache(encoder_output, self_attention=use_cache)
     # Initialize the decoder input with the sos token
     decoder_input = torch.empty(1, 1).fill_(sos_idx).long().to(device)
     while True:
         if decoder_input.size(1) == max_len:
             break
-        # build mask for target
-        decoder_mask = causal_mask(decoder_input.size(1)).long().to(device)
-      
 
         # calculate output
-        out =model.decode(decoder_input,None,  decoder_mask, encoder_output)
-     
+        if use_cache:
+            # the newest token may attend to every cached position, so no mask is needed
+            out = model.decode(decoder_input[:, -1:], None, None, encoder_output, cache)
+        else:
+            # build mask for target
+            decoder_mask = causal_mask(decoder_input.size(1)).long().to(device)
+            out = model.decode(decoder_input, None, decoder_mask, encoder_output, cache)
 
         # get next token
-        prob = model.project(out[:, -1])
+        prob = model.project_last(out)
         _, next_word = torch.max(prob, dim=1)
      
         decoder_input = torch.cat(
@@ -61,14 +72,51 @@ def greedy_decode(model, source, source_mask, tokenizer_tgt, max_len, device):
     return decoder_input.squeeze(0)
 
 
-def run_validation(model, validation_ds, tokenizer_tgt, max_len, device, print_msg, global_step,num_examples=3):
+def validate(model, validation_ds, tokenizer_tgt, max_len, device, precision='fp32', loss_fn=None, loss_chunk_size: int = 1024,
+             generate_captions: bool = True):
+    # One batched pass over the validation loader. Every image is encoded once, the encoder output is
+    # used for the teacher-forced loss (when loss_fn is given) and for greedy caption generation.
+    # Returns the loss summed over the label tokens and the number of label tokens (device tensors,
+    # so the mean does not depend on the batch size), the reference captions and the generated ones
     model.eval()
-    count = 0
-
-    source_texts = []
+    loss_sum = torch.zeros((), device=device)
+    tokens = torch.zeros((), device=device)
     expected = []
     predicted = []
-
+    with torch.no_grad(), precision_context(device, precision):
+        for batch in validation_ds:
+            if 'encoder_output' in batch:
+                # precomputed by the frozen encoder
+                encoder_output = batch['encoder_output'].to(device) # (B, patches, d_model)
+            else:
+                encoder_input = batch["encoder_input"].to(device) # (B, 3, img_size, img_size)
+                encoder_output = model.encode(encoder_input, None)
+            if loss_fn is not None:
+                decoder_input = batch['decoder_input'].to(device) # (B, seq_len)
+                label = batch['label'].to(device) # (B, seq_len)
+                decoder_output = model.decode(decoder_input, None, None, encoder_output)
+                # the loss is the mean over the [PAD]-free label tokens of the batch
+                loss = model.project_loss(decoder_output, label, loss_fn.ignore_index, loss_fn.label_smoothing, loss_chunk_size)
+                batch_tokens = (label != loss_fn.ignore_index).sum()
+                loss_sum += loss.detach() * batch_tokens
+                tokens += batch_tokens
+            if generate_captions:
+                model_out = batch_greedy_decode(model, None, tokenizer_tgt, max_len, device, encoder_output=encoder_output)
+                expected.extend(batch["tgt_text"])
+                predicted.extend(decode_captions(tokenizer_tgt, model_out))
+    return loss_sum, tokens, expected, predicted
+
+
+def caption_metrics(predicted, expected):
+    # character/word error rate and BLEU over all captions at once
+    return {
+        'validation cer': torchmetrics.text.CharErrorRate()(predicted, expected).item(),
+        'validation wer': torchmetrics.text.WordErrorRate()(predicted, expected).item(),
+        'validation BLEU': torchmetrics.text.BLEUScore()(predicted, [[text] for text in expected]).item(),
+    }
+
+
+def print_examples(expected, predicted, print_msg, num_examples=3):
     try:
         # get the console window width
         with os.popen('stty size', 'r') as console:
@@ -78,66 +126,43 @@ def run_validation(model, validation_ds, tokenizer_tgt, max_len, device, print_m
         # If we can't get the console width, use 80 as default
         console_width = 80
 
-    with torch.no_grad():
-        for batch in validation_ds:
-            count += 1
-            encoder_input = batch["encoder_input"].to(device) # (b, seq_len)
-            encoder_mask = batch["encoder_mask"].to(device) # (b, 1, 1, seq_len)
-
-            # check that the batch size is 1
-            assert encoder_input.size(
-                0) == 1, "Batch size must be 1 for validation"
-
-            model_out = greedy_decode(model, encoder_input, None, tokenizer_tgt, max_len, device)
-
-            # source_text = batch["src_text"][0]
-            target_text = batch["tgt_text"][0]
-            model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
-
-            # source_texts.append(source_text)
-            expected.append(target_text)
-            predicted.append(model_out_text)
-            
-            # Print the source, target and model output
-            print_msg('-'*console_width)
-            # print_msg(f"{f'SOURCE: ':>12}{source_text}")
-            print_msg(f"{f'TARGET: ':>12}{target_text}")
-            print_msg(f"{f'PREDICTED: ':>12}{model_out_text}")
-
-            if count == num_examples:
-                print_msg('-'*console_width)
-                break
-    
-    # if writer:
-    #     # Evaluate the character error rate
-    #     # Compute the char error rate 
-    #     metric = torchmetrics.CharErrorRate()
-    #     cer = metric(predicted, expected)
-    #     writer.add_scalar('validation cer', cer, global_step)
-    #     writer.flush()
-
-    #     # Compute the word error rate
-    #     metric = torchmetrics.WordErrorRate()
-    #     wer = metric(predicted, expected)
-    #     writer.add_scalar('validation wer', wer, global_step)
-    #     writer.flush()
-
-    #     # Compute the BLEU metric
-    #     metric = torchmetrics.BLEUScore()
-    #     bleu = metric(predicted, expected)
-    #     writer.add_scalar('validation BLEU', bleu, global_step)
-    #     writer.flush()
+    for target_text, model_out_text in list(zip(expected, predicted))[:num_examples]:
+        # Print the target and model output
+        print_msg('-'*console_width)
+        print_msg(f"{f'TARGET: ':>12}{target_text}")
+        print_msg(f"{f'PREDICTED: ':>12}{model_out_text}")
+    print_msg('-'*console_width)
+
+
+def run_validation(model, validation_ds, tokenizer_tgt, max_len, device, print_msg, global_step,num_examples=3, precision='fp32',
+                   writer=None):
+    # batched greedy captions for the whole validation loader, a few of them are printed
+    # and CER/WER/BLEU over all of them are written to TensorBoard
+    _, _, expected, predicted = validate(model, validation_ds, tokenizer_tgt, max_len, device, precision)
+    print_examples(expected, predicted, print_msg, num_examples)
+    metrics = caption_metrics(predicted, expected)
+    if writer:
+        for name, value in metrics.items():
+            writer.add_scalar(name, value, global_step)
+        writer.flush()
+    return metrics
+
+def compute_loss(model, encoder_input, decoder_input, label, loss_fn, config, encoder_output=None):
+    # Encoder, decoder and loss in one model forward, which is what DistributedDataParallel needs.
+    # With loss_chunk_size the projection and the cross entropy are fused and chunked, so the
+    # (B, seq_len, vocab_size) log-probs are never materialized and [PAD] positions are skipped,
+    # loss_chunk_size=0 is the full projection followed by the cross entropy.
+    # encoder_output skips the encoder when the batch carries precomputed features
+    return model(encoder_input, decoder_input, label, loss_fn.ignore_index, loss_fn.label_smoothing, config['loss_chunk_size'],
+                 encoder_output=encoder_output)
 
 def get_all_sentences(ds, lang):
     for item in ds:
         yield item[lang]
-def plot_grad_flow(named_parameters):
-    ave_grads = []
-    layers = []
-    for n, p in named_parameters:
-        if(p.requires_grad) and ("bias" not in n) and p.grad is not None:
-            layers.append(n)
-            ave_grads.append(p.grad.abs().mean().item())
+def plot_grad_flow(named_parameters, path='graph.png'):
+    # the per-layer means are read back from the device in one go
+    layers, ave_grads = layer_grad_means(named_parameters)
+    ave_grads = ave_grads.tolist()
     plt.plot(ave_grads, alpha=0.3, color="b")
     plt.hlines(0, 0, len(ave_grads)+1, linewidth=1, color="k" )
     plt.xticks(range(0,len(ave_grads), 1), layers, rotation="vertical")
@@ -146,7 +171,7 @@ def plot_grad_flow(named_parameters):
     plt.ylabel("average gradient")
     plt.title("Gradient flow")
     plt.grid(True)
-    plt.savefig('graph.png')
+    plt.savefig(path)
 def batch_iterator(data):
     for i in range(0, len(data)):
         yield data[i]['en_text'] 
@@ -169,7 +194,17 @@ def get_or_build_tokenizer(config, ds,):
         tokenizer = Tokenizer.from_file(str(tokenizer_path))
     return tokenizer
 
+def split_ds(ds_raw, seed):
+    torch.manual_seed(seed)
+    # Keep 90% for training, 10% for validation
+    train_ds_size = int(0.9 * len(ds_raw))
+    val_ds_size = len(ds_raw) - train_ds_size
+    return random_split(ds_raw, [train_ds_size, val_ds_size])
+
+
 def get_ds(config):
+    if config['shard_dir']:
+        return get_sharded_ds(config)
     # It only has the train split, so we divide it overselves
     # ds_raw = load_dataset(path="youssef101/artelingo", name='artelingo', splits=['val','test'])
     # ds_raw = concatenate_datasets([ds_raw['val'], ds_raw['test']])
@@ -180,14 +215,40 @@ def get_ds(config):
     # tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
     tokenizer_tgt = get_or_build_tokenizer(config, ds_raw)
     seed = 20  # You can choose any integer as your seed
-    torch.manual_seed(seed)
-    # Keep 90% for training, 10% for validation
-    train_ds_size = int(0.9 * len(ds_raw))
-    val_ds_size = len(ds_raw) - train_ds_size
-    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
-
-    train_ds = BilingualDataset(train_ds_raw, tokenizer_tgt,  config['seq_len'])
-    val_ds = BilingualDataset(val_ds_raw,  tokenizer_tgt, config['seq_len'])
+    train_ds_raw, val_ds_raw = split_ds(ds_raw, seed)
+
+    # built-in (torch/PIL) or transformers image preprocessing, both give the ViT pixel_values
+    image_processor = get_image_processor(config['image_processor'], config['image_size'])
+
+    # Preprocessed images are written once to a memory-mapped cache and then served from it,
+    # a cache built with other preprocessing settings is built again
+    image_cache = None
+    if config['image_cache']:
+        if TensorStore.exists(config['image_cache']):
+            image_cache = ImageCache(config['image_cache'])
+            if not image_cache.matches(image_processor, config['image_cache_dtype'], len(ds_raw)):
+                print(f"{config['image_cache']} does not match the image processor settings, rebuilding it")
+                image_cache = None
+        if image_cache is None:
+            image_cache = build_image_cache(ds_raw, config['image_cache'], config['image_cache_dtype'], image_processor)
+
+    # Captions are tokenized once into a flat id array with a length index,
+    # a store built with another tokenizer is built again
+    caption_store = None
+    if config['caption_store']:
+        if CaptionStore.exists(config['caption_store']):
+            caption_store = CaptionStore(config['caption_store'])
+            if not caption_store.matches(tokenizer_tgt, len(ds_raw)):
+                print(f"{config['caption_store']} was built with another tokenizer, rebuilding it")
+                caption_store = None
+        if caption_store is None:
+            caption_store = build_caption_store(ds_raw, tokenizer_tgt, config['caption_store'])
+
+    # With dynamic padding every batch is only padded to its longest caption instead of seq_len
+    pad_to_seq_len = not config['dynamic_padding']
+    train_ds = BilingualDataset(train_ds_raw, tokenizer_tgt,  config['seq_len'], image_cache, caption_store, pad_to_seq_len, image_processor)
+    val_ds = BilingualDataset(val_ds_raw,  tokenizer_tgt, config['seq_len'], image_cache, caption_store, pad_to_seq_len, image_processor)
+    collate_fn = get_collate_fn(tokenizer_tgt.token_to_id("[PAD]")) if config['dynamic_padding'] else None
 
     # # Find the maximum length of each sentence in the source and target sentence
     # max_len_src = 0
@@ -203,34 +264,150 @@ def get_ds(config):
     # print(f'Max length of target sentence: {max_len_tgt}')
     
 
-    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True)
-    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
+    # workers, pinned memory and prefetching from get_config()
+    loader_kwargs = dataloader_kwargs(config)
+    # in a distributed run every process loads its own 1/world_size of the batches,
+    # batch_size stays the per-process batch size
+    rank, world_size = get_rank(), get_world_size()
+    # The training order only depends on seed and epoch (set_epoch), so a resumed run can skip
+    # the batches it already trained on
+    if config['bucket_batching']:
+        # batches of captions with similar length, the order is reshuffled every epoch with set_epoch
+        batch_sampler = BucketBatchSampler(train_ds.caption_lengths(), config['batch_size'],
+                                           bucket_size_multiplier=config['bucket_size_multiplier'], seed=seed,
+                                           num_replicas=world_size, rank=rank)
+    else:
+        train_sampler = DistributedSampler(train_ds, world_size, rank, shuffle=True, seed=seed)
+        batch_sampler = BatchSampler(train_sampler, config['batch_size'], drop_last=False)
+    # with its own generator the DataLoader does not draw its worker seeds from the global RNG,
+    # which is part of the checkpoint
+    train_dataloader = DataLoader(train_ds, batch_sampler=ResumableBatchSampler(batch_sampler), collate_fn=collate_fn,
+                                  generator=torch.Generator().manual_seed(seed), **loader_kwargs)
+    # Validation runs in batches of val_batch_size on the whole split in order, or on the same
+    # random subset of val_max_samples images every epoch
+    val_sampler = SubsetSampler(len(val_ds), config['val_max_samples'], seed, world_size, rank)
+    val_dataloader = DataLoader(val_ds, batch_size=config['val_batch_size'], sampler=val_sampler, collate_fn=collate_fn, **loader_kwargs)
 
     return train_dataloader, val_dataloader, tokenizer_tgt
 
-def get_model(config,  vocab_tgt_len):
-    model = build_transformer( config['seq_len'],config['batch_size'], vocab_tgt_len, config['d_model'] )
+
+def get_sharded_ds(config):
+    # Streaming mode: the samples are read sequentially from Arrow shards instead of indexing the whole
+    # dataset. The first run writes the shards of the same 90/10 split as get_ds (images still encoded),
+    # later runs only need the shard directory and the tokenizer
+    seed = 20
+    train_dir, val_dir = Path(config['shard_dir']) / 'train', Path(config['shard_dir']) / 'val'
+    if not (ShardedCaptionDataset.exists(train_dir) and ShardedCaptionDataset.exists(val_dir)):
+        if is_main_process():
+            ds_raw = load_dataset("HausaNLP/HausaVG", split='train+validation+test+challenge_test')
+            get_or_build_tokenizer(config, ds_raw)
+            train_ds_raw, val_ds_raw = split_ds(ds_raw, seed)
+            # the image files are copied as they are instead of being decoded and encoded again
+            ds_raw = ds_raw.cast_column('image', HFImage(decode=False))
+            write_shards(ds_raw, train_ds_raw.indices, train_dir, config['shard_rows'])
+            write_shards(ds_raw, val_ds_raw.indices, val_dir, config['shard_rows'])
+        barrier()
+    # the model is initialized from the same global seed as after get_ds, whether the shards were written or not
+    torch.manual_seed(seed)
+    tokenizer_tgt = Tokenizer.from_file(str(Path(config['tokenizer_file'])))
+
+    image_processor = get_image_processor(config['image_processor'], config['image_size'])
+    pad_to_seq_len = not config['dynamic_padding']
+    collate_fn = get_collate_fn(tokenizer_tgt.token_to_id("[PAD]")) if config['dynamic_padding'] else None
+    loader_kwargs = dataloader_kwargs(config)
+    # the workers get a fresh copy of the dataset every epoch, with its epoch and the batches to skip
+    if 'persistent_workers' in loader_kwargs:
+        loader_kwargs['persistent_workers'] = False
+    rank, world_size = get_rank(), get_world_size()
+    # the datasets split the shards between the processes and workers themselves and keep the
+    # training order (set_epoch, skip) like ResumableBatchSampler
+    train_ds = ShardedCaptionDataset(train_dir, tokenizer_tgt, config['seq_len'], image_processor, pad_to_seq_len,
+                                     config['shuffle_buffer'], True, seed, world_size, rank, config['batch_size'],
+                                     config['num_workers'])
+    # the whole split in order, or the same random subset of val_max_samples images every epoch (the
+    # dataset stays at epoch 0)
+    val_ds = ShardedCaptionDataset(val_dir, tokenizer_tgt, config['seq_len'], image_processor, pad_to_seq_len,
+                                   config['shuffle_buffer'], config['val_max_samples'] is not None, seed, world_size,
+                                   rank, num_workers=config['num_workers'], max_samples=config['val_max_samples'])
+    # its own generator keeps the global RNG (part of the checkpoint) untouched, like in get_ds
+    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], collate_fn=collate_fn,
+                                  generator=torch.Generator().manual_seed(seed), **loader_kwargs)
+    val_dataloader = DataLoader(val_ds, batch_size=config['val_batch_size'], collate_fn=collate_fn, **loader_kwargs)
+
+    return train_dataloader, val_dataloader, tokenizer_tgt
+
+
+def save_checkpoint(checkpointer, config, tag, model, optimizer, epoch, global_step, batch_in_epoch=None):
+    # Every process writes its RNG state to its own shard, rank 0 also writes the model/optimizer file.
+    # batch_in_epoch is the number of batches of the epoch that were trained on, None after a full epoch
+    model_filename = get_weights_file_path(config, tag)
+    files = {shard_path(model_filename, get_rank()): {'rng_state': get_rng_state()}}
+    if is_main_process():
+        files[model_filename] = {
+            'epoch': epoch,
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'global_step': global_step,
+            'batch_in_epoch': batch_in_epoch,
+            # the batch position is per process, it only fits a run with the same number of processes
+            'world_size': get_world_size(),
+            # the weights are fp32 in both precisions, this only records how the run was trained
+            'precision': config['precision'],
+        }
+    checkpointer.save(files)
+
+def get_model(config,  vocab_tgt_len, pad_idx=None):
+    model = build_transformer( config['seq_len'],config['batch_size'], vocab_tgt_len, config['d_model'],
+                               attention_backend=config['attention_backend'], fused_qkv=config['fused_qkv'], pad_idx=pad_idx,
+                               img_size=config['image_size'] )
+    model.set_gradient_checkpointing(config['activation_checkpointing'])
+    if config['freeze_encoder']:
+        model.freeze_encoder()
     return model
 
-def train_model(config):
-    wandb.login(key = 'c20a1022142595d7d1324fdc53b3ccb34c0ded22')
-    wandb.init(project="Vision", name=config['project_name'])
+def attach_encoder_features(config, model, train_dataloader, val_dataloader, device):
+    # The frozen encoder gives the same output for an image every epoch, so it runs once over the
+    # whole dataset and the loaders serve its output instead of the images. Rank 0 builds the store,
+    # every process checks that it was built with the weights of this model
+    if not config['freeze_encoder']:
+        raise ValueError('encoder_features needs freeze_encoder, a trained encoder would make the features stale')
+    if config['shard_dir']:
+        raise ValueError('encoder_features needs the map-style dataset, it cannot be combined with shard_dir')
+    path = config['encoder_features']
+    if is_main_process() and not TensorStore.exists(path):
+        build_encoder_features(model, train_dataloader.dataset, path, config['encoder_features_dtype'],
+                               config['encoder_features_batch_size'], device)
+    barrier()
+    feature_store = FeatureStore(path)
+    if feature_store.index['encoder'] != model.encoder_fingerprint():
+        raise ValueError(f'{path} was built with different encoder weights, delete it to build it again')
+    train_dataloader.dataset.set_encoder_features(feature_store)
+    val_dataloader.dataset.set_encoder_features(feature_store)
 
-    # Initialize WandB configuration
-    wandb.config.epochs = config['num_epochs']
-    wandb.config.batch_size = config['batch_size']
-    wandb.config.learning_rate = config['lr'] 
+def train_model(config):
+    # joins the torchrun process group, a plain `python train.py` stays a single process
+    rank, local_rank, world_size = setup_distributed(config)
+    main_process = is_main_process()
+    if main_process:
+        wandb.login(key = 'c20a1022142595d7d1324fdc53b3ccb34c0ded22')
+        wandb.init(project="Vision", name=config['project_name'])
+
+        # Initialize WandB configuration
+        wandb.config.epochs = config['num_epochs']
+        wandb.config.batch_size = config['batch_size'] * world_size
+        wandb.config.learning_rate = config['lr'] 
     # Define the device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print("Using device:", device)
+    device = torch.device(f"cuda:{local_rank}" if torch.cuda.is_available() else "cpu")
+    if main_process:
+        print("Using device:", device, "processes:", world_size)
 
     # Make sure the weights folder exists
     Path(config['model_folder']).mkdir(parents=True, exist_ok=True)
 
     train_dataloader, val_dataloader, tokenizer_tgt = get_ds(config)
-    model = get_model(config, tokenizer_tgt.get_vocab_size()).to(device)
+    model = get_model(config, tokenizer_tgt.get_vocab_size(), tokenizer_tgt.token_to_id("[PAD]")).to(device)
     # Tensorboard
-    writer = SummaryWriter(config['experiment_name'])
+    writer = SummaryWriter(config['experiment_name']) if main_process else None
 
     optimizer = torch.optim.Adam(model.parameters(), lr=5e-5, eps=1e-9)
     scheduler = StepLR(optimizer, step_size=1000, gamma=0.95) 
@@ -238,104 +415,147 @@ def train_model(config):
     # If the user specified a model to preload before training, load it
     initial_epoch = 0
     global_step = 0
-    if config['preload']:
-        model_filename = get_weights_file_path(config, config['preload'])
+    start_batch = 0  # batches of initial_epoch that were already trained on
+    resume_rng = None
+    preload = latest_checkpoint(config) if config['preload'] == 'latest' else config['preload']
+    if config['preload'] == 'latest' and preload is None:
+        print('No checkpoint to resume from, starting from scratch')
+    if preload:
+        model_filename = get_weights_file_path(config, preload)
         print(f'Preloading model {model_filename}')
         state = torch.load(model_filename)
-        model.load_state_dict(state['model_state_dict'])
+        load_model_state(model, state['model_state_dict'])
         initial_epoch = state['epoch'] + 1
-        optimizer.load_state_dict(state['optimizer_state_dict'])
+        # the optimizer state only fits when the checkpoint has the same QKV layout as the model
+        if 'optimizer_state_dict' in state and is_fused_state_dict(state['model_state_dict']) == config['fused_qkv']:
+            optimizer.load_state_dict(state['optimizer_state_dict'])
+        else:
+            print('Checkpoint has a different QKV layout, starting with a fresh optimizer state')
         global_step = state['global_step']
 
+        # mid-epoch checkpoints continue with the next batch of the same epoch, with the RNG state they stopped at
+        same_processes = state.get('world_size', 1) == world_size
+        if state.get('batch_in_epoch') is not None:
+            initial_epoch = state['epoch']
+            start_batch = state['batch_in_epoch'] if same_processes else 0
+            if not same_processes:
+                print(f"Checkpoint was written by {state['world_size']} processes, restarting epoch {initial_epoch} from its first batch")
+        rng_filename = shard_path(model_filename, rank)
+        if same_processes and os.path.exists(rng_filename):
+            resume_rng = torch.load(rng_filename, weights_only=False)['rng_state']
+
+    if config['encoder_features']:
+        attach_encoder_features(config, model, train_dataloader, val_dataloader, device)
+
+    # DistributedDataParallel starts from the weights of rank 0 and all-reduces the gradients during backward,
+    # raw_model is the Transformer itself for everything that is not the training forward
+    model = wrap_model(model, config)
+    raw_model = unwrap_model(model)
+
     loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_tgt.token_to_id("[PAD]"), label_smoothing=0.1).to(device)
- 
 
+    # losses and gradient statistics are accumulated on the device and written every log_every steps
+    # the logged values are averaged over all processes, only rank 0 writes them
+    metrics = MetricsLogger(writer, wandb.log if main_process else None, config['log_every'], config['log_in_background'],
+                            names={'train loss': 'Training Loss', 'grad norm': 'Gradient Norm'}, reduce_fn=all_reduce_mean)
+
+    # checkpoints are snapshotted to the CPU and written by a background thread, only the newest
+    # keep_last_checkpoints of this run are kept
+    checkpointer = AsyncCheckpointer(config['keep_last_checkpoints'], config['async_checkpoint'])
+    if resume_rng is not None:
+        # dropout continues with the random numbers it would have used without the interruption
+        set_rng_state(resume_rng)
+
+    # the epoch order is kept by the samplers, or by the datasets themselves when they stream shards
+    streaming = isinstance(train_dataloader.dataset, IterableDataset)
+    train_order = train_dataloader.dataset if streaming else train_dataloader.batch_sampler
     for epoch in range(initial_epoch, config['num_epochs']):
         model.train()
-        batch_iterator = tqdm(train_dataloader, desc=f"Processing Epoch {epoch:02d}")
-        for batch in batch_iterator:
+        train_order.set_epoch(epoch)
+        # a resumed epoch skips the batches that were trained on before the checkpoint
+        train_order.skip(start_batch)
+        batch_iterator = tqdm(train_dataloader, desc=f"Processing Epoch {epoch:02d}", initial=start_batch, disable=not main_process)
+        # the gradients of grad_accum_steps micro-batches are summed before every optimizer step,
+        # the effective batch size is batch_size * grad_accum_steps
+        accum_steps = config['grad_accum_steps']
+        optimizer.zero_grad(set_to_none=True)
+        for micro_step, batch in enumerate(batch_iterator, start_batch):
             # run_validation(model, val_dataloader, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step)
-            optimizer.zero_grad()
 
-            encoder_input = batch['encoder_input'].to(device) # (b, seq_len)
+            # either the images or the output of the frozen encoder for them
+            encoder_input = batch['encoder_input'].to(device) if 'encoder_input' in batch else None # (b, seq_len)
+            encoder_output = batch['encoder_output'].to(device) if 'encoder_output' in batch else None # (B, patches, d_model)
             decoder_input= batch['decoder_input'].to(device) # (B, seq_len)
-            encoder_mask = batch['encoder_mask'].to(device) # (B, 1, 1, seq_len)
-            decoder_mask = batch['decoder_mask'].to(device) # (B, 1, seq_len, seq_len)
-
-            # Run the tensors through the encoder, decoder and the projection layer
-           
-            encoder_output = model.encode(encoder_input, None) # (B, seq_len, d_model)
-            decoder_output = model.decode( decoder_input,None,  decoder_mask, encoder_output) # (B, seq_len, d_model)
-            proj_output = model.project(decoder_output)
-           
-             # (B, seq_len, vocab_size)
-
             # Compare the output with the label
             label = batch['label'].to(device) # (B, seq_len)
 
-            # Compute the loss using a simple cross entropy
-       
-            loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
-            batch_iterator.set_postfix({"loss": f"{loss.item():6.3f}"})
+            # the gradients are only all-reduced between the processes on the last micro-batch of a step
+            sync = (micro_step + 1) % accum_steps == 0 or micro_step + 1 == len(train_dataloader)
+            # the last group of the epoch can have fewer than accum_steps micro-batches
+            group_start = micro_step - micro_step % accum_steps
+            group_size = min(accum_steps, len(train_dataloader) - group_start)
 
-            # Log the loss
-            writer.add_scalar('train loss', loss.item(), global_step)
-            wandb.log({"Training Loss": loss.item(), "Global Step": global_step})
-            writer.flush()
-
-            # Backpropagate the loss
-            loss.backward()
-            plot_grad_flow(model.named_parameters())
+            with no_sync(model, sync):
+                # Run the tensors through the encoder, decoder and the projection layer
+                with precision_context(device, config['precision']):
+                    # the causal/padding mask is derived from decoder_input inside the model,
+                    # the loss is a simple cross entropy
+                    loss = compute_loss(model, encoder_input, decoder_input, label, loss_fn, config, encoder_output)
+                metrics.add('train loss', loss)
+
+                # Backpropagate the loss, scaled so the accumulated gradient is the mean over the micro-batches
+                (loss / group_size).backward()
+            if not sync:
+                continue
+
+            if config['log_grad_norm']:
+                metrics.add('grad norm', grad_norm(model.parameters()))
+            if config['grad_flow_every'] and global_step % config['grad_flow_every'] == 0 and main_process:
+                plot_grad_flow(model.named_parameters())
 
             # Update the weights
             optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
             # scheduler.step()
             
 
             global_step += 1
-        model.eval()
-        eval_loss = 0.0
-        # batch_iterator = tqdm(v_dataloader, desc=f"Processing Epoch {epoch:02d}")
-        with torch.no_grad():
-            for batch in val_dataloader:
-            
-
-                encoder_input = batch['encoder_input'].to(device) # (b, seq_len)
-                decoder_input = batch['decoder_input'].to(device) # (B, seq_len)
-                encoder_mask = batch['encoder_mask'].to(device) # (B, 1, 1, seq_len)
-                decoder_mask = batch['decoder_mask'].to(device) # (B, 1, seq_len, seq_len)
-
-                # Run the tensors through the encoder, decoder and the projection layer
-            
-                encoder_output = model.encode(encoder_input, None) # (B, seq_len, d_model)
-                decoder_output = model.decode( decoder_input,None,  decoder_mask, encoder_output) # (B, seq_len, d_model)
-                proj_output = model.project(decoder_output)
-            
-                # (B, seq_len, vocab_size)
-
-                # Compare the output with the label
-                label = batch['label'].to(device) # (B, seq_len)
-
-                # Compute the loss using a simple cross entropy
-        
-                eval_loss += loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
-           
-                
-        avg_val_loss = eval_loss / len(val_dataloader)
-        print(f'Epoch {epoch},Validation Loss: {avg_val_loss.item()}')
-        wandb.log({"Validation Loss": avg_val_loss.item(), "Global Step": global_step})
-
-        # Save the model at the end of every epoch
-        model_filename = get_weights_file_path(config, f"{epoch:02d}")
-        torch.save({
-            'epoch': epoch,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'global_step': global_step
-        }, model_filename)
-
-        # Run validation at the end of every epoch
-        run_validation(model, val_dataloader, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step)
+            # Log the loss
+            if metrics.step(global_step):
+                batch_iterator.set_postfix({"loss": f"{metrics.last['train loss']:6.3f}"})
+            # mid-epoch checkpoints are only taken on optimizer steps, so no gradients are half accumulated
+            if config['checkpoint_every'] and global_step % config['checkpoint_every'] == 0:
+                save_checkpoint(checkpointer, config, f"{epoch:02d}_{global_step:07d}", raw_model, optimizer,
+                                epoch, global_step, micro_step + 1)
+        start_batch = 0
+        metrics.flush(global_step)
+        # Run validation at the end of every epoch: loss and greedy captions in one batched pass
+        loss_sum, tokens, expected, predicted = validate(raw_model, val_dataloader, tokenizer_tgt, config['seq_len'], device,
+                                                          config['precision'], loss_fn, config['loss_chunk_size'],
+                                                          generate_captions=config['val_generate'])
+        # every process validated its own part of the validation set
+        loss_sum, tokens = all_reduce_sum(torch.stack([loss_sum, tokens])).tolist()
+        avg_val_loss = loss_sum / max(tokens, 1)
+        expected, predicted = all_gather_objects(expected), all_gather_objects(predicted)
+        if main_process:
+            print(f'Epoch {epoch},Validation Loss: {avg_val_loss}')
+            wandb.log({"Validation Loss": avg_val_loss, "Global Step": global_step})
+            if predicted:
+                print_examples(expected, predicted, lambda msg: batch_iterator.write(msg))
+                val_metrics = caption_metrics(predicted, expected)
+                for name, value in val_metrics.items():
+                    writer.add_scalar(name, value, global_step)
+                writer.flush()
+                wandb.log({"Validation CER": val_metrics['validation cer'], "Validation WER": val_metrics['validation wer'],
+                           "Validation BLEU": val_metrics['validation BLEU'], "Global Step": global_step})
+
+        # Save the model at the end of every epoch, after validation so the saved RNG state
+        # is the one the next epoch starts with
+        save_checkpoint(checkpointer, config, f"{epoch:02d}", raw_model, optimizer, epoch, global_step)
+
+    metrics.close()
+    checkpointer.close()
+    cleanup_distributed()
 
      
 